@@ -5,10 +5,8 @@ import datetime
 import re
 from enum import Enum
 
-import plotly.io as pio
 import streamlit as st
 from langchain.callbacks import get_openai_callback
-from langchain.callbacks.base import BaseCallbackHandler
 from langchain.schema import OutputParserException
 
 import app
@@ -16,13 +14,19 @@ import app.patches
 import app.settings
 from api.connectors.bigquery import bigquery_client as client
 from api.security.guards import is_nda_broken_sync
-from app import datasets, db_charts, db_queries
+from app import datasets, db_queries, db_writer
+from app.analytics import record_query_status
 from app.auth import check_user_credits, requires_auth
+from app.charts import get_chart_figure
 from app.components.notices import Notices
 from app.components.sidebar import Sidebar
+from app.components.stream_handler import StreamHandler
+from app.users import increment_user_counter
 from config.datasets import Dataset
 from chartgpt.agents.agent_toolkits.bigquery.utils import get_sample_dataframes
-from chartgpt.app import get_agent
+from chartgpt.app import agent_pool, get_agent, invoke_agent
+from chartgpt.display import reset_display_registry
+from chartgpt.tools.bigquery.client import ReplBigQueryClient
 
 
 # Show notices
@@ -32,11 +36,8 @@ query_params = st.experimental_get_query_params()
 if "chart_id" in query_params:
     st.button("← Back to ChartGPT", on_click=st.experimental_set_query_params)
     # Get chart from Firestore
-    chart_ref = db_charts.document(query_params["chart_id"][0])
-    chart = chart_ref.get()
-    if chart.exists:
-        chart_json = chart.to_dict()["json"]
-        chart = pio.from_json(chart_json)
+    chart = get_chart_figure(query_params["chart_id"][0])
+    if chart is not None:
         st.plotly_chart(chart, use_container_width=True)
         st.stop()
     else:
@@ -102,45 +103,30 @@ def main(user_id, _user_email):
 
     display_sample_dataframes(dataset)
 
-    class StreamHandler(BaseCallbackHandler):
-        def on_llm_new_token(self, token: str, **kwargs) -> None:
-            if "text" not in st.session_state:
-                # NOTE This is necessary because of a bug in Streamlit state after st.stop()
-                return
-            st.session_state["text"] += token
-
-            def add_newlines(text):
-                # Add a newline before ```python
-                text = re.sub(r"```python", "\n\n```python", text)
-
-                # Add a newline after ``` when it's not followed by the word "python"
-                text = re.sub(r"```(?=\w)(?!python)", "```\n\n", text)
-
-                return text
-
-            st.session_state["text"] = add_newlines(st.session_state["text"])
-
-            # Using regex, find and remove `Action Input:` etc.
-            st.session_state["text"] = re.sub(
-                r"Action Input:\s*", "", st.session_state["text"], flags=re.IGNORECASE
-            )
-            st.session_state["text"] = re.sub(
-                r"Analysis Complete:\s*",
-                "",
-                st.session_state["text"],
-                flags=re.IGNORECASE,
-            )
-            st.session_state["empty_container"].markdown(st.session_state["text"])
-
-    # get_agent() is cached by Streamlit, where the cache is invalidated if dataset_ids changes
-    # if "agent" not in st.session_state:
+    # The agent is rebuilt only when the dataset or model temperature changes,
+    # or after the chat history is cleared, so that reruns reuse the agent
+    # and its memory. The prompt and schema are shared between sessions by
+    # the agent pool in get_agent().
     stream_handler = StreamHandler()
-    st.session_state["agent"] = get_agent(
-        secure_execution=True,
-        temperature=sidebar.model_temperature,
-        datasets=[dataset],
-        callbacks=[stream_handler],
-    )
+    agent_key = (dataset.project, dataset.id, sidebar.model_temperature)
+    if (
+        not st.session_state.get("agent")
+        or st.session_state.get("agent_key") != agent_key
+    ):
+        if "bigquery_client" not in st.session_state:
+            # Enforces dataset query budgets, caches query results and
+            # records statistics for this session
+            st.session_state["bigquery_client"] = ReplBigQueryClient(
+                client, datasets=datasets
+            )
+        st.session_state["agent"] = get_agent(
+            secure_execution=True,
+            temperature=sidebar.model_temperature,
+            datasets=[dataset],
+            bigquery_client=st.session_state["bigquery_client"],
+        )
+        st.session_state["agent_key"] = agent_key
+        app.logger.info("Agent pool metrics: %s", agent_pool.metrics)
 
     st.markdown("### 2. Ask a question 🤔")
 
@@ -246,8 +232,13 @@ def main(user_id, _user_email):
             "status": QueryStatus.SUBMITTED.name,
             "model_temperature": sidebar.model_temperature,
         }
-        query_ref.set(query_metadata)
+        db_writer.set(query_ref, dict(query_metadata))
+        increment_user_counter(user_id, "queries")
         st.session_state["query_metadata"] = query_metadata
+        # Objects displayed while answering a previous question can be freed
+        reset_display_registry()
+        # Reset query statistics so that they only cover this question
+        st.session_state["bigquery_client"].pop_stats()
 
         # Display user message in chat message container
         st.session_state["messages"].append({"role": "user", "content": question})
@@ -272,9 +263,11 @@ def main(user_id, _user_email):
                         st.session_state["empty_container"] = st.session_state[
                             "container"
                         ].empty()
-                        response = st.session_state.agent(
-                            question
-                        )  # callbacks=[stream_handler]
+                        response = invoke_agent(
+                            st.session_state.agent,
+                            question,
+                            callbacks=[stream_handler],
+                        )
                         app.logger.info("response = %s", response)
                         app.logger.info(cb)
                 else:
@@ -283,19 +276,27 @@ def main(user_id, _user_email):
                 final_output = response["output"]
                 intermediate_steps = response["intermediate_steps"]
                 timestamp_end = str(datetime.datetime.now())
-                query_ref.update(
+                agent = st.session_state.agent.agent
+                db_writer.update(
+                    query_ref,
                     {
                         "timestamp_end": timestamp_end,
                         "status": QueryStatus.SUCCEEDED.name,
                         "final_output": final_output,
                         "number_of_steps": len(intermediate_steps),
+                        "scratchpad_tokens": agent.scratchpad_tokens,
+                        "prompt_prefix_tokens": agent.prompt_prefix.tokens,
+                        "prompt_prefix_hash": agent.prompt_prefix.hash,
+                        "prompt_prefix_tokens_reused": agent.prompt_prefix_tokens_reused,
                         "steps": [str(step) for step in intermediate_steps],
                         "total_tokens": cb.total_tokens,
                         "prompt_tokens": cb.prompt_tokens,
                         "completion_tokens": cb.completion_tokens,
                         "estimated_total_cost": cb.total_cost,
-                    }
+                        "query_cache": st.session_state["bigquery_client"].pop_stats(),
+                    },
                 )
+                record_query_status(timestamp_start, QueryStatus.SUCCEEDED.name)
 
                 st.success(
                     """
@@ -307,13 +308,16 @@ def main(user_id, _user_email):
                 )
             except OutputParserException as e:
                 timestamp_end = str(datetime.datetime.now())
-                query_ref.update(
+                db_writer.update(
+                    query_ref,
                     {
                         "timestamp_end": timestamp_end,
                         "status": QueryStatus.FAILED.name,
                         "failure": str(e),
-                    }
+                        "query_cache": st.session_state["bigquery_client"].pop_stats(),
+                    },
                 )
+                record_query_status(timestamp_start, QueryStatus.FAILED.name)
                 st.error(
                     "Analysis failed."
                     + "\n\n"
@@ -323,13 +327,16 @@ def main(user_id, _user_email):
                 )
             except Exception as e:
                 timestamp_end = str(datetime.datetime.now())
-                query_ref.update(
+                db_writer.update(
+                    query_ref,
                     {
                         "timestamp_end": timestamp_end,
                         "status": QueryStatus.FAILED.name,
                         "failure": str(e),
-                    }
+                        "query_cache": st.session_state["bigquery_client"].pop_stats(),
+                    },
                 )
+                record_query_status(timestamp_start, QueryStatus.FAILED.name)
                 if app.DEBUG:
                     raise e
                 else:
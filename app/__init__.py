@@ -13,6 +13,8 @@ from google.cloud import bigquery
 from google.oauth2 import service_account
 from sentry_sdk import capture_exception, set_tag
 
+from app.write_behind import FirestoreWriter
+
 # Load environment variables from .env
 load_dotenv()
 # If set, Streamlit secrets take preference over environment variables
@@ -25,6 +27,9 @@ URL = os.environ.get("URL", "http://localhost:8501")
 # Configure logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
+# Modules of the chartgpt package log to their own module loggers
+chartgpt_logger = logging.getLogger("chartgpt")
+chartgpt_logger.setLevel(logging.INFO)
 
 if ENV == "LOCAL":
     import app_secrets.gcp_service_accounts
@@ -39,6 +44,7 @@ if DEBUG := (os.getenv("DEBUG", "false").lower() == "true"):
         )
     )
     logger.addHandler(fh)
+    chartgpt_logger.addHandler(fh)
 
 if DISPLAY_USER_UPDATES := (
     os.getenv("DISPLAY_USER_UPDATES", "false").lower() == "true"
@@ -96,6 +102,12 @@ db = firestore.client()
 db_charts = db.collection("charts")
 db_users = db.collection("users")
 db_queries = db.collection("queries")
+# Per-user usage counts, see app.users.get_user_counters()
+db_user_counters = db.collection("user_counters")
+# Number of finished queries per day and status, see app.analytics
+db_daily_query_stats = db.collection("daily_query_stats")
+# Writes that users shouldn't wait on, committed in batches in the background
+db_writer = FirestoreWriter(db)
 
 st.markdown(
     """
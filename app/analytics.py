@@ -0,0 +1,67 @@
+"""Usage analytics for the admin dashboard, read from rollup collections.
+
+Rather than streaming every query and chart, counts are read from documents
+that are incremented as queries and charts are written: `user_counters` has
+the number of queries and charts of each user (see `app.users`), and
+`daily_query_stats` has the number of finished queries per day and status.
+"""
+
+import os
+
+import pandas as pd
+import streamlit as st
+from firebase_admin import firestore
+
+from app import db_daily_query_stats, db_user_counters, db_users, db_writer
+from app.users import backfill_user_counters, is_backfilled
+
+# Seconds the dashboard reuses analytics before reading them again
+ANALYTICS_CACHE_TTL = float(os.environ.get("ANALYTICS_CACHE_TTL", 300))
+
+
+def record_query_status(timestamp_start: str, status: str) -> None:
+    """Count a finished query in the `daily_query_stats` of the day it started."""
+    day = timestamp_start[:10]
+    db_writer.set(
+        db_daily_query_stats.document(day),
+        {"date": day, status: firestore.Increment(1)},
+        merge=True,
+    )
+
+
+@st.cache_data(ttl=ANALYTICS_CACHE_TTL, show_spinner=False)
+def get_user_analytics() -> pd.DataFrame:
+    """Number of queries and charts of every user, most queries first."""
+    counters = {counter.id: counter.to_dict() for counter in db_user_counters.stream()}
+    rows = []
+    for user in db_users.select(["user_email"]).stream():
+        # Users who haven't loaded the app since counters were added
+        counts = counters.get(user.id)
+        if not is_backfilled(counts):
+            counts = backfill_user_counters(user.id)
+        rows.append(
+            {
+                "id": user.id,
+                "user_email": user.to_dict().get("user_email"),
+                "number_of_queries": counts.get("queries", 0),
+                "number_of_charts": counts.get("charts", 0),
+            }
+        )
+    df_users = pd.DataFrame(
+        rows, columns=["id", "user_email", "number_of_queries", "number_of_charts"]
+    )
+    df_users["active"] = (df_users["number_of_queries"] > 0) | (
+        df_users["number_of_charts"] > 0
+    )
+    return df_users.sort_values(by=["number_of_queries"], ascending=False).reset_index(
+        drop=True
+    )
+
+
+@st.cache_data(ttl=ANALYTICS_CACHE_TTL, show_spinner=False)
+def get_daily_query_stats() -> pd.DataFrame:
+    """Number of finished queries per day (index) and status (columns)."""
+    stats = [day.to_dict() for day in db_daily_query_stats.order_by("date").stream()]
+    if not stats:
+        return pd.DataFrame()
+    return pd.DataFrame(stats).set_index("date").fillna(0).astype(int)
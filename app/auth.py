@@ -7,8 +7,9 @@ https://console.developers.google.com/apis/api/people.googleapis.com/overview
 """
 
 import os
+import time
 from typing import Optional
-from functools import wraps
+from functools import lru_cache, wraps
 import jwt
 
 import streamlit as st
@@ -19,6 +20,10 @@ from app import db_users
 from app.users import UserCredits
 
 
+# Seconds a closed beta membership lookup is reused across sessions
+CLOSED_BETA_CACHE_TTL = float(os.environ.get("CLOSED_BETA_CACHE_TTL", 300))
+
+
 class AuthError(Exception):
     pass
 
@@ -32,6 +37,71 @@ def get_token() -> Optional[str]:
         return None
 
 
+@lru_cache(maxsize=1024)
+def _decode_token(token: str) -> dict:
+    # Expiry is checked on every use by decode_token(), not cached
+    return jwt.decode(
+        token,
+        key=os.environ["JWT_SECRET_KEY"],
+        algorithms=["HS256"],
+        options={"verify_exp": False},
+    )
+
+
+def decode_token(token: str) -> dict:
+    """Decode and verify a JWT, verifying each token's signature only once."""
+    decoded_token = _decode_token(token)
+    exp = decoded_token.get("exp")
+    if exp is not None and int(exp) <= time.time():
+        raise jwt.ExpiredSignatureError("Signature has expired")
+    return decoded_token
+
+
+def is_closed_beta_member(user_email: str) -> bool:
+    """Whether the email address has a `closed_beta_email_addresses` document.
+
+    Documents are keyed by lower-cased email address, see
+    `scripts/firestore_closed_beta_email_addresses_lowercase.py`. Only members
+    are cached, so that users added to the closed beta are let in at once.
+    """
+    try:
+        return _get_closed_beta_membership(user_email.lower())
+    except KeyError:
+        return False
+
+
+@st.cache_data(ttl=CLOSED_BETA_CACHE_TTL, show_spinner=False)
+def _get_closed_beta_membership(email_id: str) -> bool:
+    # Raises KeyError for non-members, as st.cache_data doesn't cache errors
+    if (
+        not app.db.collection("closed_beta_email_addresses")
+        .document(email_id)
+        .get()
+        .exists
+    ):
+        raise KeyError(email_id)
+    return True
+
+
+def save_user(user_id: str, user_email: str) -> UserCredits:
+    """Upsert the user and create their credits if they don't exist."""
+    db_users.document(user_id).set(
+        {
+            "user_id": user_id,
+            "user_email": user_email,
+        },
+        merge=True,
+    )
+
+    # Create user credits if they don't exist
+    if not (user_credits := UserCredits.collection.get(key=f"user_credits/{user_id}")):
+        user_credits = UserCredits()
+        user_credits.user_id = user_id
+        user_credits.free_credits = 20
+        user_credits.save()
+    return user_credits
+
+
 def requires_auth(f=lambda *args, **kwargs: None):
     """Determines if the Access Token is valid"""
 
@@ -49,59 +119,25 @@ def requires_auth(f=lambda *args, **kwargs: None):
             set_user({"id": "anonymous", "email": "anonymous"})
             with st.spinner("Loading..."):
                 try:
-                    decoded_token = jwt.decode(
-                        token, key=os.environ["JWT_SECRET_KEY"], algorithms=["HS256"]
-                    )
+                    decoded_token = decode_token(token)
                     user_id = decoded_token["user_id"]
                     user_email = decoded_token["user_email"]
-                    closed_beta_email_addresses_result = app.db.collection(
-                        "closed_beta_email_addresses"
-                    ).get()
-                    closed_beta_email_addresses = [
-                        doc.id.lower() for doc in closed_beta_email_addresses_result
-                    ]
                     query_params = st.experimental_get_query_params()
                     chart_id = query_params.get("chart_id", None)
                     if user_id and user_email:
                         # st.toast(f"Logging in...", icon='🔒')
                         set_user({"id": user_id, "email": user_email})
-                        if user_email.lower() in closed_beta_email_addresses:
-                            # Save user details in Firestore
-                            user_ref = db_users.document(user_id)
-                            if not user_ref.get().exists:
-                                # Create user if they don't exist
-                                user_ref.create(
-                                    {
-                                        "user_id": user_id,
-                                        "user_email": user_email,
-                                    }
-                                )
-                            else:
-                                # Update user if they exist
-                                user_ref.update(
-                                    {
-                                        "user_id": user_id,
-                                        "user_email": user_email,
-                                    }
-                                )
-
-                            # Create user credits if they don't exist
-                            if not (
-                                user_credits := UserCredits.collection.get(
-                                    key=f"user_credits/{user_id}"
-                                )
-                            ):
-                                user_credits = UserCredits()
-                                user_credits.user_id = user_id
-                                user_credits.free_credits = 20
-                                user_credits.save()
+                        if is_closed_beta_member(user_email):
+                            # Save user details in Firestore, once per session
+                            if st.session_state.get("user_id") != user_id:
+                                user_credits = save_user(user_id, user_email)
+                                st.session_state[
+                                    "user_free_credits"
+                                ] = user_credits.free_credits
 
                             # Save user details in session state
                             st.session_state["user_id"] = user_id
                             st.session_state["user_email"] = user_email
-                            st.session_state[
-                                "user_free_credits"
-                            ] = user_credits.free_credits
 
                             if chart_id:
                                 st.experimental_set_query_params(
@@ -135,7 +171,6 @@ def requires_auth(f=lambda *args, **kwargs: None):
         return decorated
 
 
-
 def check_user_credits() -> None:
     # Check user credit usage
     user_query_count = st.session_state["user_query_count"]
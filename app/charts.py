@@ -1,6 +1,28 @@
-from typing import Optional
+import json
+import logging
+import os
+import sys
+import zlib
+from functools import lru_cache
+from typing import Any, Dict, Optional
+
+import plotly.io as pio
+from plotly.graph_objs import Figure
 
 from app import db_charts
+from chartgpt.figures import decode_arrays, encode_arrays, optimize_figure
+
+logger = logging.getLogger(__name__)
+
+# Optional, Cloud Storage bucket for chart JSON, which is otherwise stored
+# compressed in the chart's Firestore document
+CHART_BUCKET = os.environ.get("CHART_BUCKET") or None
+CHART_COMPRESSION_LEVEL = 6
+# Parsed figures of charts kept in memory, shared between sessions
+CHART_FIGURE_CACHE_SIZE = int(os.environ.get("CHART_FIGURE_CACHE_SIZE", 64))
+# Points per trace, and height in pixels, of chart thumbnails
+CHART_THUMBNAIL_POINTS = 200
+CHART_THUMBNAIL_HEIGHT = 300
 
 
 def get_chart(chart_id) -> Optional[dict]:
@@ -10,3 +32,89 @@ def get_chart(chart_id) -> Optional[dict]:
         return {"id": chart.id, **chart.to_dict()}
     else:
         return None
+
+
+def get_chart_figure(chart_id) -> Optional[Figure]:
+    """Parsed figure of a chart, loaded only when it's shown in full.
+
+    Missing charts aren't cached, as a chart's document is written in the
+    background and may not exist yet when a link to it is opened.
+    """
+    try:
+        return _load_chart_figure(chart_id)
+    except KeyError:
+        return None
+
+
+def make_thumbnail(chart_json: str) -> str:
+    """Figure JSON of a small, downsampled copy of a chart, for galleries."""
+    figure = pio.from_json(chart_json)
+    # Galleries show many thumbnails, and browsers only allow a few WebGL
+    # contexts, so traces aren't converted to WebGL
+    optimize_figure(figure, max_points=CHART_THUMBNAIL_POINTS, webgl_points=sys.maxsize)
+    figure = json.loads(pio.to_json(figure, validate=False))
+    layout = figure.setdefault("layout", {})
+    # Galleries apply the Streamlit theme, so the template isn't needed
+    layout.pop("template", None)
+    layout["height"] = CHART_THUMBNAIL_HEIGHT
+    return json.dumps(figure, separators=(",", ":"))
+
+
+def store_chart_json(chart_id: str, chart: Dict[str, Any]) -> Dict[str, Any]:
+    """Replace the chart's "json" with a compressed copy or a blob reference.
+
+    Numeric arrays are stored as base64 typed arrays. Also adds the chart's
+    thumbnail. Run by the Firestore writer in the background, before the
+    chart's document is written.
+    """
+    chart = dict(chart)
+    chart["thumbnail"] = make_thumbnail(chart["json"])
+    chart_json = json.dumps(
+        encode_arrays(json.loads(chart.pop("json"))), separators=(",", ":")
+    )
+    compressed = zlib.compress(chart_json.encode(), CHART_COMPRESSION_LEVEL)
+    if "figure_stats" in chart:
+        chart["figure_stats"] = {
+            **chart["figure_stats"],
+            "stored_bytes": len(compressed),
+        }
+    if CHART_BUCKET:
+        from firebase_admin import storage
+
+        blob = storage.bucket(CHART_BUCKET).blob(f"charts/{chart_id}.json.zlib")
+        blob.upload_from_string(compressed, content_type="application/octet-stream")
+        chart["json_uri"] = f"gs://{CHART_BUCKET}/{blob.name}"
+    else:
+        chart["json_zlib"] = compressed
+    return chart
+
+
+def load_chart_json(chart: Dict[str, Any]) -> str:
+    """Figure JSON of a chart document, however it was stored."""
+    if "json_uri" in chart:
+        chart_json = _download_chart_json(chart["json_uri"])
+    elif "json_zlib" in chart:
+        chart_json = zlib.decompress(chart["json_zlib"]).decode()
+    else:
+        return chart["json"]
+    # Typed arrays need a newer Plotly.js than Streamlit ships with
+    return json.dumps(decode_arrays(json.loads(chart_json)))
+
+
+@lru_cache(maxsize=CHART_FIGURE_CACHE_SIZE)
+def _load_chart_figure(chart_id) -> Figure:
+    # Raises KeyError for missing charts, which lru_cache doesn't cache
+    chart = get_chart(chart_id)
+    if chart is None:
+        raise KeyError(chart_id)
+    return pio.from_json(load_chart_json(chart))
+
+
+@lru_cache(maxsize=128)
+def _download_chart_json(uri: str) -> str:
+    from firebase_admin import storage
+
+    bucket, name = uri[len("gs://") :].split("/", 1)
+    return zlib.decompress(
+        storage.bucket(bucket).blob(name).download_as_bytes()
+    ).decode()
@@ -0,0 +1,71 @@
+import json
+import os
+
+import streamlit as st
+from firebase_admin import firestore
+
+from app.charts import get_chart_figure
+
+CHART_GALLERY_PAGE_SIZE = int(os.environ.get("CHART_GALLERY_PAGE_SIZE", 10))
+# Fields of chart documents listed in galleries, without their full figure
+GALLERY_FIELDS = ["query_metadata", "timestamp", "thumbnail"]
+
+
+class ChartGallery:
+    """Pages of chart thumbnails, most recent first.
+
+    Pages are fetched with a cursor on `timestamp` and only the fields shown,
+    so load time depends on the page size rather than the number or size of
+    charts. A chart's full, interactive figure is only loaded when expanded.
+    """
+
+    def __init__(self, query, key: str, page_size: int = CHART_GALLERY_PAGE_SIZE):
+        self.key = key
+        # Cursors of the pages viewed so far, the last one being displayed
+        cursors = st.session_state.setdefault(f"{key}_cursors", [None])
+        charts_query = query.select(GALLERY_FIELDS).order_by(
+            "timestamp", direction=firestore.Query.DESCENDING
+        )
+        if cursors[-1] is not None:
+            charts_query = charts_query.start_after(cursors[-1])
+        # Fetch one more chart than displayed, to know if there is a next page
+        charts = list(charts_query.limit(page_size + 1).stream())
+        has_next_page = len(charts) > page_size
+        charts = charts[:page_size]
+
+        for chart in charts:
+            self.display_chart(chart)
+
+        previous_column, next_column = st.columns(2)
+        if len(cursors) > 1:
+            previous_column.button(
+                "← Newer charts", key=f"{key}_newer", on_click=cursors.pop
+            )
+        if has_next_page:
+            next_column.button(
+                "Older charts →",
+                key=f"{key}_older",
+                on_click=cursors.append,
+                args=({"timestamp": charts[-1].get("timestamp")},),
+            )
+
+    def display_chart(self, chart) -> None:
+        query_metadata = chart.get("query_metadata") or {}
+        st.markdown(f"#### {query_metadata.get('query')}")
+        st.markdown(f"Dataset: `{query_metadata.get('dataset_id')}`")
+        # TODO Re-enable sharing of charts
+        # st.button('Copy chart URL', type="primary", key=chart.id, on_click=copy_url_to_clipboard, args=(f"/?chart_id={chart.id}",))
+
+        thumbnail = chart.to_dict().get("thumbnail")
+        if st.checkbox(
+            "Interactive chart", key=f"{self.key}_{chart.id}", value=not thumbnail
+        ):
+            figure = get_chart_figure(chart.id)
+            if figure is not None:
+                st.plotly_chart(figure, use_container_width=True)
+        elif thumbnail:
+            st.plotly_chart(
+                json.loads(thumbnail),
+                use_container_width=True,
+                config={"staticPlot": True},
+            )
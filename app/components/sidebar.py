@@ -1,10 +1,11 @@
 import os
+import time
 from dataclasses import dataclass
 
 import streamlit as st
-from google.cloud.firestore_v1.base_query import FieldFilter
 
 import app
+from app.users import get_user_counters
 
 
 @dataclass
@@ -20,20 +21,20 @@ class Sidebar:
             user_id = st.session_state["user_id"]
             user_email = st.session_state["user_email"]
 
-            user_query_count = (
-                app.db_queries.where(filter=FieldFilter("user_id", "==", user_id))
-                .count()
-                .get()[0][0]
-                .value
+            start = time.perf_counter()
+            previous = st.session_state.get("user_counters")
+            counts = get_user_counters(user_id)
+            cached = previous is not None and previous is st.session_state.get(
+                "user_counters"
             )
-            st.session_state["user_query_count"] = user_query_count
-
-            user_chart_count = (
-                app.db_charts.where(filter=FieldFilter("user_id", "==", user_id))
-                .count()
-                .get()[0][0]
-                .value
+            app.logger.info(
+                "Read usage counters from %s in %.2f ms",
+                "the session" if cached else "Firestore",
+                (time.perf_counter() - start) * 1000,
             )
+            user_query_count = counts["queries"]
+            st.session_state["user_query_count"] = user_query_count
+            user_chart_count = counts["charts"]
             st.session_state["user_chart_count"] = user_chart_count
 
             st.markdown(
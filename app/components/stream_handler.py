@@ -0,0 +1,149 @@
+import os
+import time
+from typing import Any, List, Union
+
+import streamlit as st
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.schema import LLMResult
+
+# Minimum seconds between re-renders of the streamed markdown
+STREAM_FLUSH_INTERVAL = float(os.environ.get("STREAM_FLUSH_INTERVAL", 0.1))
+
+CODE_FENCE = "```"
+PYTHON_CODE_FENCE = "```python"
+# Labels in the agent's output that aren't shown to the user
+HIDDEN_LABELS = ("action input:", "analysis complete:")
+
+
+class StreamRewriter:
+    """Rewrites streamed LLM output for display, one token at a time.
+
+    Puts code fences on their own paragraph and removes the agent's labels,
+    processing each token once rather than the whole text so far. Text that
+    could be the start of a code fence or label is held back until the next
+    token decides it.
+    """
+
+    def __init__(self) -> None:
+        self._pending = ""
+        self._skip_whitespace = False
+
+    def feed(self, token: str) -> str:
+        """Return the display text for a token, and any text held back before."""
+        text = self._pending + token
+        self._pending = ""
+        out: List[str] = []
+        i = 0
+        while i < len(text):
+            char = text[i]
+            after_label = self._skip_whitespace
+            if self._skip_whitespace:
+                if char.isspace():
+                    i += 1
+                    continue
+                self._skip_whitespace = False
+            if char == "`":
+                rest = text[i : i + len(PYTHON_CODE_FENCE)]
+                if (
+                    rest != PYTHON_CODE_FENCE
+                    and PYTHON_CODE_FENCE.startswith(rest)
+                    and i + len(rest) == len(text)
+                ):
+                    # Maybe a fence, opening or closing, decided by what follows
+                    self._pending = rest
+                    self._skip_whitespace = after_label
+                    break
+                if rest.startswith(CODE_FENCE + "`"):
+                    # A fence starts at the last three backticks of a run
+                    out.append(char)
+                    i += 1
+                    continue
+                if rest == PYTHON_CODE_FENCE:
+                    # Directly after a label, the fence replaces it and its newline
+                    out.append(PYTHON_CODE_FENCE if after_label else "\n\n```python")
+                    i += len(PYTHON_CODE_FENCE)
+                    continue
+                if rest.startswith(CODE_FENCE):
+                    out.append(CODE_FENCE)
+                    i += len(CODE_FENCE)
+                    if text[i].isalnum() or text[i] == "_":
+                        # Text straight after a closing fence
+                        out.append("\n\n")
+                    continue
+            if char in "aA":
+                rest = text[i : i + max(map(len, HIDDEN_LABELS))].lower()
+                label = next((l for l in HIDDEN_LABELS if rest.startswith(l)), None)
+                if label:
+                    self._skip_whitespace = True
+                    i += len(label)
+                    continue
+                if any(l.startswith(rest) for l in HIDDEN_LABELS) and (
+                    i + len(rest) == len(text)
+                ):
+                    self._pending = text[i:]
+                    break
+            out.append(char)
+            i += 1
+        return "".join(out)
+
+    def flush(self) -> str:
+        """Return any text held back, at the end of the output."""
+        text, self._pending = self._pending, ""
+        self._skip_whitespace = False
+        if text.startswith(CODE_FENCE) and len(text) > len(CODE_FENCE):
+            # A closing fence followed by the start of "python"
+            return CODE_FENCE + "\n\n" + text[len(CODE_FENCE) :]
+        return text
+
+
+class StreamHandler(BaseCallbackHandler):
+    """Streams the agent's output into `st.session_state["empty_container"]`.
+
+    Text is appended to `st.session_state["text"]` as tokens arrive, but the
+    markdown is only re-rendered every `flush_interval` seconds and when the
+    LLM finishes, as each render sends the whole text to the browser.
+    """
+
+    def __init__(self, flush_interval: float = STREAM_FLUSH_INTERVAL) -> None:
+        self.flush_interval = flush_interval
+        self._rewriter = StreamRewriter()
+        self._flushed_at = 0.0
+        self._dirty = False
+
+    def on_llm_start(self, serialized: Any, prompts: List[str], **kwargs) -> None:
+        self._rewriter = StreamRewriter()
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        if "text" not in st.session_state:
+            # NOTE This is necessary because of a bug in Streamlit state after st.stop()
+            return
+        text = self._rewriter.feed(token)
+        if not text:
+            return
+        st.session_state["text"] += text
+        self._dirty = True
+        if time.monotonic() - self._flushed_at >= self.flush_interval:
+            self._render()
+
+    def on_llm_end(self, response: LLMResult, **kwargs) -> None:
+        self._flush()
+
+    def on_llm_error(
+        self, error: Union[Exception, KeyboardInterrupt], **kwargs
+    ) -> None:
+        self._flush()
+
+    def _flush(self) -> None:
+        if "text" not in st.session_state:
+            return
+        text = self._rewriter.flush()
+        if text:
+            st.session_state["text"] += text
+            self._dirty = True
+        if self._dirty:
+            self._render()
+
+    def _render(self) -> None:
+        st.session_state["empty_container"].markdown(st.session_state["text"])
+        self._flushed_at = time.monotonic()
+        self._dirty = False
@@ -3,11 +3,15 @@ import json
 import pandas as pd
 import plotly.express as px
 import streamlit as st
+from google.cloud.firestore_v1.base_query import FieldFilter
 
+from app import db_charts
+from app.analytics import get_daily_query_stats, get_user_analytics
 from app.auth import is_user_admin, requires_auth
-from app.charts import get_chart
+from app.charts import get_chart, load_chart_json
+from app.components.chart_gallery import ChartGallery
 from app.components.notices import Notices
-from app.users import UserCredits, get_user_charts, get_user_queries, get_users
+from app.users import UserCredits, get_user_queries
 
 # Show notices
 Notices()
@@ -28,22 +32,7 @@ def main(user_id, user_email):
         with user_analytics_tab:
             # Allow user to select a user, and display the user email instead of the ID
             st.markdown("## Users")
-            df_users = pd.DataFrame(get_users())[["id", "user_email"]]
-
-            # Add analytics to df_users
-            df_users["number_of_queries"] = df_users["id"].apply(
-                lambda user_id: len(get_user_queries(user_id))
-            )
-            df_users["number_of_charts"] = df_users["id"].apply(
-                lambda user_id: len(get_user_charts(user_id))
-            )
-            df_users["active"] = (df_users["number_of_queries"] > 0) | (
-                df_users["number_of_charts"] > 0
-            )
-            # Sort by number of queries
-            df_users = df_users.sort_values(
-                by=["number_of_queries"], ascending=False
-            ).reset_index(drop=True)
+            df_users = get_user_analytics()
 
             user_analytics_csv = df_users.to_csv(index=False).encode("utf-8")
 
@@ -67,6 +56,13 @@ def main(user_id, user_email):
             # Create a Pandas dataframe of all users
             st.dataframe(df_users)
 
+            # Plot the number of finished queries per day by status
+            st.markdown("## Daily Queries")
+            df_daily_query_stats = get_daily_query_stats()
+            if df_daily_query_stats.shape[0] > 0:
+                fig = px.bar(df_daily_query_stats)
+                st.plotly_chart(fig)
+
         with user_tab:
             # User data
             st.markdown(f"## User: {user_email}")
@@ -102,11 +98,6 @@ def main(user_id, user_email):
             df_queries = pd.DataFrame(get_user_queries(user_id))
             st.dataframe(df_queries)
 
-            # Create a Pandas dataframe of all charts for the selected user
-            st.markdown("## User Charts")
-            df_charts = pd.DataFrame(get_user_charts(user_id))
-            st.dataframe(df_charts)
-
             # Set Pandas plotting backend to Plotly
             pd.options.plotting.backend = "plotly"
 
@@ -146,10 +137,12 @@ def main(user_id, user_email):
             fig = px.histogram(df_queries, x="number_of_steps", nbins=100)
             st.plotly_chart(fig)
 
-            # Using the Plotly chart `json` field, display all the user's Plotly charts
+            # Display the user's charts, a page at a time
             st.markdown("## User Charts")
-            for chart in get_user_charts(user_id):
-                st.plotly_chart(json.loads(chart["json"]))
+            ChartGallery(
+                db_charts.where(filter=FieldFilter("user_id", "==", user_id)),
+                key=f"admin_charts_{user_id}",
+            )
 
         with chart_tab:
             # Get details for a specific chart
@@ -158,7 +151,7 @@ def main(user_id, user_email):
             if chart_id:
                 chart = get_chart(chart_id)
                 if chart:
-                    st.plotly_chart(json.loads(chart["json"]))
+                    st.plotly_chart(json.loads(load_chart_json(chart)))
                     st.json(chart)
                 else:
                     st.info("Chart not found.")
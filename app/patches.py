@@ -1,13 +1,16 @@
 import datetime
-from io import StringIO
 
 import pandas as pd
 import plotly.io as pio
-from pandas.io.formats import format as fmt
 from plotly.graph_objs._figure import Figure
 
-from app import ENV, db_charts, logger
+from app import ENV, db_charts, db_writer, logger
+from app.charts import store_chart_json
+from app.users import increment_user_counter
 from app.utils import copy_url_to_clipboard
+from chartgpt.data.preview import preview
+from chartgpt.display import get_display_registry
+from chartgpt.figures import optimize_figure
 
 # Set plotly as the default plotting backend for pandas
 pd.options.plotting.backend = "plotly"
@@ -17,21 +20,14 @@ pd.options.plotting.backend = "plotly"
 def pd_display(self):
     import streamlit as st
 
-    df_id = id(self)
-    if df_id not in st.session_state:
+    if get_display_registry().mark(self):
         st.session_state["container"].text("")
         st.session_state["container"].dataframe(self)
         st.session_state["text"] = "\n\n"
         st.session_state["empty_container"] = st.session_state["container"].empty()
-        st.session_state[df_id] = 1
 
-    if self._info_repr():
-        buf = StringIO()
-        self.info(buf=buf)
-        return buf.getvalue()
-
-    repr_params = fmt.get_dataframe_repr_params()
-    return self.to_string(**repr_params)
+    # Bounded, as this is called for observations and logs of agent steps
+    return preview(self)
 
 
 pd.DataFrame.display = lambda self: pd_display(self)
@@ -51,13 +47,11 @@ pd.core.frame.DataFrame._repr_html_ = lambda self: pd_display(self)
 def pandas_object_display(self):
     import streamlit as st
 
-    df_id = id(self)
-    if df_id not in st.session_state:
+    if get_display_registry().mark(self):
         st.session_state["container"].text("")
         st.session_state["container"].dataframe(self)
         st.session_state["text"] = "\n\n"
         st.session_state["empty_container"] = st.session_state["container"].empty()
-        st.session_state[df_id] = 1
 
     return object.__repr__(self)
 
@@ -68,16 +62,13 @@ pd.core.base.PandasObject.__repr__ = lambda self: pandas_object_display(self)
 def series_display(self):
     import streamlit as st
 
-    df_id = id(self)
-    if df_id not in st.session_state:
+    if get_display_registry().mark(self):
         st.session_state["container"].text("")
         st.session_state["container"].dataframe(self)
         st.session_state["text"] = "\n\n"
         st.session_state["empty_container"] = st.session_state["container"].empty()
-        st.session_state[df_id] = 1
 
-    repr_params = fmt.get_series_repr_params()
-    return self.to_string(**repr_params)
+    return preview(self)
 
 
 pd.core.series.Series.__repr__ = lambda self: series_display(self)
@@ -87,13 +78,17 @@ pd.core.series.Series.__repr__ = lambda self: series_display(self)
 def st_show(self):
     import streamlit as st
 
-    figure_id = id(self)
-    if figure_id not in st.session_state:
+    if get_display_registry().mark(self):
+        figure_stats = optimize_figure(self)._asdict()
         st.session_state["container"].plotly_chart(self, use_container_width=True)
         chart_json = self.to_json()
-        # Create new Firestore document with unique ID:
+        figure_stats["json_bytes"] = len(chart_json)
+        # Create new Firestore document with unique ID, generated client-side,
+        # written in the background with its JSON compressed or offloaded
         chart_ref = db_charts.document()
-        chart_ref.set(
+        chart_id = chart_ref.id
+        db_writer.set(
+            chart_ref,
             {
                 "user_id": st.session_state.get("user_id", None),
                 "user_email": st.session_state.get("user_email", None),
@@ -101,9 +96,11 @@ def st_show(self):
                 "query_metadata": st.session_state["query_metadata"],
                 "timestamp": str(datetime.datetime.now()),
                 "json": chart_json,
-            }
+                "figure_stats": figure_stats,
+            },
+            prepare=lambda chart: store_chart_json(chart_id, chart),
         )
-        chart_id = chart_ref.id
+        increment_user_counter(st.session_state.get("user_id"), "charts")
         # TODO Re-enable sharing of charts
         # st.session_state["container"].button('Copy chart URL', type="primary", key=chart_id, on_click=copy_url_to_clipboard, args=(f"/?chart_id={chart_id}",))
         st.session_state["text"] = "\n\n"
@@ -116,12 +113,11 @@ def st_show(self):
                 "chart_id": chart_id,
             }
         )
-        st.session_state[figure_id] = 1
         try:
             pio.templates.default = "plotly"
             self.update_layout(template=pio.templates.default)
             # TODO Enable for Discord bot
-            # self.write_image(f'app/outputs/{figure_id}.png')
+            # self.write_image(f'app/outputs/{id(self)}.png')
         except ValueError as e:
             logger.error(e)
     # return plotly.io.to_image(self, format="png")
@@ -1,12 +1,20 @@
+import os
+import time
 from dataclasses import dataclass
+from typing import Any, Dict, Optional
 
 import pandas as pd
 import plotly.express as px
 import streamlit as st
+from firebase_admin import firestore
 from fireo.fields import IDField, NumberField
 from fireo.models import Model
+from google.cloud.firestore_v1.base_query import FieldFilter
 
-from app import db_charts, db_queries, db_users
+from app import db, db_charts, db_queries, db_user_counters, db_users, db_writer
+
+# Seconds a session reuses a user's counters before reading them again
+USER_COUNTERS_TTL = float(os.environ.get("USER_COUNTERS_TTL", 60))
 
 
 class UserCredits(Model):
@@ -34,6 +42,90 @@ def get_user_charts(user_id):
     return [{"id": chart.id, **chart.to_dict()} for chart in charts]
 
 
+def get_user_counters(user_id) -> Dict[str, int]:
+    """Number of queries and charts of a user, cached in the session.
+
+    Read from the user's `user_counters` document, which is backfilled with
+    count aggregations the first time it's needed, then incremented as
+    queries and charts are written. Increments can create the document
+    before it's backfilled, so it's backfilled until it has `backfilled`. Counts are reused for `USER_COUNTERS_TTL`
+    seconds and incremented locally, so most reruns don't call Firestore.
+    """
+    cached = st.session_state.get("user_counters")
+    if (
+        cached is not None
+        and cached["user_id"] == user_id
+        and time.monotonic() - cached["read_at"] < USER_COUNTERS_TTL
+    ):
+        return cached["counts"]
+
+    counters = db_user_counters.document(user_id).get()
+    counts = counters.to_dict() if counters.exists else None
+    if not is_backfilled(counts):
+        counts = backfill_user_counters(user_id)
+    counts = {"queries": counts.get("queries", 0), "charts": counts.get("charts", 0)}
+    st.session_state["user_counters"] = {
+        "user_id": user_id,
+        "counts": counts,
+        "read_at": time.monotonic(),
+    }
+    return counts
+
+
+def is_backfilled(counts: Optional[Dict[str, Any]]) -> bool:
+    """Whether a `user_counters` document has been backfilled."""
+    return bool(counts and counts.get("backfilled"))
+
+
+def backfill_user_counters(user_id) -> Dict[str, Any]:
+    """Set a user's counters to count aggregations, unless already backfilled.
+
+    Replaces counts incremented before the backfill, which the aggregations
+    include.
+    """
+    counts = {
+        "queries": _count_user_documents(db_queries, user_id),
+        "charts": _count_user_documents(db_charts, user_id),
+        "backfilled": True,
+    }
+    return _set_backfilled_counters(
+        db.transaction(), db_user_counters.document(user_id), counts
+    )
+
+
+@firestore.transactional
+def _set_backfilled_counters(transaction, counters_ref, counts) -> Dict[str, Any]:
+    counters = counters_ref.get(transaction=transaction)
+    if counters.exists and is_backfilled(counters.to_dict()):
+        # Backfilled by another session in the meantime
+        return counters.to_dict()
+    transaction.set(counters_ref, counts, merge=True)
+    return counts
+
+
+def increment_user_counter(user_id, counter: str) -> None:
+    """Count a new query or chart of a user, in the background."""
+    if not user_id:
+        return
+    db_writer.set(
+        db_user_counters.document(user_id),
+        {counter: firestore.Increment(1)},
+        merge=True,
+    )
+    cached = st.session_state.get("user_counters")
+    if cached is not None and cached["user_id"] == user_id:
+        cached["counts"][counter] += 1
+
+
+def _count_user_documents(collection, user_id) -> int:
+    return (
+        collection.where(filter=FieldFilter("user_id", "==", user_id))
+        .count()
+        .get()[0][0]
+        .value
+    )
+
+
 def plot_daily_queries(user_id):
     # Get all queries for the user
     queries = get_user_queries(user_id)
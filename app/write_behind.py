@@ -0,0 +1,200 @@
+"""Write-behind queue for Firestore, so that users don't wait on writes."""
+
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from google.api_core.exceptions import (
+    Aborted,
+    DeadlineExceeded,
+    InternalServerError,
+    ResourceExhausted,
+    RetryError,
+    ServiceUnavailable,
+)
+from google.cloud import firestore
+
+logger = logging.getLogger(__name__)
+
+FIRESTORE_FLUSH_INTERVAL = float(os.environ.get("FIRESTORE_FLUSH_INTERVAL", 1.0))
+FIRESTORE_WRITE_RETRIES = int(os.environ.get("FIRESTORE_WRITE_RETRIES", 5))
+# Firestore allows at most 500 writes per batch
+FIRESTORE_BATCH_SIZE = 500
+# Errors of commits that may succeed if retried
+RETRYABLE_ERRORS = (
+    Aborted,
+    DeadlineExceeded,
+    InternalServerError,
+    ResourceExhausted,
+    RetryError,
+    ServiceUnavailable,
+)
+
+
+class Write(NamedTuple):
+    operation: str  # "set" or "update"
+    ref: firestore.DocumentReference
+    data: Dict[str, Any]
+    # Run in the background before the write, e.g. to compress a payload
+    prepare: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None
+    merge: bool = False
+
+
+class FirestoreWriter:
+    """Commits queued writes in batches from a background thread.
+
+    Writes are committed in the order they were queued, at most
+    `flush_interval` seconds after being queued, so a document's `update()`
+    always follows its `set()`. Batches failing with transient errors are
+    retried with exponential backoff, then logged and dropped. If a batch
+    fails otherwise, e.g. on a missing document or an invalid value, its
+    writes are committed one by one so that only the failing ones are
+    dropped. Pending writes are flushed at exit.
+    """
+
+    def __init__(
+        self,
+        client: firestore.Client,
+        flush_interval: float = FIRESTORE_FLUSH_INTERVAL,
+        retries: int = FIRESTORE_WRITE_RETRIES,
+    ):
+        self.client = client
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self._queue: "queue.Queue[Write]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def set(
+        self,
+        ref: firestore.DocumentReference,
+        data: Dict[str, Any],
+        prepare: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
+        merge: bool = False,
+    ) -> None:
+        """Queue `ref.set(data, merge=merge)`."""
+        self._put(Write("set", ref, data, prepare, merge))
+
+    def update(self, ref: firestore.DocumentReference, data: Dict[str, Any]) -> None:
+        """Queue `ref.update(data)`."""
+        self._put(Write("update", ref, data))
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until all queued writes are committed or dropped."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def _put(self, write: Write) -> None:
+        if self._thread is None:
+            self._start()
+        self._queue.put(write)
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="firestore-writer", daemon=True
+            )
+            self._thread.start()
+            atexit.register(self.flush, timeout=10)
+
+    def _run(self) -> None:
+        while True:
+            writes = [self._queue.get()]
+            # Wait for more writes to share the batch, up to the interval
+            deadline = time.monotonic() + self.flush_interval
+            while len(writes) < FIRESTORE_BATCH_SIZE:
+                try:
+                    writes.append(
+                        self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                    )
+                except queue.Empty:
+                    break
+            try:
+                self._commit(writes)
+            except Exception:
+                # Keep the thread alive, or no later write would be committed
+                logger.exception("Failed to commit %d Firestore writes", len(writes))
+            finally:
+                for _ in writes:
+                    self._queue.task_done()
+
+    def _commit(self, writes: List[Write]) -> None:
+        prepared = []
+        for write in writes:
+            data = write.data
+            if write.prepare is not None:
+                try:
+                    data = write.prepare(data)
+                except Exception:
+                    logger.exception("Failed to prepare write to %s", write.ref.path)
+                    continue
+            prepared.append((write, data))
+        if not prepared:
+            return
+
+        start = time.perf_counter()
+        try:
+            self._commit_batch(prepared)
+            committed = len(prepared)
+        except RETRYABLE_ERRORS as e:
+            logger.error(
+                "Dropped %d Firestore writes after %d attempts: %s",
+                len(prepared),
+                self.retries + 1,
+                e,
+            )
+            return
+        except Exception as e:
+            if len(prepared) == 1:
+                logger.error(
+                    "Dropped Firestore write to %s: %s", prepared[0][0].ref.path, e
+                )
+                return
+            logger.warning(
+                "Failed to commit %d Firestore writes, committing them one by one: %s",
+                len(prepared),
+                e,
+            )
+            committed = self._commit_each(prepared)
+        logger.info(
+            "Committed %d Firestore writes in %.2f ms",
+            committed,
+            (time.perf_counter() - start) * 1000,
+        )
+
+    def _commit_batch(self, prepared: List[Tuple[Write, Dict[str, Any]]]) -> None:
+        # Raises the last error if a transient error persists after retries
+        batch = self.client.batch()
+        for write, data in prepared:
+            if write.operation == "set":
+                batch.set(write.ref, data, merge=write.merge)
+            else:
+                batch.update(write.ref, data)
+        for attempt in range(self.retries + 1):
+            try:
+                batch.commit()
+                return
+            except RETRYABLE_ERRORS:
+                if attempt == self.retries:
+                    raise
+                time.sleep(min(2**attempt * 0.5, 30))
+
+    def _commit_each(self, prepared: List[Tuple[Write, Dict[str, Any]]]) -> int:
+        committed = 0
+        for write, data in prepared:
+            try:
+                self._commit_batch([(write, data)])
+                committed += 1
+            except Exception as e:
+                logger.error("Dropped Firestore write to %s: %s", write.ref.path, e)
+        return committed
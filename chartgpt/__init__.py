@@ -1,5 +1,13 @@
-from chartgpt.app import get_agent
-
 __all__ = [
     "get_agent",
 ]
+
+
+def __getattr__(name):
+    # Imported lazily so that worker processes can import chartgpt modules
+    # without initialising the Streamlit app
+    if name == "get_agent":
+        from chartgpt.app import get_agent
+
+        return get_agent
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
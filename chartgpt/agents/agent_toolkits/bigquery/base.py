@@ -1,5 +1,6 @@
-import inspect
+import logging
 import re
+from dataclasses import dataclass
 from typing import Any, Dict, List, Optional
 
 from google.cloud import bigquery
@@ -7,69 +8,82 @@ from langchain.agents.agent import AgentExecutor
 from langchain.callbacks.base import BaseCallbackManager
 from langchain.chains.llm import LLMChain
 from langchain.llms.base import BaseLLM
+from langchain.prompts.prompt import PromptTemplate
 from langchain.schema import BaseMemory
 
-import api.utils as utils
 from config.datasets import Dataset
 from chartgpt.agents.agent_toolkits.bigquery.prompt import PREFIX, SUFFIX
-from chartgpt.agents.agent_toolkits.bigquery.utils import (get_example_query,
-                                                           get_tables_summary)
-from chartgpt.agents.mrkl.base import CustomAgent
+from chartgpt.agents.agent_toolkits.bigquery.schema_retriever import (
+    SCHEMA_WIDE_TABLE_COLUMNS,
+    SchemaRetriever,
+)
+from chartgpt.agents.agent_toolkits.bigquery.utils import (
+    StreamlitDict,
+    fetch_tables_metadata,
+    get_database_schema,
+    get_example_query,
+    get_tables_summary,
+    summarize_wide_tables,
+)
+from chartgpt.agents.mrkl.base import CustomAgent, PromptPrefix, get_prompt_prefix
 from chartgpt.agents.mrkl.output_parser import CustomOutputParser
+from chartgpt.tools.python.namespace import create_namespace
+from chartgpt.tools.python.process_pool import REPL_EXECUTION_BACKEND, process_pool
 from chartgpt.tools.python.tool import PythonAstREPLTool
 
+logger = logging.getLogger(__name__)
 
-def create_bigquery_agent(
+
+@dataclass(frozen=True)
+class BigQueryAgentTemplate:
+    """The parts of a BigQuery agent that can be shared between sessions.
+
+    Building these requires BigQuery metadata requests and prompt rendering,
+    whereas the per-session parts (memory, callbacks, REPL locals) are cheap
+    to attach with `create_bigquery_agent_from_template`. The prompt prefix,
+    which includes the schema, is rendered and counted once per template.
+    """
+
+    llm: BaseLLM
+    prompt: PromptTemplate
+    tables_summary: Dict
+    prompt_prefix: PromptPrefix
+    schema_retriever: SchemaRetriever
+
+
+def query_post_processing(query: str) -> str:
+    # Modules and `display()` are already in the namespace from
+    # `create_namespace()`, so only the agent's code is run and validated
+    query = query.replace("print(", "display(")
+    query = re.sub(".*client =.*\n?", "client = bigquery_client", query)
+    query = re.sub(".*bigquery_client =.*\n?", "", query)
+    return query
+
+
+def create_bigquery_agent_template(
     llm: BaseLLM,
     bigquery_client: bigquery.Client,
     datasets: List[Dataset],
-    callback_manager: Optional[BaseCallbackManager] = None,
     prefix: str = PREFIX,
     suffix: str = SUFFIX,
     input_variables: Optional[List[str]] = None,
-    verbose: bool = False,
-    return_intermediate_steps: bool = False,
-    max_iterations: Optional[int] = 15,
-    max_execution_time: Optional[float] = None,
-    early_stopping_method: str = "force",
-    agent_executor_kwargs: Optional[Dict[str, Any]] = None,
-    memory: Optional[BaseMemory] = None,
-    secure_execution: bool = True,
-    **kwargs: Any,
-) -> AgentExecutor:
-    tables_summary = get_tables_summary(client=bigquery_client, datasets=datasets)
-    example_query = get_example_query(datasets=datasets)
-    python_tool = PythonAstREPLTool(
-        secure_execution=secure_execution,
-        locals={"tables_summary": tables_summary, "bigquery_client": bigquery_client},
+    with_memory: bool = False,
+) -> BigQueryAgentTemplate:
+    # Both the schema and tables summary are built from a single fetch
+    tables_metadata = fetch_tables_metadata(client=bigquery_client, datasets=datasets)
+    tables_summary = get_tables_summary(
+        client=bigquery_client, datasets=datasets, tables_metadata=tables_metadata
     )
-
-    def query_post_processing(query: str) -> str:
-        query = query.replace("print(", "display(")
-        imports = inspect.cleandoc(
-            """
-        import streamlit as st
-        import plotly.express as px
-        import plotly.graph_objects as go
-        import pandas as pd
-        import numpy as np
-
-        pd.set_option('display.max_columns', None)
-        pd.set_option('display.max_rows', 5)
-
-        def display(*args):
-            import streamlit as st
-            st.write(*args)
-            return args
-        """
-        )
-        query = imports + "\n\n" + query
-        query = re.sub(".*client =.*\n?", "client = bigquery_client", query)
-        query = re.sub(".*bigquery_client =.*\n?", "", query)
-        return query
-
-    python_tool.query_post_processing = query_post_processing
-    tools = [python_tool]
+    database_schema = get_database_schema(
+        datasets=datasets,
+        tables_metadata=tables_metadata,
+        wide_table_columns=SCHEMA_WIDE_TABLE_COLUMNS,
+    )
+    # Columns of wide tables are put in the prompt per question instead
+    schema_retriever = SchemaRetriever.from_tables_metadata(
+        datasets=datasets, tables_metadata=tables_metadata
+    )
+    example_query = get_example_query(datasets=datasets)
 
     if input_variables is None:
         input_variables = [
@@ -79,40 +93,85 @@ def create_bigquery_agent(
             "input",
             "agent_scratchpad",
         ]
-    if memory is not None:
+    if with_memory:
         input_variables.append("chat_history")
+    if "{relevant_columns}" in prefix + suffix:
+        input_variables.append("relevant_columns")
 
     prompt = CustomAgent.create_prompt(
-        tools,
+        [PythonAstREPLTool()],
         prefix=prefix,
         suffix=suffix,
         input_variables=input_variables,
     )
 
-    dataset_schemas = []
-    for dataset in datasets:
-        table_id = dataset.tables[0] if dataset.tables else ""
-        schema = utils.get_tables_summary(
-            client=bigquery_client,
-            data_source_url=f"bigquery/{dataset.project}/{dataset.id}/{table_id}",
-        )
-        dataset_schemas.append(schema)
-
-    tables_summary_escaped = "{" + str(dict(tables_summary)) + "}"
+    tables_summary_escaped = (
+        "{"
+        + str(summarize_wide_tables(tables_summary, SCHEMA_WIDE_TABLE_COLUMNS))
+        + "}"
+    )
     partial_prompt = prompt.partial(
-        database_schema="\n\n".join(dataset_schemas),
+        database_schema=database_schema,
         tables_summary=tables_summary_escaped,
         example_query=example_query,
     )
-
-    llm_chain = LLMChain(
+    prompt_prefix = get_prompt_prefix(partial_prompt)
+    logger.info(
+        "Prompt prefix has %d tokens (%s)", prompt_prefix.tokens, prompt_prefix.hash
+    )
+    return BigQueryAgentTemplate(
         llm=llm,
         prompt=partial_prompt,
+        tables_summary=tables_summary,
+        prompt_prefix=prompt_prefix,
+        schema_retriever=schema_retriever,
+    )
+
+
+def create_bigquery_agent_from_template(
+    template: BigQueryAgentTemplate,
+    bigquery_client: bigquery.Client,
+    callback_manager: Optional[BaseCallbackManager] = None,
+    verbose: bool = False,
+    return_intermediate_steps: bool = False,
+    max_iterations: Optional[int] = 15,
+    max_execution_time: Optional[float] = None,
+    early_stopping_method: str = "force",
+    agent_executor_kwargs: Optional[Dict[str, Any]] = None,
+    memory: Optional[BaseMemory] = None,
+    secure_execution: bool = True,
+    **kwargs: Any,
+) -> AgentExecutor:
+    python_tool = PythonAstREPLTool(
+        secure_execution=secure_execution,
+        locals=create_namespace(
+            # Copy so that agent code can't modify the summary of other sessions
+            tables_summary=StreamlitDict(template.tables_summary),
+            bigquery_client=bigquery_client,
+            describe_columns=template.schema_retriever.describe_columns,
+        ),
+    )
+    python_tool.query_post_processing = query_post_processing
+    # Tells the agent when its queries were rewritten to stay within budget
+    python_tool.observation_notices = getattr(bigquery_client, "pop_notices", None)
+    if REPL_EXECUTION_BACKEND == "process":
+        python_tool.backend = process_pool.session(
+            tables_summary=template.tables_summary,
+            bigquery_client=bigquery_client,
+            schema_columns=template.schema_retriever.columns,
+        )
+    tools = [python_tool]
+
+    llm_chain = LLMChain(
+        llm=template.llm,
+        prompt=template.prompt,
     )
     tool_names = [tool.name for tool in tools]
     agent = CustomAgent(
         llm_chain=llm_chain,
         allowed_tools=tool_names,
+        prompt_prefix=template.prompt_prefix,
+        relevant_columns=template.schema_retriever.relevant_columns,
         **kwargs,
     )
     return AgentExecutor.from_agent_and_tools(
@@ -128,3 +187,46 @@ def create_bigquery_agent(
         memory=memory,
         **(agent_executor_kwargs or {}),
     )
+
+
+def create_bigquery_agent(
+    llm: BaseLLM,
+    bigquery_client: bigquery.Client,
+    datasets: List[Dataset],
+    callback_manager: Optional[BaseCallbackManager] = None,
+    prefix: str = PREFIX,
+    suffix: str = SUFFIX,
+    input_variables: Optional[List[str]] = None,
+    verbose: bool = False,
+    return_intermediate_steps: bool = False,
+    max_iterations: Optional[int] = 15,
+    max_execution_time: Optional[float] = None,
+    early_stopping_method: str = "force",
+    agent_executor_kwargs: Optional[Dict[str, Any]] = None,
+    memory: Optional[BaseMemory] = None,
+    secure_execution: bool = True,
+    **kwargs: Any,
+) -> AgentExecutor:
+    template = create_bigquery_agent_template(
+        llm=llm,
+        bigquery_client=bigquery_client,
+        datasets=datasets,
+        prefix=prefix,
+        suffix=suffix,
+        input_variables=input_variables,
+        with_memory=memory is not None,
+    )
+    return create_bigquery_agent_from_template(
+        template,
+        bigquery_client=bigquery_client,
+        callback_manager=callback_manager,
+        verbose=verbose,
+        return_intermediate_steps=return_intermediate_steps,
+        max_iterations=max_iterations,
+        max_execution_time=max_execution_time,
+        early_stopping_method=early_stopping_method,
+        agent_executor_kwargs=agent_executor_kwargs,
+        memory=memory,
+        secure_execution=secure_execution,
+        **kwargs,
+    )
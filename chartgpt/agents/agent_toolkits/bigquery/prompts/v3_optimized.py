@@ -48,6 +48,7 @@ Do not try import or use other libraries.
 - Do NOT make DML statements (INSERT, UPDATE, DELETE, DROP, etc.).
 - Always use `LOWER` when comparing strings to ensure case insensitivity: e.g. `LOWER(column_name) = LOWER('value')`
 - Check column names using: `print(tables_summary[dataset_id][table_id])`
+- For tables with many columns, search for columns using: `print(describe_columns("keywords", table=table_id))`
 - Always prefer performing complex queries using Pandas rather than SQL.
 - Unless displaying Plotly charts and Pandas DataFrames, use `print()` to display output, for example on the last line of code.
 - When performing EDA, always try check correlation and create statistical plots.
@@ -55,6 +56,7 @@ Do not try import or use other libraries.
 
 Begin!
 
+{relevant_columns}
 Chat History: {chat_history}
 
 Question: {input}
@@ -0,0 +1,221 @@
+"""Process-wide cache of BigQuery table metadata used to build agent prompts."""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from google.cloud import bigquery
+from google.cloud.bigquery.retry import DEFAULT_RETRY
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_CACHE_TTL = float(os.environ.get("SCHEMA_CACHE_TTL", 3600))  # seconds
+SCHEMA_CACHE_SNAPSHOT_PATH = os.environ.get("SCHEMA_CACHE_SNAPSHOT_PATH", None)
+
+# Incremented when TableMetadata changes so that older snapshots are ignored
+SNAPSHOT_VERSION = 2
+
+
+@dataclass
+class TableMetadata:
+    """Subset of `bigquery.Table` needed for the agent prompt."""
+
+    table_id: str
+    etag: Optional[str] = None
+    modified: Optional[int] = None  # milliseconds since epoch
+    description: Optional[str] = None
+    # (name, field_type, description) for each top-level column
+    fields: List[Tuple[str, str, str]] = field(default_factory=list)
+    # Time partitioning type (DAY, HOUR, MONTH or YEAR) and column, where a
+    # partition_type without a partition_field means ingestion-time partitioning
+    partition_type: Optional[str] = None
+    partition_field: Optional[str] = None
+    fetched_at: float = 0.0
+
+    @classmethod
+    def from_table(cls, table: bigquery.Table) -> "TableMetadata":
+        return cls(
+            table_id=f"{table.project}.{table.dataset_id}.{table.table_id}",
+            etag=table.etag,
+            modified=(
+                round(table.modified.timestamp() * 1000) if table.modified else None
+            ),
+            description=table.description,
+            fields=[
+                (
+                    schema_field.name,
+                    schema_field.field_type,
+                    schema_field.description or "",
+                )
+                for schema_field in table.schema
+            ],
+            partition_type=(
+                table.time_partitioning.type_ if table.time_partitioning else None
+            ),
+            partition_field=(
+                table.time_partitioning.field if table.time_partitioning else None
+            ),
+            fetched_at=time.time(),
+        )
+
+    @classmethod
+    def from_dict(cls, value: dict) -> "TableMetadata":
+        value = dict(value)
+        value["fields"] = [tuple(schema_field) for schema_field in value["fields"]]
+        return cls(**value)
+
+
+class SchemaCache:
+    """Table metadata keyed by `project.dataset.table`.
+
+    Entries younger than `ttl` seconds are served without a network call.
+    Older entries are revalidated with a partial `tables.get` request that only
+    returns the table's `etag` and `lastModifiedTime`, and the full table is
+    fetched only if either has changed. If `snapshot_path` is set, the cache is
+    loaded from a JSON file so a cold process starts warm, and persisted to it
+    by `save_snapshot_if_changed()`.
+    """
+
+    def __init__(
+        self, ttl: float = SCHEMA_CACHE_TTL, snapshot_path: Optional[str] = None
+    ):
+        self.ttl = ttl
+        self.snapshot_path = snapshot_path
+        self._entries: Dict[str, TableMetadata] = {}
+        self._counters: Counter = Counter()
+        # Whether tables were fetched since the snapshot was last saved
+        self._changed = False
+        self._lock = threading.Lock()
+        if snapshot_path:
+            self.load_snapshot()
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """Counters of `hits`, `misses`, `revalidations` and `invalidations`."""
+        with self._lock:
+            return {
+                "hits": self._counters["hits"],
+                "misses": self._counters["misses"],
+                "revalidations": self._counters["revalidations"],
+                "invalidations": self._counters["invalidations"],
+                "entries": len(self._entries),
+            }
+
+    def get_table(
+        self,
+        client: bigquery.Client,
+        table_id: str,
+        timeout: Optional[float] = None,
+        max_age: Optional[float] = None,
+    ) -> TableMetadata:
+        """Return metadata for `table_id`, fetching it only when stale or changed.
+
+        `max_age` overrides the cache TTL for callers that need fresher
+        metadata, e.g. a table's last modified time.
+        """
+        with self._lock:
+            entry = self._entries.get(table_id)
+        now = time.time()
+        max_age = self.ttl if max_age is None else max_age
+        if entry and now - entry.fetched_at < max_age:
+            self._count("hits")
+            return entry
+
+        if entry:
+            try:
+                etag, modified = self._fetch_version(client, table_id, timeout)
+            except Exception:
+                logger.exception("Failed to revalidate schema for %s", table_id)
+            else:
+                if etag == entry.etag and modified == entry.modified:
+                    entry.fetched_at = now
+                    self._count("revalidations")
+                    return entry
+                self._count("invalidations")
+
+        self._count("misses")
+        table = client.get_table(table_id, timeout=timeout)
+        entry = TableMetadata.from_table(table)
+        with self._lock:
+            self._entries[table_id] = entry
+            self._changed = True
+        return entry
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._counters.clear()
+
+    def load_snapshot(self) -> None:
+        try:
+            with open(self.snapshot_path, "r") as f:
+                snapshot = json.load(f)
+            if snapshot.get("version") != SNAPSHOT_VERSION:
+                logger.info("Ignoring outdated schema cache snapshot")
+                return
+            entries = {
+                table_id: TableMetadata.from_dict(value)
+                for table_id, value in snapshot["tables"].items()
+            }
+        except FileNotFoundError:
+            return
+        except (AttributeError, ValueError, TypeError, KeyError):
+            logger.exception(
+                "Ignoring invalid schema cache snapshot %s", self.snapshot_path
+            )
+            return
+        with self._lock:
+            self._entries.update(entries)
+        logger.info("Loaded %d tables from schema cache snapshot", len(entries))
+
+    def save_snapshot_if_changed(self) -> None:
+        """Persist the cache, once after fetching many tables rather than per table."""
+        if self.snapshot_path and self._changed:
+            self.save_snapshot()
+
+    def save_snapshot(self) -> None:
+        with self._lock:
+            self._changed = False
+            snapshot = {
+                "version": SNAPSHOT_VERSION,
+                "tables": {
+                    table_id: asdict(entry) for table_id, entry in self._entries.items()
+                },
+            }
+        directory = os.path.dirname(os.path.abspath(self.snapshot_path))
+        os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file first so readers never see a partial snapshot
+        with tempfile.NamedTemporaryFile("w", dir=directory, delete=False) as f:
+            json.dump(snapshot, f)
+        os.replace(f.name, self.snapshot_path)
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            self._counters[counter] += 1
+
+    @staticmethod
+    def _fetch_version(
+        client: bigquery.Client, table_id: str, timeout: Optional[float] = None
+    ) -> Tuple[Optional[str], Optional[int]]:
+        project, dataset_id, table_name = table_id.split(".")
+        response = client._call_api(
+            DEFAULT_RETRY,
+            method="GET",
+            path=f"/projects/{project}/datasets/{dataset_id}/tables/{table_name}",
+            query_params={"fields": "etag,lastModifiedTime"},
+            timeout=timeout,
+        )
+        modified = response.get("lastModifiedTime")
+        return response.get("etag"), int(modified) if modified else None
+
+
+schema_cache = SchemaCache(
+    ttl=SCHEMA_CACHE_TTL,
+    snapshot_path=SCHEMA_CACHE_SNAPSHOT_PATH,
+)
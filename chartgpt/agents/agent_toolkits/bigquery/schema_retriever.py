@@ -0,0 +1,188 @@
+"""Local search over the columns of wide tables, to keep the prompt small.
+
+Tables with more than `SCHEMA_WIDE_TABLE_COLUMNS` columns aren't listed in
+full in the prompt. Instead, the columns most relevant to each question are
+retrieved with BM25 over column names and descriptions, and agent code can
+search for others with `describe_columns()`.
+"""
+
+import logging
+import math
+import os
+import re
+from collections import Counter, defaultdict
+from functools import lru_cache
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+import pandas as pd
+
+from chartgpt.agents.agent_toolkits.bigquery.schema_cache import TableMetadata
+from config.datasets import Dataset
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_WIDE_TABLE_COLUMNS = int(os.environ.get("SCHEMA_WIDE_TABLE_COLUMNS", 50))
+SCHEMA_RELEVANT_COLUMNS = int(os.environ.get("SCHEMA_RELEVANT_COLUMNS", 20))
+
+# Okapi BM25 parameters
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_CAMEL_CASE = re.compile(r"([a-z0-9])([A-Z])")
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+class ColumnDocument(NamedTuple):
+    """A column of a table, as indexed by `SchemaRetriever`."""
+
+    table_id: str  # project.dataset.table
+    name: str
+    field_type: str
+    description: str
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text and snake_case or camelCase names into lowercase terms."""
+    terms = _TOKEN.findall(_CAMEL_CASE.sub(r"\1 \2", text).lower())
+    # Crude plural stemming, so that "loans" matches "loan_id"
+    return [
+        term[:-1] if len(term) > 3 and term.endswith("s") else term for term in terms
+    ]
+
+
+class SchemaRetriever:
+    """BM25 index of the columns of wide tables.
+
+    Built once per agent template, and cheap enough to rebuild from its
+    `columns` in worker processes. Column names count twice, as they are
+    shorter than descriptions and usually what the question refers to.
+    """
+
+    def __init__(self, columns: Sequence[ColumnDocument]):
+        self.columns = [ColumnDocument(*column) for column in columns]
+        self._postings: Dict[str, List[tuple]] = defaultdict(list)
+        self._lengths: List[int] = []
+        for index, column in enumerate(self.columns):
+            terms = tokenize(column.name) * 2 + tokenize(column.description)
+            self._lengths.append(len(terms))
+            for term, frequency in Counter(terms).items():
+                self._postings[term].append((index, frequency))
+        self._average_length = (
+            sum(self._lengths) / len(self._lengths) if self._lengths else 1.0
+        )
+        # Memoized per question, so every step of a question has the same prompt
+        self.relevant_columns = lru_cache(maxsize=256)(self._relevant_columns)
+
+    @classmethod
+    def from_tables_metadata(
+        cls,
+        datasets: List[Dataset],
+        tables_metadata: Dict[str, TableMetadata],
+        wide_table_columns: int = SCHEMA_WIDE_TABLE_COLUMNS,
+    ) -> "SchemaRetriever":
+        columns = []
+        for dataset in datasets:
+            prefix = f"{dataset.project}.{dataset.id}."
+            for full_table_id, table in sorted(tables_metadata.items()):
+                if not full_table_id.startswith(prefix):
+                    continue
+                if len(table.fields) <= wide_table_columns:
+                    continue
+                columns.extend(
+                    ColumnDocument(
+                        full_table_id,
+                        name,
+                        field_type,
+                        dataset.column_descriptions.get(name) or description,
+                    )
+                    for name, field_type, description in table.fields
+                )
+        return cls(columns)
+
+    def search(
+        self, query: str, k: int = SCHEMA_RELEVANT_COLUMNS, table: Optional[str] = None
+    ) -> List[ColumnDocument]:
+        """Return up to `k` columns matching a query, best first.
+
+        Args:
+            query: Question or keywords to match column names and descriptions.
+            k: Maximum number of columns to return.
+            table: Only search columns of tables whose ID ends with this.
+        """
+        scores: Dict[int, float] = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(
+                1 + (len(self.columns) - len(postings) + 0.5) / (len(postings) + 0.5)
+            )
+            for index, frequency in postings:
+                length_norm = (
+                    1 - BM25_B + BM25_B * (self._lengths[index] / self._average_length)
+                )
+                scores[index] += (
+                    idf
+                    * frequency
+                    * (BM25_K1 + 1)
+                    / (frequency + BM25_K1 * length_norm)
+                )
+        ranked = sorted(scores, key=lambda index: (-scores[index], index))
+        if table:
+            ranked = [
+                index
+                for index in ranked
+                if self.columns[index].table_id.endswith(table)
+            ]
+        return [self.columns[index] for index in ranked[:k]]
+
+    def _relevant_columns(self, question: str) -> str:
+        if not self.columns:
+            return ""
+        columns = self.search(question)
+        if not columns:
+            return ""
+        by_table: Dict[str, List[ColumnDocument]] = defaultdict(list)
+        for column in columns:
+            by_table[column.table_id].append(column)
+        tables = "\n\n".join(
+            f"Table: `{table_id}`\n"
+            + "\n".join(
+                f"- {column.name} ({column.field_type}): {column.description}"
+                for column in table_columns
+            )
+            for table_id, table_columns in by_table.items()
+        )
+        logger.info("Retrieved %d relevant columns for the question", len(columns))
+        return (
+            "# Relevant Columns\n"
+            "Columns of wide tables most relevant to the question:\n\n"
+            f"{tables}\n"
+        )
+
+    def describe_columns(
+        self, search: str = "", table: Optional[str] = None, k: int = 50
+    ) -> pd.DataFrame:
+        """Find columns of wide tables, for use in agent code.
+
+        Args:
+            search: Keywords to match column names and descriptions. All
+                columns are returned, up to `k`, if empty.
+            table: Only include columns of tables whose ID ends with this.
+            k: Maximum number of columns to return.
+        """
+        if search:
+            columns = self.search(search, k=k, table=table)
+        else:
+            columns = [
+                column
+                for column in self.columns
+                if not table or column.table_id.endswith(table)
+            ][:k]
+        return pd.DataFrame(
+            [
+                (column.table_id, column.name, column.field_type, column.description)
+                for column in columns
+            ],
+            columns=["table", "column", "type", "description"],
+        )
@@ -1,26 +1,36 @@
 import inspect
-from typing import Dict, List, Tuple, Union
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Tuple, Union
 
 import pandas as pd
 from google.api_core.exceptions import InternalServerError
 from google.cloud import bigquery
 
-from app import logger
+from chartgpt.agents.agent_toolkits.bigquery.schema_cache import (
+    TableMetadata,
+    schema_cache,
+)
+from chartgpt.display import get_display_registry
 from config.datasets import Dataset
 
+logger = logging.getLogger(__name__)
+
+SCHEMA_FETCH_MAX_WORKERS = int(os.environ.get("SCHEMA_FETCH_MAX_WORKERS", 8))
+SCHEMA_FETCH_TIMEOUT = float(os.environ.get("SCHEMA_FETCH_TIMEOUT", 30))  # seconds
+
 
 class StreamlitDict(dict):
     def __repr__(self):
         import streamlit as st
 
-        df_id = id(self)
-        if not df_id in st.session_state:
+        if get_display_registry().mark(self):
             st.session_state["container"].dataframe(self)
             st.session_state["text"] = "\n\n"
             st.session_state["empty_container"] = st.session_state["container"].empty()
-            st.session_state[df_id] = 1
             st.write(self)
-            st.session_state[df_id] = 1
         return dict.__repr__(self)
 
 
@@ -37,36 +47,174 @@ def get_table_ids(client: bigquery.Client) -> List[str]:
     ]
 
 
+def get_dataset_table_ids(
+    client: bigquery.Client, dataset: Dataset, timeout: Optional[float] = None
+) -> List[str]:
+    """Tables configured for the dataset, or all its tables if none are."""
+    if dataset.tables:
+        return dataset.tables
+    return [
+        table.table_id
+        for table in client.list_tables(
+            f"{dataset.project}.{dataset.id}", timeout=timeout
+        )
+    ]
+
+
+def fetch_tables_metadata(
+    client: bigquery.Client,
+    datasets: List[Dataset],
+    max_workers: int = SCHEMA_FETCH_MAX_WORKERS,
+    timeout: float = SCHEMA_FETCH_TIMEOUT,
+) -> Dict[str, TableMetadata]:
+    """Fetch metadata for all tables in datasets concurrently.
+
+    Tables are keyed by `project.dataset.table`. Tables that fail or don't
+    complete within `timeout` seconds are logged and left out, so that one
+    slow or missing table doesn't prevent the agent from being created.
+    """
+    start = time.perf_counter()
+    table_ids = []
+    for dataset in datasets:
+        try:
+            dataset_table_ids = get_dataset_table_ids(client, dataset, timeout)
+        except Exception:
+            logger.exception("Failed to list tables for dataset %s", dataset.id)
+            continue
+        table_ids.extend(
+            f"{dataset.project}.{dataset.id}.{table_id}"
+            for table_id in dataset_table_ids
+        )
+    if not table_ids:
+        return {}
+
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(table_ids)))
+    futures = {
+        executor.submit(schema_cache.get_table, client, table_id, timeout): table_id
+        for table_id in table_ids
+    }
+    _, not_done = wait(futures, timeout=timeout)
+    # Don't block on stragglers, they are left to finish in the background
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    # Kept in the order tables were listed, not the order they completed in
+    tables_metadata = {}
+    for future, table_id in futures.items():
+        if future in not_done:
+            logger.error("Timed out fetching schema for table %s", table_id)
+            continue
+        try:
+            tables_metadata[table_id] = future.result()
+        except Exception:
+            logger.exception("Failed to fetch schema for table %s", table_id)
+    # Once for all tables, as each save writes the whole cache
+    try:
+        schema_cache.save_snapshot_if_changed()
+    except OSError:
+        logger.exception("Failed to save schema cache snapshot")
+
+    logger.info(
+        "Fetched %d of %d table schemas in %.2f s, schema cache stats: %s",
+        len(tables_metadata),
+        len(table_ids),
+        time.perf_counter() - start,
+        schema_cache.stats,
+    )
+    return tables_metadata
+
+
 def get_tables_summary(
-    client: bigquery.Client, datasets: List[Dataset], include_types=False
+    client: bigquery.Client,
+    datasets: List[Dataset],
+    include_types=False,
+    tables_metadata: Optional[Dict[str, TableMetadata]] = None,
 ) -> Dict[str, List[Dict[str, List[Union[Tuple[str, str], str]]]]]:
     # Generate tables_summary for all tables in datasets
+    if tables_metadata is None:
+        tables_metadata = fetch_tables_metadata(client=client, datasets=datasets)
     tables_summary = StreamlitDict()
     for dataset in datasets:
         dataset_id = dataset.id
-        project = dataset.project
+        prefix = f"{dataset.project}.{dataset_id}."
         tables_summary[dataset_id] = {}
-        for table_id in dataset.tables:
-            table_ref = client.dataset(dataset_id, project=project).table(table_id)
-            table = client.get_table(table_ref)
+        for full_table_id, table in sorted(tables_metadata.items()):
+            if not full_table_id.startswith(prefix):
+                continue
+            table_id = full_table_id[len(prefix) :]
             tables_summary[dataset_id][table_id] = [
                 (
-                    schema_field.name,
-                    schema_field.field_type,
-                    "Description: "
-                    + dataset.column_descriptions.get(schema_field.name, ""),
+                    name,
+                    field_type,
+                    "Description: " + dataset.column_descriptions.get(name, ""),
                 )
                 if include_types
                 else (
-                    schema_field.name,
-                    "Description: "
-                    + dataset.column_descriptions.get(schema_field.name, ""),
+                    name,
+                    "Description: " + dataset.column_descriptions.get(name, ""),
                 )
-                for schema_field in table.schema
+                for name, field_type, _ in table.fields
             ]
     return tables_summary
 
 
+def get_database_schema(
+    datasets: List[Dataset],
+    tables_metadata: Dict[str, TableMetadata],
+    wide_table_columns: Optional[int] = None,
+) -> str:
+    # Generate a description of every table and column in datasets. Columns
+    # of tables wider than `wide_table_columns` are retrieved per question.
+    dataset_schemas = []
+    for dataset in datasets:
+        prefix = f"{dataset.project}.{dataset.id}."
+        table_schemas = []
+        for full_table_id, table in sorted(tables_metadata.items()):
+            if not full_table_id.startswith(prefix):
+                continue
+            if wide_table_columns is not None and (
+                len(table.fields) > wide_table_columns
+            ):
+                columns = (
+                    f"{len(table.fields)} columns, the most relevant to the "
+                    "question are listed under Relevant Columns. Search for "
+                    "others using `describe_columns()`."
+                )
+            else:
+                columns = "\n".join(
+                    f"- {name} ({field_type}): "
+                    + (dataset.column_descriptions.get(name) or description)
+                    for name, field_type, description in table.fields
+                )
+            table_schemas.append(
+                f"Table: `{full_table_id}`\n"
+                f"Description: {table.description or ''}\n"
+                f"Columns:\n{columns}"
+            )
+        dataset_schemas.append(
+            f"Dataset: `{dataset.project}.{dataset.id}`\n\n"
+            + "\n\n".join(table_schemas)
+        )
+    return "\n\n".join(dataset_schemas)
+
+
+def summarize_wide_tables(tables_summary: Dict, wide_table_columns: int) -> Dict:
+    """Replace the columns of wide tables in a tables summary with their count.
+
+    Used for the summary in the prompt, while agent code has the full one.
+    """
+    return {
+        dataset_id: {
+            table_id: (
+                columns
+                if len(columns) <= wide_table_columns
+                else f"{len(columns)} columns, see describe_columns()"
+            )
+            for table_id, columns in tables.items()
+        }
+        for dataset_id, tables in tables_summary.items()
+    }
+
+
 def get_example_query(
     datasets: List[Dataset],
 ) -> str:
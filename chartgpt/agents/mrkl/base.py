@@ -1,23 +1,74 @@
+import asyncio
+import hashlib
 import logging
-from typing import Dict, List, Optional, Sequence, Tuple, Union
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 from langchain.agents.agent import AgentOutputParser
+from langchain.callbacks.manager import Callbacks
 from langchain.agents.mrkl.base import ZeroShotAgent
 from langchain.prompts.few_shot import FewShotPromptTemplate
 from langchain.prompts.prompt import PromptTemplate
-from langchain.schema import AgentAction, BaseMessage
+from langchain.schema import AgentAction, AgentFinish, BaseMessage
 from langchain.tools.base import BaseTool
-from pydantic import Field, root_validator
+from pydantic import Field, PrivateAttr, root_validator
 
 from chartgpt.agents.agent_toolkits.bigquery.prompt import PREFIX, SUFFIX
 from chartgpt.agents.mrkl.output_parser import CustomOutputParser
 from chartgpt.agents.mrkl.prompt import FORMAT_INSTRUCTIONS
+from chartgpt.agents.mrkl.scratchpad import Scratchpad
+from chartgpt.tokens import count_tokens
 
 logger = logging.getLogger(__name__)
 
 
+class PromptPrefix(NamedTuple):
+    """The start of a prompt that is the same for every LLM call of an agent.
+
+    Sent unchanged before the chat history, question and scratchpad, so that
+    it can be served from the provider's prompt cache where available.
+    """
+
+    text: str
+    tokens: int
+    hash: str
+
+
+def get_prompt_prefix(prompt: PromptTemplate) -> PromptPrefix:
+    """Render and count the tokens of a prompt up to its first variable.
+
+    Partial variables such as the database schema are part of the prefix.
+    """
+    markers = {variable: f"\x00{variable}\x00" for variable in prompt.input_variables}
+    rendered = prompt.format(**markers)
+    end = min(
+        (rendered.find(marker) for marker in markers.values() if marker in rendered),
+        default=len(rendered),
+    )
+    text = rendered[:end]
+    return PromptPrefix(
+        text=text,
+        tokens=count_tokens(text),
+        hash=hashlib.sha256(text.encode()).hexdigest()[:16],
+    )
+
+
 class CustomAgent(ZeroShotAgent):
     output_parser: AgentOutputParser = Field(default_factory=CustomOutputParser)
+    prompt_prefix: Optional[PromptPrefix] = None
+    # Returns the columns relevant to a question, for the `relevant_columns`
+    # prompt variable, which is provided by the agent rather than the caller
+    relevant_columns: Optional[Callable[[str], str]] = None
+    _scratchpad: Optional[Scratchpad] = PrivateAttr(default=None)
 
     @property
     def observation_prefix(self) -> str:
@@ -78,19 +129,76 @@ class CustomAgent(ZeroShotAgent):
                 raise ValueError(f"Got unexpected prompt type {type(prompt)}")
         return values
 
+    @property
+    def input_keys(self) -> List[str]:
+        """Return the input keys, excluding those provided by the agent."""
+        return list(
+            set(self.llm_chain.input_keys) - {"agent_scratchpad", "relevant_columns"}
+        )
+
+    def get_full_inputs(
+        self, intermediate_steps: List[Tuple[AgentAction, str]], **kwargs: Any
+    ) -> Dict[str, Any]:
+        """Create the full inputs for the LLMChain from intermediate steps."""
+        return super().get_full_inputs(
+            intermediate_steps, **self._add_relevant_columns(kwargs)
+        )
+
+    async def aplan(
+        self,
+        intermediate_steps: List[Tuple[AgentAction, str]],
+        callbacks: Callbacks = None,
+        **kwargs: Any,
+    ) -> Union[AgentAction, AgentFinish]:
+        """Like `plan()`, but parses the output in a thread.
+
+        The output parser writes to `st.session_state`, which is only
+        available in threads attached to the session, not in the event loop.
+        """
+        full_inputs = self.get_full_inputs(intermediate_steps, **kwargs)
+        full_output = await self.llm_chain.apredict(callbacks=callbacks, **full_inputs)
+        return await asyncio.to_thread(self.output_parser.parse, full_output)
+
+    def return_stopped_response(
+        self,
+        early_stopping_method: str,
+        intermediate_steps: List[Tuple[AgentAction, str]],
+        **kwargs: Any,
+    ):
+        """Return response when agent has been stopped due to max iterations."""
+        return super().return_stopped_response(
+            early_stopping_method,
+            intermediate_steps,
+            **self._add_relevant_columns(kwargs),
+        )
+
+    def _add_relevant_columns(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        if "relevant_columns" not in self.llm_chain.prompt.input_variables:
+            return inputs
+        relevant_columns = ""
+        if self.relevant_columns is not None:
+            relevant_columns = self.relevant_columns(inputs["input"])
+        return {**inputs, "relevant_columns": relevant_columns}
+
+    @property
+    def scratchpad_tokens(self) -> int:
+        """Size in tokens of the scratchpad of the current question."""
+        return self._scratchpad.tokens if self._scratchpad else 0
+
+    @property
+    def prompt_prefix_tokens_reused(self) -> int:
+        """Tokens of the prompt prefix sent again unchanged for this question.
+
+        Every LLM call after the first one of a question repeats the prefix.
+        """
+        if self.prompt_prefix is None or self._scratchpad is None:
+            return 0
+        return self.prompt_prefix.tokens * self._scratchpad.steps
+
     def _construct_scratchpad(
         self, intermediate_steps: List[Tuple[AgentAction, str]]
     ) -> Union[str, List[BaseMessage]]:
         """Construct the scratchpad that lets the agent continue its thought process."""
-        thoughts = ""
-        for action, observation in intermediate_steps:
-            character_limit = 1000
-            if len(str(observation)) > character_limit:
-                observation = str(observation)[:character_limit]
-            thoughts += action.log
-            thoughts += f"\n{self.observation_prefix}{observation}\n{self.llm_prefix}"
-        logger.info(
-            f"===================== scratchpad start =====================\n{thoughts}"
-        )
-        logger.info("===================== scratchpad end =====================")
-        return thoughts
+        if self._scratchpad is None:
+            self._scratchpad = Scratchpad(self.observation_prefix, self.llm_prefix)
+        return self._scratchpad.update(intermediate_steps)
@@ -7,7 +7,7 @@ FORMAT_INSTRUCTIONS = """
 Always start your response with an appropriate prefix from the following list: [Thought, Action Input, Observation]
 Never respond without an Action Input.
 
-Question: {input}
+Question: <the input question to answer>
 Thought: <consider what to do>
 Action Input:
 ```python
@@ -0,0 +1,153 @@
+"""Scratchpad of the agent's previous steps, built incrementally."""
+
+import logging
+import os
+from typing import Any, List, Sequence, Tuple
+
+import pandas as pd
+from langchain.schema import AgentAction
+
+from chartgpt.data.preview import to_text
+from chartgpt.tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Tokens of the scratchpad above which older observations are compacted
+SCRATCHPAD_TOKEN_BUDGET = int(os.environ.get("SCRATCHPAD_TOKEN_BUDGET", 2000))
+# Characters of an observation shown in full, and once compacted
+OBSERVATION_CHARACTER_LIMIT = 1000
+COMPACT_OBSERVATION_CHARACTER_LIMIT = 200
+
+
+def head_tail(text: str, limit: int) -> str:
+    """Shorten a text to about `limit` characters, keeping its start and end."""
+    if len(text) <= limit:
+        return text
+    head = text[: limit // 2]
+    tail = text[len(text) - limit // 2 :]
+    omitted = len(text) - len(head) - len(tail)
+    return f"{head}\n[... {omitted} characters omitted ...]\n{tail}"
+
+
+def summarize_observation(observation: Any) -> str:
+    """Summarize an observation, describing DataFrames by their schema only."""
+    if isinstance(observation, pd.DataFrame):
+        columns = ", ".join(
+            f"{name} ({dtype})" for name, dtype in observation.dtypes.items()
+        )
+        summary = (
+            f"DataFrame with {len(observation)} rows and "
+            f"{len(observation.columns)} columns: {columns}"
+        )
+    elif isinstance(observation, pd.Series):
+        summary = (
+            f"Series {observation.name} with {len(observation)} rows "
+            f"({observation.dtype})"
+        )
+    elif isinstance(observation, (list, tuple)) and any(
+        isinstance(item, (pd.DataFrame, pd.Series)) for item in observation
+    ):
+        # E.g. the arguments returned by `display()`
+        return "\n".join(summarize_observation(item) for item in observation)
+    else:
+        summary = str(observation)
+    return head_tail(summary, COMPACT_OBSERVATION_CHARACTER_LIMIT)
+
+
+class _Entry:
+    __slots__ = ("step", "text", "tokens", "compacted")
+
+    def __init__(self, step: Tuple[AgentAction, Any], text: str):
+        self.step = step
+        self.text = text
+        self.tokens = count_tokens(text)
+        self.compacted = False
+
+
+class Scratchpad:
+    """Text of the agent's previous steps, updated as steps are added.
+
+    Only new steps are rendered and counted on each iteration, instead of
+    the whole history. When the scratchpad exceeds its token budget, the
+    observations of older steps are compacted, oldest first, to a summary:
+    the schema of DataFrames, or the start and end of long text. The most
+    recent steps are always kept in full.
+    """
+
+    def __init__(
+        self,
+        observation_prefix: str,
+        llm_prefix: str,
+        token_budget: int = SCRATCHPAD_TOKEN_BUDGET,
+        keep_recent: int = 1,
+    ):
+        self.observation_prefix = observation_prefix
+        self.llm_prefix = llm_prefix
+        self.token_budget = token_budget
+        self.keep_recent = keep_recent
+        self._entries: List[_Entry] = []
+        self._text = ""
+        self.tokens = 0
+
+    @property
+    def steps(self) -> int:
+        """Number of steps in the scratchpad."""
+        return len(self._entries)
+
+    def update(self, intermediate_steps: Sequence[Tuple[AgentAction, Any]]) -> str:
+        """Return the scratchpad for the steps, adding those not seen before."""
+        if not self._extends(intermediate_steps):
+            # Steps of a new question
+            self._entries = []
+            self._text = ""
+            self.tokens = 0
+        new_steps = intermediate_steps[len(self._entries) :]
+        for action, observation in new_steps:
+            entry = _Entry(
+                (action, observation),
+                self._render(
+                    action,
+                    head_tail(to_text(observation), OBSERVATION_CHARACTER_LIMIT),
+                ),
+            )
+            self._entries.append(entry)
+            self._text += entry.text
+            self.tokens += entry.tokens
+        if new_steps and self.tokens > self.token_budget:
+            self._compact()
+        if new_steps:
+            logger.info(
+                "Scratchpad has %d tokens over %d steps (%d compacted)",
+                self.tokens,
+                len(self._entries),
+                sum(entry.compacted for entry in self._entries),
+            )
+        return self._text
+
+    def _extends(self, intermediate_steps: Sequence[Tuple[AgentAction, Any]]) -> bool:
+        return len(intermediate_steps) >= len(self._entries) and all(
+            entry.step is step for entry, step in zip(self._entries, intermediate_steps)
+        )
+
+    def _render(self, action: AgentAction, observation: str) -> str:
+        return (
+            f"{action.log}\n{self.observation_prefix}{observation}\n{self.llm_prefix}"
+        )
+
+    def _compact(self) -> None:
+        compacted = False
+        for entry in self._entries[: -self.keep_recent or None]:
+            if self.tokens <= self.token_budget:
+                break
+            if entry.compacted:
+                continue
+            action, observation = entry.step
+            text = self._render(action, summarize_observation(observation))
+            tokens = count_tokens(text)
+            entry.compacted = True
+            if tokens < entry.tokens:
+                self.tokens += tokens - entry.tokens
+                entry.text, entry.tokens = text, tokens
+                compacted = True
+        if compacted:
+            self._text = "".join(entry.text for entry in self._entries)
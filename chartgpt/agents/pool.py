@@ -0,0 +1,66 @@
+"""Bounded LRU pool of agent templates shared between Streamlit sessions."""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable
+
+from chartgpt.agents.agent_toolkits.bigquery.base import BigQueryAgentTemplate
+
+logger = logging.getLogger(__name__)
+
+
+class AgentTemplatePool:
+    """Memoize agent templates by key, evicting the least recently used.
+
+    Concurrent requests for the same missing key may both build the template;
+    the last one to finish is kept. This avoids holding the lock while
+    BigQuery metadata is fetched.
+    """
+
+    def __init__(self, max_size: int = 8):
+        self.max_size = max_size
+        self._templates: "OrderedDict[Hashable, BigQueryAgentTemplate]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._metrics = {
+            "builds": 0,
+            "reuses": 0,
+            "evictions": 0,
+            "build_seconds": 0.0,
+        }
+
+    @property
+    def metrics(self) -> Dict[str, float]:
+        """Number of builds and reuses, and the total time spent building."""
+        with self._lock:
+            return {**self._metrics, "size": len(self._templates)}
+
+    def get(
+        self, key: Hashable, build: Callable[[], BigQueryAgentTemplate]
+    ) -> BigQueryAgentTemplate:
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+                self._metrics["reuses"] += 1
+                return template
+
+        start = time.perf_counter()
+        template = build()
+        build_seconds = time.perf_counter() - start
+        logger.info("Built agent template %s in %.2f s", key, build_seconds)
+
+        with self._lock:
+            self._metrics["builds"] += 1
+            self._metrics["build_seconds"] += build_seconds
+            self._templates[key] = template
+            self._templates.move_to_end(key)
+            while len(self._templates) > self.max_size:
+                self._templates.popitem(last=False)
+                self._metrics["evictions"] += 1
+        return template
+
+    def clear(self) -> None:
+        with self._lock:
+            self._templates.clear()
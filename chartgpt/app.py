@@ -1,36 +1,72 @@
+import asyncio
 import os
-from typing import List, Optional
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import Context, ContextVar, copy_context
+from typing import Dict, List, Optional
 
+from google.cloud import bigquery
 from langchain.callbacks.manager import CallbackManager
 from langchain.chat_models import ChatOpenAI
 from langchain.memory import ConversationBufferMemory
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
-from api.connectors.bigquery import bigquery_client
+from api.connectors.bigquery import bigquery_client as default_bigquery_client
 from config.datasets import Dataset
-from chartgpt.agents.agent_toolkits import create_bigquery_agent
-from chartgpt.callback_handler import CustomCallbackHandler
+from chartgpt.agents.agent_toolkits.bigquery.base import (
+    create_bigquery_agent_from_template,
+    create_bigquery_agent_template,
+)
+from chartgpt.agents.pool import AgentTemplatePool
+from chartgpt.callback_handler import CustomCallbackHandler, TracingCallbackHandler
 
 OPENAI_MODEL = os.environ.get("OPENAI_MODEL", "gpt-3.5-turbo")
+AGENT_POOL_SIZE = int(os.environ.get("AGENT_POOL_SIZE", 8))
+# Threads running agent code and synchronous callbacks, shared by all sessions
+AGENT_THREADS = int(os.environ.get("AGENT_THREADS", 32))
 
-callback_manager = CallbackManager([CustomCallbackHandler()])
+callback_manager = CallbackManager([CustomCallbackHandler(), TracingCallbackHandler()])
+agent_pool = AgentTemplatePool(max_size=AGENT_POOL_SIZE)
 
 
 def get_agent(
     secure_execution: bool = True,
     temperature: float = 0.0,
     datasets: Optional[List[Dataset]] = None,
-    callbacks: Optional[List] = None,
+    bigquery_client: Optional[bigquery.Client] = None,
 ):
-    return create_bigquery_agent(
-        ChatOpenAI(
-            model_name=OPENAI_MODEL,
-            streaming=True,
-            temperature=temperature,
-            request_timeout=180,
-            callbacks=callbacks,
+    """Create an agent for a session from a pooled template.
+
+    The prompt, rendered schema and LLM client are shared by all sessions
+    using the same datasets, model and temperature, while a new memory and
+    Python REPL are created for every call. As the LLM client is shared,
+    per-session callbacks such as stream handlers should be passed when
+    calling the agent, e.g. `agent(question, callbacks=[stream_handler])`.
+    """
+    bigquery_client = bigquery_client or default_bigquery_client
+    datasets = datasets or []
+    key = (
+        tuple(f"{dataset.project}.{dataset.id}" for dataset in datasets),
+        OPENAI_MODEL,
+        temperature,
+    )
+    template = agent_pool.get(
+        key,
+        lambda: create_bigquery_agent_template(
+            ChatOpenAI(
+                model_name=OPENAI_MODEL,
+                streaming=True,
+                temperature=temperature,
+                request_timeout=180,
+            ),
+            bigquery_client=bigquery_client,
+            datasets=datasets,
+            with_memory=True,
         ),
+    )
+    return create_bigquery_agent_from_template(
+        template,
         bigquery_client=bigquery_client,
-        datasets=datasets,
         # https://github.com/hwchase17/langchain/issues/6083
         verbose=False,
         callback_manager=callback_manager,
@@ -46,3 +82,83 @@ def get_agent(
         ),
         secure_execution=secure_execution,
     )
+
+
+# Streamlit session of the agent run a task, or a thread it started, belongs to
+_script_run_ctx: ContextVar = ContextVar("script_run_ctx", default=None)
+_agent_loop: Optional[asyncio.AbstractEventLoop] = None
+_agent_loop_lock = threading.Lock()
+
+
+class _SessionExecutor(ThreadPoolExecutor):
+    """Attaches its threads to the Streamlit session of the submitting task."""
+
+    def submit(self, fn, /, *args, **kwargs):
+        ctx = _script_run_ctx.get()
+
+        def run():
+            add_script_run_ctx(threading.current_thread(), ctx)
+            return fn(*args, **kwargs)
+
+        return super().submit(run)
+
+
+def get_agent_loop() -> asyncio.AbstractEventLoop:
+    """The event loop shared by the agent runs of all sessions.
+
+    Started in a background thread on first use. The loop thread isn't
+    attached to any Streamlit session, so code using Streamlit, such as the
+    output parser and synchronous callbacks, runs in the loop's default
+    executor, whose threads are attached to the session of the submitting task.
+    """
+    global _agent_loop
+    with _agent_loop_lock:
+        if _agent_loop is None:
+            loop = asyncio.new_event_loop()
+            loop.set_default_executor(
+                _SessionExecutor(max_workers=AGENT_THREADS, thread_name_prefix="agent")
+            )
+            threading.Thread(
+                target=loop.run_forever, name="agent-loop", daemon=True
+            ).start()
+            _agent_loop = loop
+    return _agent_loop
+
+
+async def ainvoke_agent(agent, question: str, callbacks: Optional[List] = None) -> Dict:
+    """Run an agent on a question asynchronously.
+
+    LLM calls and code run in worker processes are awaited. Code run
+    in-process, including its BigQuery queries, code using Streamlit and
+    synchronous callbacks such as stream handlers run in the loop's default
+    executor.
+    """
+    return await agent.acall({"input": question}, callbacks=callbacks)
+
+
+def invoke_agent(agent, question: str, callbacks: Optional[List] = None) -> Dict:
+    """Run an agent on the shared event loop and wait for its response.
+
+    The calling Streamlit script blocks until the run finishes, while the
+    loop interleaves the runs of all sessions as they wait on the LLM or on
+    worker processes. The run sees the caller's context variables, e.g. of
+    `get_openai_callback()`, and its threads are attached to the caller's
+    Streamlit session.
+    """
+    context = copy_context()
+    context.run(_script_run_ctx.set, get_script_run_ctx())
+    future = asyncio.run_coroutine_threadsafe(
+        _run_in_context(context, ainvoke_agent(agent, question, callbacks)),
+        get_agent_loop(),
+    )
+    try:
+        return future.result()
+    except BaseException:
+        # E.g. the script was stopped by a rerun
+        future.cancel()
+        raise
+
+
+async def _run_in_context(context: Context, coroutine):
+    # Tasks run in a copy of the context they are created in
+    return await context.run(asyncio.ensure_future, coroutine)
@@ -1,11 +1,15 @@
 import inspect
+import time
 from typing import Any, Dict, List, Optional, Union
+from uuid import UUID
 
 import streamlit as st
 from langchain.callbacks.base import BaseCallbackHandler
 from langchain.schema import AgentAction, AgentFinish, LLMResult
 
 from app import logger
+from chartgpt.tokens import count_tokens
+from chartgpt.tracing import Tracer, tracer as default_tracer
 
 
 class CustomCallbackHandler(BaseCallbackHandler):
@@ -14,38 +18,34 @@ class CustomCallbackHandler(BaseCallbackHandler):
     ) -> None:
         """Print out the prompts."""
         class_name = serialized["id"]
-        logger.info(f"on_llm_start: {class_name}")
+        logger.debug("on_llm_start: %s", class_name)
 
     def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
         """Do nothing."""
-        logger.info(f"on_llm_end: {response}")
-
-    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
-        """Do nothing."""
-        logger.info(f"on_llm_new_token: {token}")
+        logger.debug("on_llm_end: %s", response)
 
     def on_llm_error(
         self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any
     ) -> None:
         """Do nothing."""
-        logger.info(f"on_llm_error: {error}")
+        logger.info("on_llm_error: %s", error)
 
     def on_chain_start(
         self, serialized: Dict[str, Any], inputs: Dict[str, Any], **kwargs: Any
     ) -> None:
         """Print out that we are entering a chain."""
         class_name = serialized["id"]
-        logger.info(f"on_chain_start: {class_name}")
+        logger.debug("on_chain_start: %s", class_name)
 
     def on_chain_end(self, outputs: Dict[str, Any], **kwargs: Any) -> None:
         """Print out that we finished a chain."""
-        logger.info(f"on_chain_end: {outputs}")
+        logger.debug("on_chain_end: %s", outputs)
 
     def on_chain_error(
         self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any
     ) -> None:
         """Do nothing."""
-        logger.info(f"on_chain_error: {error}")
+        logger.info("on_chain_error: %s", error)
 
     def on_tool_start(
         self,
@@ -54,13 +54,13 @@ class CustomCallbackHandler(BaseCallbackHandler):
         **kwargs: Any,
     ) -> None:
         """Do nothing."""
-        logger.info(f"on_tool_start: {input_str}")
+        logger.debug("on_tool_start: %s", input_str)
 
     def on_agent_action(
         self, action: AgentAction, color: Optional[str] = None, **kwargs: Any
     ) -> Any:
         """Run on agent action."""
-        logger.info(f"on_agent_action: {action}")
+        logger.debug("on_agent_action: %s", action)
         new_lines = action.tool_input.count("\n")
         should_display = new_lines > 1 or not "display" in action.tool_input
         if should_display:
@@ -83,13 +83,13 @@ class CustomCallbackHandler(BaseCallbackHandler):
         **kwargs: Any,
     ) -> None:
         """If not the final action, print out observation."""
-        logger.info(f"on_tool_end: {output}")
+        logger.debug("on_tool_end: %s", output)
 
     def on_tool_error(
         self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any
     ) -> None:
         """Do nothing."""
-        logger.info(f"on_tool_error: {error}")
+        logger.info("on_tool_error: %s", error)
 
     def on_text(
         self,
@@ -99,15 +99,162 @@ class CustomCallbackHandler(BaseCallbackHandler):
         **kwargs: Optional[str],
     ) -> None:
         """Run when agent ends."""
-        logger.info(f"on_text: {text}")
+        logger.debug("on_text: %s", text)
 
     def on_agent_finish(
         self, finish: AgentFinish, color: Optional[str] = None, **kwargs: Any
     ) -> None:
         """Run on agent end."""
-        logger.info(f"on_agent_finish: {finish}")
+        logger.debug("on_agent_finish: %s", finish)
         output = finish.return_values["output"]
         if "messages" in st.session_state:
             st.session_state["messages"].append(
                 {"role": "assistant", "content": output}
             )
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """Records spans for chains, LLM calls and tool calls in a `Tracer`.
+
+    Payloads such as prompts and code are only included if the tracer is
+    verbose, and tokens are only counted for sampled traces.
+    """
+
+    def __init__(self, tracer: Tracer = default_tracer):
+        self.tracer = tracer
+
+    def on_chain_start(
+        self,
+        serialized: Dict[str, Any],
+        inputs: Dict[str, Any],
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        **kwargs: Any,
+    ) -> None:
+        span = self.tracer.start_span(
+            run_id, _name(serialized, "chain"), "chain", parent_run_id
+        )
+        if span.sampled and self.tracer.verbose:
+            span.attributes["inputs"] = _truncate(inputs)
+
+    def on_chain_end(
+        self, outputs: Dict[str, Any], *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        span = self.tracer.get_span(run_id)
+        if span is not None and span.sampled:
+            steps = outputs.get("intermediate_steps")
+            if steps is not None:
+                span.attributes["steps"] = len(steps)
+            if self.tracer.verbose:
+                span.attributes["outputs"] = _truncate(outputs)
+        self.tracer.end_span(run_id)
+
+    def on_chain_error(
+        self,
+        error: Union[Exception, KeyboardInterrupt],
+        *,
+        run_id: UUID,
+        **kwargs: Any,
+    ) -> None:
+        self.tracer.end_span(run_id, error)
+
+    def on_llm_start(
+        self,
+        serialized: Dict[str, Any],
+        prompts: List[str],
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        **kwargs: Any,
+    ) -> None:
+        span = self.tracer.start_span(
+            run_id, _name(serialized, "llm"), "llm", parent_run_id
+        )
+        if span.sampled:
+            span.attributes["prompt_tokens"] = sum(map(count_tokens, prompts))
+            span.attributes["completion_tokens"] = 0
+            if self.tracer.verbose:
+                span.attributes["prompts"] = prompts
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> None:
+        span = self.tracer.get_span(run_id)
+        if span is not None and span.sampled:
+            if not span.attributes["completion_tokens"]:
+                span.attributes["first_token_ms"] = round(
+                    (time.perf_counter() - span._perf_start) * 1000, 3
+                )
+            # Streamed tokens arrive one at a time
+            span.attributes["completion_tokens"] += 1
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        span = self.tracer.get_span(run_id)
+        if span is not None and span.sampled:
+            usage = (response.llm_output or {}).get("token_usage") or {}
+            # Only reported by the API when not streaming
+            span.attributes.update(
+                {key: value for key, value in usage.items() if value}
+            )
+            if self.tracer.verbose:
+                span.attributes["completions"] = [
+                    generation.text
+                    for generations in response.generations
+                    for generation in generations
+                ]
+        self.tracer.end_span(run_id)
+
+    def on_llm_error(
+        self,
+        error: Union[Exception, KeyboardInterrupt],
+        *,
+        run_id: UUID,
+        **kwargs: Any,
+    ) -> None:
+        self.tracer.end_span(run_id, error)
+
+    def on_tool_start(
+        self,
+        serialized: Dict[str, Any],
+        input_str: str,
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        **kwargs: Any,
+    ) -> None:
+        span = self.tracer.start_span(
+            run_id, _name(serialized, "tool"), "tool", parent_run_id
+        )
+        if span.sampled:
+            span.attributes["input_chars"] = len(input_str)
+            if self.tracer.verbose:
+                span.attributes["input"] = input_str
+
+    def on_tool_end(self, output: str, *, run_id: UUID, **kwargs: Any) -> None:
+        span = self.tracer.get_span(run_id)
+        if span is not None and span.sampled:
+            output = str(output)
+            span.attributes["output_chars"] = len(output)
+            if self.tracer.verbose:
+                span.attributes["output"] = _truncate(output)
+        self.tracer.end_span(run_id)
+
+    def on_tool_error(
+        self,
+        error: Union[Exception, KeyboardInterrupt],
+        *,
+        run_id: UUID,
+        **kwargs: Any,
+    ) -> None:
+        self.tracer.end_span(run_id, error)
+
+
+def _name(serialized: Optional[Dict[str, Any]], default: str) -> str:
+    serialized = serialized or {}
+    if serialized.get("name"):
+        return serialized["name"]
+    return (serialized.get("id") or [default])[-1]
+
+
+def _truncate(value: Any, limit: int = 10000) -> str:
+    text = str(value)
+    return text if len(text) <= limit else text[:limit] + "..."
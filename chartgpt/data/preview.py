@@ -0,0 +1,81 @@
+"""Bounded text previews of DataFrames and Series.
+
+Agent observations, logs and the scratchpad only use the start of a
+DataFrame's text, so rendering it in full is wasted work on large results.
+A preview is the first and last rows of at most the first and last columns,
+followed by the shape and dtypes, at a cost that depends on the preview's
+size rather than the object's.
+"""
+
+import os
+from typing import Any, Union
+
+import numpy as np
+import pandas as pd
+
+# Rows and columns of a preview, half from the start and half from the end
+PREVIEW_ROWS = int(os.environ.get("PREVIEW_ROWS", 10))
+PREVIEW_COLUMNS = int(os.environ.get("PREVIEW_COLUMNS", 20))
+# Characters of a cell shown in a preview
+PREVIEW_CELL_CHARACTERS = 50
+
+
+def _head_tail_positions(length: int, limit: int) -> np.ndarray:
+    # Positions of the first and last limit / 2 items, plus one more on each
+    # side, so that pandas shows "..." where the rest are left out
+    half = limit // 2 + 1
+    return np.r_[0:half, length - half : length]
+
+
+def preview(
+    obj: Union[pd.DataFrame, pd.Series],
+    rows: int = PREVIEW_ROWS,
+    columns: int = PREVIEW_COLUMNS,
+) -> str:
+    """Text of the first and last rows and columns, with shape and dtypes."""
+    if isinstance(obj, pd.Series):
+        return _preview_series(obj, rows)
+
+    length, width = obj.shape
+    row_positions = (
+        _head_tail_positions(length, rows) if length > rows + 2 else slice(None)
+    )
+    column_positions = (
+        _head_tail_positions(width, columns) if width > columns + 2 else slice(None)
+    )
+    sample = obj.iloc[row_positions, column_positions]
+    text = sample.to_string(
+        # Truncating the sample by one row and column shows "..." in between
+        max_rows=len(sample) - 1 if length > rows + 2 else None,
+        min_rows=len(sample) - 2 if length > rows + 2 else None,
+        max_cols=sample.shape[1] - 1 if width > columns + 2 else None,
+        max_colwidth=PREVIEW_CELL_CHARACTERS,
+        show_dimensions=False,
+    )
+    dtypes = ", ".join(
+        f"{name}: {dtype}" for name, dtype in obj.dtypes.iloc[:columns].items()
+    )
+    if width > columns:
+        dtypes += f", ... ({width - columns} more)"
+    return f"{text}\n\n[{length} rows x {width} columns]\ndtypes: {dtypes}"
+
+
+def to_text(obj: Any) -> str:
+    """Text of an object, previewing DataFrames and Series."""
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return preview(obj)
+    return str(obj)
+
+
+def _preview_series(series: pd.Series, rows: int) -> str:
+    length = len(series)
+    truncated = length > rows + 2
+    sample = series.iloc[_head_tail_positions(length, rows)] if truncated else series
+    text = sample.to_string(
+        max_rows=len(sample) - 1 if truncated else None,
+        min_rows=len(sample) - 2 if truncated else None,
+        length=False,
+        name=False,
+        dtype=False,
+    )
+    return f"{text}\n\nName: {series.name}, Length: {length}, dtype: {series.dtype}"
@@ -1,9 +1,15 @@
-import locale
 import re
+from typing import Optional, Tuple
 
 import numpy as np
 import pandas as pd
 
+# Strings of digits with at least one decimal or thousands separator
+LOCALE_NUMBER = r"(?=.*\d)[\d.,]*[.,][\d.,]*"
+# Values that spreadsheet exports of the NFTfi loan data use for errors
+SPREADSHEET_DIVISION_ERROR = "#DIV/0!"
+SPREADSHEET_MISSING_VALUE = "#N/A"
+
 
 def format_bigquery_column_names(df):
     # Remove special charachters
@@ -29,18 +35,38 @@ def format_bigquery_column_names(df):
 def clean_nftfi_loan_dataframe(df) -> pd.DataFrame:
     # Convert date from Google datetime to Pandas datetime
     # df["date"] = df["date"].astype('datetime64[s]')
-    df["date"] = pd.to_datetime(df["date"], unit="d", origin="1899-12-30")
+    df["date"] = pd.to_datetime(df["date"], unit="D", origin="1899-12-30")
 
     # Set precision of Pandas datetime to avoid BigQuery precision error
     df["loan_start_time"] = df["loan_start_time"].astype("datetime64[s]")
     df["loan_due_time"] = df["loan_due_time"].astype("datetime64[s]")
 
-    # Remove invalid values
-    # mask = df == "#DIV/0! (Function DIVIDE parameter 2 cannot be zero.)"
-    # df[mask] = np.nan
-    # df["apr"] = df["apr"].apply(lambda x: x if isinstance(x, float) else np.nan)
-    df.replace(r"#DIV/0!", np.nan, regex=True, inplace=True)
-    df.replace(r"#N/A", "", regex=True, inplace=True)
+    # Remove invalid values, which are only found in text columns
+    for column in df.columns:
+        if not _is_text(df[column]):
+            continue
+        # By position, as the index may have duplicates
+        is_string = _is_string(df[column])
+        strings = df[column][is_string].astype(str)
+        division_error = np.zeros(len(df), dtype=bool)
+        division_error[is_string] = strings.str.contains(
+            SPREADSHEET_DIVISION_ERROR, regex=False
+        ).to_numpy(dtype=bool)
+        missing = np.zeros(len(df), dtype=bool)
+        missing[is_string] = strings.str.contains(
+            SPREADSHEET_MISSING_VALUE, regex=False
+        ).to_numpy(dtype=bool)
+        missing &= ~division_error
+        if not missing.any() and not division_error.any():
+            continue
+        values = df[column].to_numpy(dtype=object, copy=True)
+        values[missing] = (
+            strings[missing[is_string]]
+            .str.replace(SPREADSHEET_MISSING_VALUE, "", regex=False)
+            .to_numpy(dtype=object)
+        )
+        values[division_error] = np.nan
+        df[column] = values
 
     # Clip NFT collateral ID as it has a string value, an integer, that is larger than Python int64 type
     df["nft_collateral_id"] = df["nft_collateral_id"].astype(float).astype(np.int64)
@@ -69,47 +95,79 @@ def is_locale_string(s):
     )
 
 
-def locale_to_float(string):
-    if is_locale_string(string):
-        if "," in string:
-            locale.setlocale(
-                locale.LC_ALL, "fr_FR.UTF-8"
-            )  # French locale, using comma as decimal separator
-        else:
-            locale.setlocale(
-                locale.LC_ALL, "en_US.UTF-8"
-            )  # US locale, using dot as decimal separator
-        string = locale.atof(string)
-    return string
+def infer_separators(string: str) -> Tuple[str, str]:
+    """Decimal and thousands separators of a number, e.g. "1.234,5" or "1,5".
 
+    The last separator of a number with both is the decimal separator. A
+    comma on its own is taken as a decimal separator, as in French.
+    """
+    if "," in string and string.rfind(",") > string.rfind("."):
+        return ",", "."
+    return ".", ","
 
-def locale_to_float_series(series):
-    # Check if the column contains locale strings
-    contains_locale_strings = any(series.apply(is_locale_string))
 
-    if contains_locale_strings:
-        # Identify locale by checking the first non-null value
-        first_non_null = series.dropna().iloc[0]
-
-        # Check if the first non-null value contains a comma as a decimal separator
-        if "," in first_non_null:
-            locale.setlocale(
-                locale.LC_ALL, "fr_FR.UTF-8"
-            )  # French locale, using comma as decimal separator
-        else:
-            locale.setlocale(
-                locale.LC_ALL, "en_US.UTF-8"
-            )  # US locale, using dot as decimal separator
+def locale_to_float(
+    string, decimal: Optional[str] = None, thousands: Optional[str] = None
+):
+    if is_locale_string(string):
+        decimal, thousands = _separators(string, decimal, thousands)
+        string = float(string.replace(thousands, "").replace(decimal, "."))
+    return string
 
-        # Convert strings with locale info to floats
-        series = series.apply(lambda x: locale.atof(x) if is_locale_string(x) else x)
-        series = pd.to_numeric(series)
 
-    return series
+def locale_to_float_series(
+    series, decimal: Optional[str] = None, thousands: Optional[str] = None
+):
+    """Convert a text column of numbers written with separators to floats.
+
+    Separators are inferred from the first such number unless given, and
+    apply to the whole column. Doesn't change the process locale, so it is
+    safe to call from concurrent sessions.
+    """
+    if not _is_text(series):
+        return series
+    # Check if the column contains locale strings, by position as the index
+    # may have duplicates
+    is_string = _is_string(series)
+    strings = series[is_string]
+    is_locale_string = strings.str.fullmatch(LOCALE_NUMBER).to_numpy(dtype=bool)
+    if not is_locale_string.any():
+        return series
+
+    locale_strings = strings[is_locale_string]
+    decimal, thousands = _separators(locale_strings.iloc[0], decimal, thousands)
+    numbers = locale_strings.str.replace(thousands, "", regex=False).str.replace(
+        decimal, ".", regex=False
+    )
+    values = series.to_numpy(dtype=object, copy=True)
+    values[np.flatnonzero(is_string)[is_locale_string]] = numbers.to_numpy()
+    return pd.to_numeric(pd.Series(values, index=series.index, name=series.name))
 
 
 def locale_to_float_dataframe(df):
-    # Iterate over all columns in the DataFrame
+    # Iterate over all text columns in the DataFrame
     for column in df.columns:
-        df[column] = locale_to_float_series(df[column])
+        if _is_text(df[column]):
+            df[column] = locale_to_float_series(df[column])
     return df
+
+
+def _is_text(series: pd.Series) -> bool:
+    return pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)
+
+
+def _is_string(series: pd.Series) -> np.ndarray:
+    # Which values of a text column are strings, e.g. not numbers or missing
+    if pd.api.types.is_object_dtype(series):
+        return series.map(type).eq(str).to_numpy()
+    return series.notna().to_numpy()
+
+
+def _separators(
+    string: str, decimal: Optional[str], thousands: Optional[str]
+) -> Tuple[str, str]:
+    if decimal is None:
+        return infer_separators(string)
+    if thousands is None:
+        thousands = "," if decimal == "." else "."
+    return decimal, thousands
@@ -0,0 +1,91 @@
+"""Tracks which objects agent code has already displayed in Streamlit.
+
+The patched `__repr__` of DataFrames, Series, figures and dicts displays an
+object the first time it's called, as agent code and LangChain may call it
+more than once. Displayed objects are remembered with weak references, so
+that they can be garbage collected and a new object that reuses the `id()`
+of a collected one is still displayed, and at most `DISPLAY_REGISTRY_SIZE`
+are remembered. A new registry is used for each question.
+"""
+
+import os
+import threading
+import weakref
+from collections import OrderedDict, deque
+from typing import Any, Tuple
+
+DISPLAY_REGISTRY_SIZE = int(os.environ.get("DISPLAY_REGISTRY_SIZE", 1024))
+
+
+class DisplayRegistry:
+    def __init__(self, max_size: int = DISPLAY_REGISTRY_SIZE):
+        self.max_size = max_size
+        self._objects: "OrderedDict[int, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Keys and references of collected objects, pruned by `mark()`. The
+        # weakref callbacks can't take the lock, as garbage collection may
+        # run them in a thread that already holds it.
+        self._collected: "deque[Tuple[int, weakref.ref]]" = deque()
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._prune()
+            return len(self._objects)
+
+    def mark(self, obj: Any) -> bool:
+        """Remember an object as displayed, returning False if it already was."""
+        key = id(obj)
+        with self._lock:
+            self._prune()
+            ref = self._objects.get(key)
+            if ref is not None and _dereference(ref) is obj:
+                self._objects.move_to_end(key)
+                return False
+            try:
+                self._objects[key] = weakref.ref(obj, self._remover(key))
+            except TypeError:
+                # Not weakly referenceable, kept until evicted
+                self._objects[key] = obj
+            self._objects.move_to_end(key)
+            while len(self._objects) > self.max_size:
+                self._objects.popitem(last=False)
+        return True
+
+    def _prune(self) -> None:
+        # Called with the lock held
+        while self._collected:
+            key, ref = self._collected.popleft()
+            # Unless the id was reused by a newer object
+            if self._objects.get(key) is ref:
+                del self._objects[key]
+
+    def _remover(self, key: int):
+        self_ref = weakref.ref(self)
+
+        def remove(ref: weakref.ref) -> None:
+            registry = self_ref()
+            if registry is not None:
+                # deque.append is atomic, so no lock is needed
+                registry._collected.append((key, ref))
+
+        return remove
+
+
+def _dereference(ref: Any) -> Any:
+    return ref() if isinstance(ref, weakref.ref) else ref
+
+
+def get_display_registry() -> DisplayRegistry:
+    """The registry of the current Streamlit session's question."""
+    import streamlit as st
+
+    if "display_registry" not in st.session_state:
+        st.session_state["display_registry"] = DisplayRegistry()
+    return st.session_state["display_registry"]
+
+
+def reset_display_registry() -> None:
+    """Start a new registry, e.g. when a new question is asked."""
+    import streamlit as st
+
+    st.session_state["display_registry"] = DisplayRegistry()
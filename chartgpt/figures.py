@@ -0,0 +1,309 @@
+"""Smaller Plotly figures for rendering and persisting agent charts.
+
+Agent code often plots every row of a query result, e.g. a scatter of a
+million transactions, which is megabytes of JSON sent to the browser and
+stored with the chart. `optimize_figure()` downsamples large line and
+scatter traces, keeping their visual shape, and draws those that are still
+large with WebGL. `encode_arrays()` and `decode_arrays()` convert the
+numeric arrays of figure JSON to and from compact base64 typed arrays.
+"""
+
+import base64
+import logging
+import os
+import time
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import numpy as np
+import plotly.graph_objects as go
+
+from chartgpt import tracing
+
+logger = logging.getLogger(__name__)
+
+# Points per trace above which line and scatter traces are downsampled
+FIGURE_MAX_POINTS = int(os.environ.get("FIGURE_MAX_POINTS", 5000))
+# Points per trace above which scatter traces are drawn with WebGL
+FIGURE_WEBGL_POINTS = int(os.environ.get("FIGURE_WEBGL_POINTS", 1000))
+# Numeric arrays shorter than this are left as JSON lists
+ENCODE_MIN_LENGTH = 64
+
+# Trace attributes with a value per point, downsampled together with x and y
+POINT_ATTRIBUTES = (
+    "text",
+    "hovertext",
+    "customdata",
+    "ids",
+    "marker.color",
+    "marker.size",
+    "marker.symbol",
+    "marker.opacity",
+    "error_x.array",
+    "error_x.arrayminus",
+    "error_y.array",
+    "error_y.arrayminus",
+)
+
+
+class FigureStats(NamedTuple):
+    traces: int
+    downsampled_traces: int
+    webgl_traces: int
+    original_points: int
+    points: int
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """Indices of the points kept by Largest-Triangle-Three-Buckets.
+
+    Keeps the first and last points, and from each of `threshold - 2` equal
+    buckets in between, the point forming the largest triangle with the
+    point kept before it and the average of the next bucket. Best for lines.
+    """
+    length = len(x)
+    if threshold >= length or threshold < 3:
+        return np.arange(length)
+    y = np.nan_to_num(y)
+    edges = np.linspace(1, length - 1, threshold - 1).astype(np.int64)
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0], indices[-1] = 0, length - 1
+    a = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_end = edges[bucket + 2] if bucket + 2 < len(edges) else length
+        average_x = x[end:next_end].mean()
+        average_y = y[end:next_end].mean()
+        areas = np.abs(
+            (x[a] - average_x) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (average_y - y[a])
+        )
+        a = start + int(np.argmax(areas))
+        indices[bucket + 1] = a
+    return indices
+
+
+def min_max_indices(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """Indices of the lowest and highest point in each of `threshold / 2` buckets.
+
+    Buckets are consecutive ranges of x, so the envelope and outliers of a
+    scatter are kept, in their original order. Best for markers.
+    """
+    length = len(x)
+    if threshold >= length or threshold < 2:
+        return np.arange(length)
+    order = np.argsort(x, kind="stable")
+    sorted_y = np.nan_to_num(y[order])
+    edges = np.linspace(0, length, threshold // 2 + 1).astype(np.int64)
+    kept = []
+    for start, end in zip(edges[:-1], edges[1:]):
+        if start == end:
+            continue
+        bucket = sorted_y[start:end]
+        kept.append(start + int(np.argmin(bucket)))
+        kept.append(start + int(np.argmax(bucket)))
+    return np.unique(order[kept])
+
+
+def optimize_figure(
+    figure: go.Figure,
+    max_points: int = FIGURE_MAX_POINTS,
+    webgl_points: int = FIGURE_WEBGL_POINTS,
+) -> FigureStats:
+    """Downsample large line and scatter traces, and draw large ones with WebGL.
+
+    Modifies the figure in place, and returns the number of points before
+    and after, which are also recorded in the current trace.
+    """
+    start = time.perf_counter()
+    data = list(figure.data)
+    downsampled = webgl = original_points = points = 0
+    for position, trace in enumerate(data):
+        if trace.type not in ("scatter", "scattergl"):
+            original_points += _count_points(trace)
+            points += _count_points(trace)
+            continue
+        length = _count_points(trace)
+        original_points += length
+        if length > max_points:
+            try:
+                if _downsample(trace, length, max_points):
+                    downsampled += 1
+                    length = _count_points(trace)
+            except (TypeError, ValueError):
+                logger.exception("Failed to downsample %s trace", trace.type)
+        points += length
+        if trace.type == "scatter" and length > webgl_points:
+            webgl_trace = _to_webgl(trace)
+            if webgl_trace is not None:
+                data[position] = webgl_trace
+                webgl += 1
+    if webgl:
+        # Traces can't be replaced in place, only removed and added
+        figure.data = ()
+        figure.add_traces(data)
+
+    stats = FigureStats(len(data), downsampled, webgl, original_points, points)
+    duration_ms = (time.perf_counter() - start) * 1000
+    if downsampled or webgl:
+        logger.info("Optimized figure in %.2f ms: %s", duration_ms, stats)
+    tracing.tracer.record_span(
+        "optimize_figure",
+        "figure",
+        duration_ms,
+        parent=tracing.current_span(),
+        **stats._asdict(),
+    )
+    return stats
+
+
+def encode_arrays(value: Any) -> Any:
+    """Replace numeric lists in figure JSON with base64 typed arrays.
+
+    Uses the `{"dtype": ..., "bdata": ...}` format of Plotly's typed arrays.
+    """
+    if isinstance(value, dict):
+        return {key: encode_arrays(item) for key, item in value.items()}
+    if isinstance(value, list):
+        encoded = _encode_array(value)
+        if encoded is not None:
+            return encoded
+        return [encode_arrays(item) for item in value]
+    return value
+
+
+def decode_arrays(value: Any) -> Any:
+    """Replace base64 typed arrays in figure JSON with lists."""
+    if isinstance(value, dict):
+        if "bdata" in value and "dtype" in value:
+            array = np.frombuffer(
+                base64.b64decode(value["bdata"]), dtype=np.dtype(value["dtype"])
+            )
+            if "shape" in value:
+                array = array.reshape(value["shape"])
+            if array.dtype.kind == "f":
+                # NaN isn't valid JSON, Plotly writes it as null
+                return np.where(np.isnan(array), None, array).tolist()
+            return array.tolist()
+        return {key: decode_arrays(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [decode_arrays(item) for item in value]
+    return value
+
+
+def _encode_array(values: List[Any]) -> Optional[Dict[str, Any]]:
+    if len(values) < ENCODE_MIN_LENGTH:
+        return None
+    is_integer = True
+    for item in values:
+        if item is None:
+            is_integer = False
+        elif isinstance(item, bool) or not isinstance(item, (int, float)):
+            return None
+        elif isinstance(item, float):
+            is_integer = False
+    if is_integer:
+        array = np.array(values, dtype=np.int64)
+        # Plotly's typed arrays have no 64-bit integers
+        array = array.astype("<i4" if np.abs(array).max() < 2**31 else "<f8")
+    else:
+        array = np.array(
+            [np.nan if item is None else item for item in values], dtype="<f8"
+        )
+    return {"dtype": array.dtype.str[1:], "bdata": base64.b64encode(array).decode()}
+
+
+def _count_points(trace) -> int:
+    lengths = [
+        len(trace[key])
+        for key in ("x", "y")
+        if key in trace and trace[key] is not None and not isinstance(trace[key], str)
+    ]
+    return max(lengths, default=0)
+
+
+def _get(trace, path: str):
+    value = trace
+    for part in path.split("."):
+        value = value[part]
+        if value is None:
+            return None
+    return value
+
+
+def _numeric(values) -> Optional[np.ndarray]:
+    array = np.asarray(values)
+    if array.dtype.kind == "M":
+        return array.astype("datetime64[ns]").astype(np.int64).astype(np.float64)
+    try:
+        # Missing values, as None, become NaN
+        return array.astype(np.float64)
+    except (TypeError, ValueError):
+        return None
+
+
+def _downsample(trace, length: int, max_points: int) -> bool:
+    y = _numeric(trace.y) if trace.y is not None else None
+    if y is None or len(y) != length:
+        return False
+    x = _numeric(trace.x) if trace.x is not None else np.arange(length, dtype=float)
+    if x is None:
+        # E.g. categories, downsampled by position
+        x = np.arange(length, dtype=float)
+    if "lines" in (trace.mode or "lines"):
+        indices = lttb_indices(x, y, max_points)
+    else:
+        indices = min_max_indices(x, y, max_points)
+
+    update: Dict[str, Any] = {"y": np.asarray(trace.y)[indices]}
+    if trace.x is not None:
+        update["x"] = np.asarray(trace.x)[indices]
+    else:
+        # Points are at `x0 + dx * i`, which the kept points must keep
+        update["x"] = _implicit_x(trace, indices)
+        if update["x"] is None:
+            return False
+    for path in POINT_ATTRIBUTES:
+        values = _get(trace, path)
+        if values is None or isinstance(values, str):
+            continue
+        values = np.asarray(values)
+        if values.ndim and len(values) == length:
+            _set_path(update, path, values[indices])
+    trace.update(update)
+    return True
+
+
+def _implicit_x(trace, indices: np.ndarray) -> Optional[np.ndarray]:
+    x0 = 0 if trace.x0 is None else trace.x0
+    dx = 1 if trace.dx is None else trace.dx
+    if isinstance(x0, (int, float)):
+        return x0 + dx * indices
+    try:
+        # On date axes, x0 is a date and dx is in milliseconds
+        return (
+            np.datetime64(x0, "ms") + np.rint(dx * indices).astype("timedelta64[ms]")
+        ).astype(str)
+    except (TypeError, ValueError):
+        return None
+
+
+def _set_path(update: Dict[str, Any], path: str, value: Any) -> None:
+    parts = path.split(".")
+    for part in parts[:-1]:
+        update = update.setdefault(part, {})
+    update[parts[-1]] = value
+
+
+def _to_webgl(trace) -> Optional[go.Scattergl]:
+    # Attributes that scattergl doesn't support, or draws differently
+    if trace.stackgroup or (trace.line and trace.line.shape == "spline"):
+        return None
+    if trace.fill not in (None, "none", "tozeroy", "tonexty"):
+        return None
+    properties = trace.to_plotly_json()
+    properties.pop("type", None)
+    try:
+        return go.Scattergl(properties)
+    except ValueError:
+        # A scatter attribute that scattergl doesn't have
+        return None
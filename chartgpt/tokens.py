@@ -0,0 +1,23 @@
+"""Token counting for text sent to OpenAI models."""
+
+import os
+from functools import lru_cache
+
+import tiktoken
+
+OPENAI_MODEL = os.environ.get("OPENAI_MODEL", "gpt-3.5-turbo")
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str = OPENAI_MODEL) -> tiktoken.Encoding:
+    """Return the tokenizer of a model, loaded once per process."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # E.g. fine-tuned or newer models unknown to this tiktoken version
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str, model: str = OPENAI_MODEL) -> int:
+    """Count the tokens of a text for a model."""
+    return len(get_encoding(model).encode(text, disallowed_special=()))
@@ -0,0 +1,397 @@
+"""BigQuery client exposed to agent code in the Python REPL."""
+
+import datetime
+import hashlib
+import logging
+import os
+import re
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+from google.cloud import bigquery
+from google.cloud.bigquery.table import RowIterator
+
+from config.datasets import DEFAULT_MAX_BYTES_PROCESSED, Dataset
+from chartgpt import tracing
+from chartgpt.agents.agent_toolkits.bigquery.schema_cache import (
+    TableMetadata,
+    schema_cache,
+)
+from chartgpt.tools.bigquery.dataframe import (
+    QUERY_RESULT_MAX_ROWS,
+    fetch_dataframe,
+    get_bqstorage_client,
+)
+from chartgpt.tools.bigquery.result_cache import (
+    QUERY_CACHE_ENABLED,
+    QueryResultCache,
+    query_result_cache,
+)
+from chartgpt.tools.bigquery.rewrite import add_limit, add_partition_filters
+
+logger = logging.getLogger(__name__)
+
+# Days of partitions kept when a query over budget is rewritten
+QUERY_PARTITION_LOOKBACK_DAYS = int(os.environ.get("QUERY_PARTITION_LOOKBACK_DAYS", 30))
+
+# Maximum age in seconds of a referenced table's last modified time before
+# it is revalidated, bounding how stale a cached query result can be
+TABLE_VERSION_MAX_AGE = 60
+
+# Queries using these functions return different results on every run
+NONDETERMINISTIC_FUNCTIONS = re.compile(
+    r"\b(RAND|GENERATE_UUID|CURRENT_(TIMESTAMP|DATETIME|TIME)|SESSION_USER)\b",
+    re.IGNORECASE,
+)
+# Queries using these functions return the same results within a day
+DAILY_FUNCTIONS = re.compile(r"\bCURRENT_DATE\b", re.IGNORECASE)
+
+# `to_dataframe()` options that don't affect the result
+IGNORED_TO_DATAFRAME_KWARGS = {"progress_bar_type", "create_bqstorage_client"}
+
+
+class QueryBudgetExceededError(ValueError):
+    """Raised when a query would process more bytes than its datasets allow."""
+
+
+class CachedQueryJob:
+    """Stand-in for a completed `bigquery.QueryJob` served from the cache."""
+
+    cache_hit = True
+    state = "DONE"
+    errors = None
+    job_id = None
+    total_bytes_processed = 0
+    total_bytes_billed = 0
+
+    def __init__(self, query: str, df: pd.DataFrame):
+        self.query = query
+        self._df = df
+
+    @property
+    def total_rows(self) -> int:
+        return len(self._df)
+
+    def done(self, *args, **kwargs) -> bool:
+        return True
+
+    def result(self, *args, **kwargs) -> "CachedQueryJob":
+        return self
+
+    def to_dataframe(self, *args, **kwargs) -> pd.DataFrame:
+        return self._df
+
+    def to_arrow(self, *args, **kwargs):
+        import pyarrow as pa
+
+        return pa.Table.from_pandas(self._df, preserve_index=False)
+
+    def __iter__(self):
+        return self._df.itertuples(index=False, name="Row")
+
+
+class _RowIterator:
+    """Proxy for a `RowIterator` that fetches DataFrames using Arrow.
+
+    If `on_dataframe` is given, it is called with every complete DataFrame.
+    """
+
+    def __init__(self, rows: RowIterator, fetch, on_dataframe=None):
+        self._rows = rows
+        self._fetch = fetch
+        self._on_dataframe = on_dataframe
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._rows, name)
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def to_dataframe(self, *args, **kwargs) -> pd.DataFrame:
+        if args or set(kwargs) - IGNORED_TO_DATAFRAME_KWARGS:
+            # Fall back to the client library for options we don't support
+            return self._rows.to_dataframe(*args, **kwargs)
+        df = self._fetch(self._rows)
+        if self._on_dataframe and not df.attrs.get("truncated"):
+            self._on_dataframe(df)
+        return df
+
+
+class _QueryJob:
+    """Proxy for a `bigquery.QueryJob` that fetches DataFrames using Arrow.
+
+    If `on_result` is given, it is called with the job once it has completed.
+    """
+
+    def __init__(
+        self, job: bigquery.QueryJob, fetch, on_dataframe=None, on_result=None
+    ):
+        self._job = job
+        self._fetch = fetch
+        self._on_dataframe = on_dataframe
+        self._on_result = on_result
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._job, name)
+
+    def __iter__(self):
+        return iter(self.result())
+
+    def result(self, *args, **kwargs):
+        rows = self._job.result(*args, **kwargs)
+        if self._on_result:
+            on_result, self._on_result = self._on_result, None
+            on_result(self._job)
+        if args or kwargs.get("max_results") or kwargs.get("start_index"):
+            # Partial results must not be cached as the full result
+            return rows
+        return _RowIterator(rows, self._fetch, self._on_dataframe)
+
+    def to_dataframe(self, *args, **kwargs) -> pd.DataFrame:
+        if args or set(kwargs) - IGNORED_TO_DATAFRAME_KWARGS:
+            return self._job.to_dataframe(*args, **kwargs)
+        return self.result().to_dataframe()
+
+
+class ReplBigQueryClient:
+    """Proxy for `bigquery.Client` that bounds and caches agent queries.
+
+    Every statement is dry run first. Statements that would process more
+    bytes than the smallest `max_bytes_processed` of the datasets they
+    reference are rewritten to filter time-partitioned tables to recent
+    partitions, and rejected with `QueryBudgetExceededError` if they are
+    still over budget. The budget is also enforced by BigQuery through
+    `maximum_bytes_billed`, and `SELECT` statements without a `LIMIT` are
+    limited to the rows `fetch_dataframe()` would download.
+
+    Deterministic `SELECT` results are cached, keyed on the normalized SQL
+    plus the last modified time of each referenced table, so that repeated
+    questions over unchanged tables don't scan them again. DataFrames are
+    downloaded as Arrow record batches, using the Storage Read API where
+    available. All other attributes are forwarded to the wrapped client.
+
+    Statistics for queries since the last call to `pop_stats()` are kept so
+    they can be recorded with the user's query, and notices about rewritten
+    queries are kept until `pop_notices()` so they can be shown to the agent.
+    """
+
+    def __init__(
+        self,
+        client: bigquery.Client,
+        datasets: Optional[List[Dataset]] = None,
+        result_cache: Optional[QueryResultCache] = query_result_cache,
+    ):
+        self._client = client
+        self.datasets = list(datasets or [])
+        self._budgets = {
+            f"{dataset.project}.{dataset.id}": dataset.max_bytes_processed
+            for dataset in self.datasets
+        }
+        self._result_cache = result_cache if QUERY_CACHE_ENABLED else None
+        self._queries: List[Dict] = []
+        self._notices: List[str] = []
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._client, name)
+
+    def query(
+        self,
+        query: str,
+        job_config: Optional[bigquery.QueryJobConfig] = None,
+        **kwargs: Any,
+    ):
+        if job_config is not None and job_config.dry_run:
+            return self._client.query(query, job_config=job_config, **kwargs)
+
+        dry_run = self._dry_run(query, job_config)
+        tables = [
+            schema_cache.get_table(
+                self._client, table_id, max_age=TABLE_VERSION_MAX_AGE
+            )
+            for table_id in (
+                f"{table.project}.{table.dataset_id}.{table.table_id}"
+                for table in dry_run.referenced_tables
+            )
+        ]
+        budget = self._budget(tables)
+        record = {
+            "sql_hash": hashlib.sha256(query.encode()).hexdigest()[:16],
+            "cache_hit": False,
+            "rewritten": False,
+            "rejected": False,
+            "bytes_estimated": dry_run.total_bytes_processed or 0,
+            "bytes_billed": None,
+            "bytes_saved": 0,
+        }
+        self._queries.append(record)
+
+        if record["bytes_estimated"] > budget and dry_run.statement_type == "SELECT":
+            rewritten = add_partition_filters(
+                query, tables, QUERY_PARTITION_LOOKBACK_DAYS
+            )
+            if rewritten != query:
+                dry_run = self._dry_run(rewritten, job_config)
+                logger.info(
+                    "Rewrote query %s with partition filters, estimated bytes "
+                    "%d -> %d",
+                    record["sql_hash"],
+                    record["bytes_estimated"],
+                    dry_run.total_bytes_processed or 0,
+                )
+                query = rewritten
+                record["rewritten"] = True
+                record["bytes_estimated"] = dry_run.total_bytes_processed or 0
+        if record["bytes_estimated"] > budget:
+            record["rejected"] = True
+            _trace_query(record)
+            logger.warning(
+                "Rejected query %s estimated to process %d bytes (budget %d)",
+                record["sql_hash"],
+                record["bytes_estimated"],
+                budget,
+            )
+            raise QueryBudgetExceededError(
+                f"The query would process {_format_bytes(record['bytes_estimated'])}"
+                f", over the budget of {_format_bytes(budget)}. "
+                "Filter on the partitioning column of large tables, e.g. to a "
+                "recent date range, and select only the columns you need."
+            )
+        if record["rewritten"]:
+            self._notices.append(
+                "Note: the query was over budget, so it was restricted to the "
+                f"last {QUERY_PARTITION_LOOKBACK_DAYS} days of data."
+            )
+
+        if dry_run.statement_type == "SELECT":
+            # One extra row lets `fetch_dataframe()` detect truncated results
+            query = add_limit(query, QUERY_RESULT_MAX_ROWS + 1)
+        job_config = _copy_job_config(job_config)
+        job_config.maximum_bytes_billed = budget
+
+        def on_result(job: bigquery.QueryJob) -> None:
+            record["bytes_billed"] = job.total_bytes_billed or 0
+            if job.started and job.ended:
+                record["job_ms"] = (job.ended - job.started).total_seconds() * 1000
+            _trace_query(record)
+            logger.info(
+                "Query %s estimated %d bytes, processed %d bytes, billed %d bytes",
+                record["sql_hash"],
+                record["bytes_estimated"],
+                job.total_bytes_processed or 0,
+                record["bytes_billed"],
+            )
+
+        if (
+            self._result_cache is None
+            or dry_run.statement_type != "SELECT"
+            or NONDETERMINISTIC_FUNCTIONS.search(query)
+            or job_config.query_parameters
+        ):
+            return _QueryJob(
+                self._client.query(query, job_config=job_config, **kwargs),
+                self._fetch_dataframe,
+                on_result=on_result,
+            )
+
+        key = self._result_cache.key(query, self._table_versions(query, tables))
+        cached = self._result_cache.get(key)
+        if cached is not None:
+            df, metadata = cached
+            record["cache_hit"] = True
+            record["bytes_billed"] = 0
+            record["bytes_saved"] = metadata.get("total_bytes_processed", 0)
+            _trace_query(record)
+            logger.info("Query result cache hit for %s", record["sql_hash"])
+            return CachedQueryJob(query, df)
+
+        job = self._client.query(query, job_config=job_config, **kwargs)
+
+        def on_dataframe(df: pd.DataFrame) -> None:
+            self._result_cache.put(
+                key, df, {"total_bytes_processed": job.total_bytes_processed or 0}
+            )
+
+        return _QueryJob(job, self._fetch_dataframe, on_dataframe, on_result)
+
+    def pop_stats(self) -> Dict:
+        """Return query statistics since the last call and reset them."""
+        queries, self._queries = self._queries, []
+        hits = sum(query["cache_hit"] for query in queries)
+        return {
+            "hits": hits,
+            "misses": len(queries) - hits,
+            "bytes_saved": sum(query["bytes_saved"] for query in queries),
+            "bytes_billed": sum(query["bytes_billed"] or 0 for query in queries),
+            "queries": queries,
+        }
+
+    def record(self, queries: List[Dict], notices: List[str]) -> None:
+        """Add statistics and notices for queries run by another client.
+
+        Used for queries run in worker processes on behalf of this session.
+        """
+        self._queries.extend(queries)
+        self._notices.extend(notices)
+        for query in queries:
+            _trace_query(query)
+
+    def pop_notices(self) -> List[str]:
+        """Return notices about rewritten queries since the last call."""
+        notices, self._notices = self._notices, []
+        return notices
+
+    def _fetch_dataframe(self, rows: RowIterator) -> pd.DataFrame:
+        return fetch_dataframe(
+            rows, bqstorage_client=get_bqstorage_client(self._client)
+        )
+
+    def _dry_run(
+        self, query: str, job_config: Optional[bigquery.QueryJobConfig]
+    ) -> bigquery.QueryJob:
+        dry_run_config = _copy_job_config(job_config)
+        dry_run_config.dry_run = True
+        dry_run_config.use_query_cache = False
+        return self._client.query(query, job_config=dry_run_config)
+
+    def _budget(self, tables: List[TableMetadata]) -> int:
+        budgets = [
+            self._budgets.get(
+                table.table_id.rsplit(".", 1)[0], DEFAULT_MAX_BYTES_PROCESSED
+            )
+            for table in tables
+        ]
+        return min(budgets, default=DEFAULT_MAX_BYTES_PROCESSED)
+
+    def _table_versions(self, query: str, tables: List[TableMetadata]) -> List:
+        versions = [(table.table_id, table.modified) for table in tables]
+        if DAILY_FUNCTIONS.search(query):
+            # BigQuery evaluates CURRENT_DATE in UTC by default
+            versions.append(("CURRENT_DATE", str(datetime.datetime.utcnow().date())))
+        return versions
+
+
+def _trace_query(record: Dict) -> None:
+    # Recorded under the tool call running the agent code, if it is traced
+    tracing.tracer.record_span(
+        "bigquery.query",
+        "bigquery",
+        record.get("job_ms", 0),
+        parent=tracing.current_span(),
+        **record,
+    )
+
+
+def _copy_job_config(
+    job_config: Optional[bigquery.QueryJobConfig],
+) -> bigquery.QueryJobConfig:
+    if job_config is None:
+        return bigquery.QueryJobConfig()
+    return bigquery.QueryJobConfig.from_api_repr(job_config.to_api_repr())
+
+
+def _format_bytes(num_bytes: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if num_bytes < 1024:
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} TiB"
@@ -0,0 +1,133 @@
+"""Memory-efficient conversion of BigQuery query results to DataFrames."""
+
+import logging
+import os
+from functools import lru_cache
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from google.cloud.bigquery.table import RowIterator
+
+logger = logging.getLogger(__name__)
+
+QUERY_RESULT_MAX_ROWS = int(os.environ.get("QUERY_RESULT_MAX_ROWS", 1_000_000))
+QUERY_RESULT_MAX_BYTES = int(os.environ.get("QUERY_RESULT_MAX_BYTES", 1024**3))
+
+# Object columns with at most this ratio of unique values become categoricals
+CATEGORY_MAX_UNIQUE_RATIO = 0.5
+
+# Match the nullable dtypes used by `RowIterator.to_dataframe()`
+_TYPES_MAPPER = {
+    pa.int64(): pd.Int64Dtype(),
+    pa.bool_(): pd.BooleanDtype(),
+}
+
+
+def fetch_dataframe(
+    rows: RowIterator,
+    bqstorage_client=None,
+    max_rows: int = QUERY_RESULT_MAX_ROWS,
+    max_bytes: int = QUERY_RESULT_MAX_BYTES,
+) -> pd.DataFrame:
+    """Download query results as Arrow record batches and convert them once.
+
+    When `bqstorage_client` is given, large results are streamed using the
+    BigQuery Storage Read API. Downloading stops after `max_rows` rows or
+    `max_bytes` bytes of Arrow data, in which case `df.attrs["truncated"]` is
+    set. The batches are converted with `self_destruct` so that Arrow memory
+    is released column by column, instead of holding both copies in memory.
+    """
+    batches = []
+    num_rows = 0
+    num_bytes = 0
+    batch_iterator = rows.to_arrow_iterable(bqstorage_client=bqstorage_client)
+    try:
+        for batch in batch_iterator:
+            if num_rows + batch.num_rows > max_rows:
+                batch = batch.slice(0, max_rows - num_rows)
+            batches.append(batch)
+            num_rows += batch.num_rows
+            num_bytes += batch.nbytes
+            if num_rows >= max_rows or num_bytes >= max_bytes:
+                break
+    finally:
+        # Stops any background downloads if the ceiling was reached
+        batch_iterator.close()
+
+    truncated = rows.total_rows is not None and num_rows < rows.total_rows
+    if not batches:
+        df = pd.DataFrame(columns=[field.name for field in rows.schema])
+    else:
+        table = pa.Table.from_batches(batches)
+        del batches
+        df = table.to_pandas(
+            self_destruct=True,
+            split_blocks=True,
+            types_mapper=_TYPES_MAPPER.get,
+        )
+        del table
+    if truncated:
+        logger.warning(
+            "Query result truncated to %d of %d rows (%d bytes)",
+            num_rows,
+            rows.total_rows,
+            num_bytes,
+        )
+    df.attrs["truncated"] = truncated
+    return df
+
+
+def compact_dtypes(
+    df: pd.DataFrame,
+    category_max_unique_ratio: float = CATEGORY_MAX_UNIQUE_RATIO,
+    downcast_numbers: bool = False,
+) -> pd.DataFrame:
+    """A copy of a DataFrame that is smaller to store or transfer.
+
+    String columns with few unique values are converted to categoricals. Only
+    for copies that agent code doesn't compute with, as categoricals reject
+    new values. If `downcast_numbers`, integers are also downcast to the
+    smallest type that holds their values, which then overflows in
+    arithmetic, and floats to `float32` where no precision is lost.
+    """
+    columns = {}
+    for position, (column, series) in enumerate(df.items()):
+        dtype = series.dtype
+        if downcast_numbers and pd.api.types.is_integer_dtype(dtype):
+            columns[position] = pd.to_numeric(series, downcast="integer")
+        elif downcast_numbers and dtype == np.float64:
+            downcast = series.astype(np.float32)
+            if np.array_equal(downcast.to_numpy(), series.to_numpy(), equal_nan=True):
+                columns[position] = downcast
+        elif dtype == object and len(series) > 1:
+            if pd.api.types.infer_dtype(
+                series, skipna=True
+            ) == "string" and series.nunique() <= category_max_unique_ratio * len(
+                series
+            ):
+                columns[position] = series.astype("category")
+    if not columns:
+        return df
+    df = df.copy(deep=False)
+    for position, series in columns.items():
+        df.isetitem(position, series)
+    return df
+
+
+@lru_cache(maxsize=None)
+def get_bqstorage_client(client) -> Optional[object]:
+    """Create a BigQuery Storage Read API client, if the library is installed.
+
+    Clients are cached as creating one opens a new gRPC channel.
+    """
+    try:
+        from google.cloud import bigquery_storage
+    except ImportError:
+        logger.warning(
+            "google-cloud-bigquery-storage is not installed, "
+            "query results will be downloaded using the REST API"
+        )
+        return None
+    return bigquery_storage.BigQueryReadClient(credentials=client._credentials)
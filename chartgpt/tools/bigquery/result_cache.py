@@ -0,0 +1,149 @@
+"""Size-bounded on-disk cache of BigQuery query results stored as Parquet."""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+import pandas as pd
+import sqlparse
+from sqlparse import tokens as T
+
+logger = logging.getLogger(__name__)
+
+QUERY_CACHE_ENABLED = os.environ.get("QUERY_CACHE_ENABLED", "true").lower() == "true"
+QUERY_CACHE_DIR = os.environ.get("QUERY_CACHE_DIR", "cache/query_results")
+QUERY_CACHE_MAX_BYTES = int(os.environ.get("QUERY_CACHE_MAX_BYTES", 1024**3))
+
+
+def normalize_sql(sql: str) -> str:
+    """Normalize SQL so that formatting differences share a cache entry.
+
+    Comments are removed, whitespace is collapsed and keywords are upper-cased,
+    while string literals and identifiers are left untouched.
+    """
+    normalized = []
+    for token in sqlparse.parse(sql)[0].flatten() if sql.strip() else []:
+        if token.ttype in T.Comment:
+            continue
+        if token.is_whitespace:
+            if normalized and normalized[-1] != " ":
+                normalized.append(" ")
+        elif token.is_keyword:
+            normalized.append(token.normalized.upper())
+        else:
+            normalized.append(token.value)
+    return "".join(normalized).strip().rstrip(";").strip()
+
+
+class QueryResultCache:
+    """LRU cache of query results keyed by SQL and referenced table versions.
+
+    Results are stored as `<key>.parquet` with a `<key>.json` sidecar holding
+    the bytes processed by the original query, so that cache hits can report
+    how many bytes were saved. The least recently used results are evicted
+    when the total size of the cache exceeds `max_bytes`.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # key -> size in bytes, ordered from least to most recently used
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        self._size = 0
+        self._load_index()
+
+    @staticmethod
+    def key(sql: str, table_versions: Iterable[Tuple[str, Optional[int]]]) -> str:
+        """Cache key for a query over tables with the given last modified times."""
+        payload = json.dumps(
+            [normalize_sql(sql), sorted(table_versions, key=lambda v: v[0])]
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    @property
+    def size(self) -> int:
+        """Total size in bytes of cached results."""
+        return self._size
+
+    def get(self, key: str) -> Optional[Tuple[pd.DataFrame, Dict]]:
+        """Return the cached DataFrame and its metadata, or None on a miss."""
+        with self._lock:
+            if key not in self._index:
+                return None
+            self._index.move_to_end(key)
+        parquet_path, metadata_path = self._paths(key)
+        try:
+            df = pd.read_parquet(parquet_path)
+            with open(metadata_path, "r") as f:
+                metadata = json.load(f)
+            os.utime(parquet_path)
+        except (OSError, ValueError):
+            logger.exception("Failed to read cached query result %s", key)
+            self._remove(key)
+            return None
+        return df, metadata
+
+    def put(self, key: str, df: pd.DataFrame, metadata: Dict) -> bool:
+        """Store a query result, returning False if it couldn't be serialized."""
+        parquet_path, metadata_path = self._paths(key)
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            df.to_parquet(parquet_path)
+            with open(metadata_path, "w") as f:
+                json.dump(metadata, f)
+        except Exception:
+            # E.g. object columns with mixed types can't be stored as Parquet
+            logger.exception("Failed to cache query result %s", key)
+            self._remove(key)
+            return False
+        size = os.path.getsize(parquet_path)
+        with self._lock:
+            self._size += size - self._index.get(key, 0)
+            self._index[key] = size
+            self._index.move_to_end(key)
+            evicted = []
+            while self._size > self.max_bytes and len(self._index) > 1:
+                evicted_key, evicted_size = self._index.popitem(last=False)
+                self._size -= evicted_size
+                evicted.append(evicted_key)
+        for evicted_key in evicted:
+            self._remove(evicted_key)
+        return True
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        base = os.path.join(self.directory, key)
+        return base + ".parquet", base + ".json"
+
+    def _remove(self, key: str) -> None:
+        with self._lock:
+            self._size -= self._index.pop(key, 0)
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _load_index(self) -> None:
+        if not os.path.isdir(self.directory):
+            return
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".parquet"):
+                stat = entry.stat()
+                entries.append(
+                    (stat.st_mtime, entry.name[: -len(".parquet")], stat.st_size)
+                )
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._size += size
+
+
+query_result_cache = QueryResultCache(
+    directory=QUERY_CACHE_DIR,
+    max_bytes=QUERY_CACHE_MAX_BYTES,
+)
@@ -0,0 +1,142 @@
+"""Rewrites of agent-generated SQL that bound the cost of running it."""
+
+import re
+from typing import Iterable, Optional
+
+import sqlparse
+from sqlparse import tokens as T
+
+from chartgpt.agents.agent_toolkits.bigquery.schema_cache import TableMetadata
+
+# Keywords that may directly follow a table reference without an alias
+_CLAUSE_KEYWORDS = {
+    "CROSS",
+    "FOR",
+    "FULL",
+    "GROUP",
+    "HAVING",
+    "INNER",
+    "JOIN",
+    "LEFT",
+    "LIMIT",
+    "ON",
+    "ORDER",
+    "QUALIFY",
+    "RIGHT",
+    "TABLESAMPLE",
+    "UNION",
+    "USING",
+    "WHERE",
+    "WINDOW",
+    "EXCEPT",
+    "INTERSECT",
+    "PIVOT",
+    "UNPIVOT",
+    "SET",
+}
+
+
+def has_limit(sql: str) -> bool:
+    """Whether the outermost query of a statement has a LIMIT clause."""
+    statements = sqlparse.parse(sql)
+    if not statements:
+        return False
+    # Subqueries are grouped into parentheses, so only top-level tokens count
+    return any(
+        token.ttype in T.Keyword and token.normalized == "LIMIT"
+        for token in statements[0].tokens
+    )
+
+
+def add_limit(sql: str, limit: int) -> str:
+    """Add a LIMIT to the outermost query if it doesn't already have one."""
+    if has_limit(sql):
+        return sql
+    # A newline ensures a trailing line comment doesn't comment out the LIMIT
+    return f"{sql.rstrip().rstrip(';')}\nLIMIT {limit}"
+
+
+def _mask_literals_and_comments(sql: str) -> str:
+    """The SQL with string literals and comments blanked out.
+
+    Has the same length, so that positions of code found in it are the same
+    in the SQL. Comments become spaces, and literals a character that can't
+    be part of an identifier or whitespace.
+    """
+    masked = []
+    for ttype, value in sqlparse.lexer.tokenize(sql):
+        if ttype in T.Comment:
+            masked.append(re.sub(r"\S", " ", value))
+        elif ttype in T.Literal.String:
+            masked.append("\x00" * len(value))
+        else:
+            masked.append(value)
+    return "".join(masked)
+
+
+def _partition_filter(table: TableMetadata, lookback_days: int) -> Optional[str]:
+    if not table.partition_type:
+        return None
+    if table.partition_field:
+        column = f"`{table.partition_field}`"
+        field_type = next(
+            (
+                field_type
+                for name, field_type, _ in table.fields
+                if name == table.partition_field
+            ),
+            None,
+        )
+    else:
+        # Ingestion-time partitioned tables are filtered on a pseudo column
+        column = "_PARTITIONTIME"
+        field_type = "TIMESTAMP"
+    # The cutoff is a whole day so that rewritten queries can be cached
+    cutoff = f"DATE_SUB(CURRENT_DATE(), INTERVAL {lookback_days} DAY)"
+    if field_type == "DATE":
+        return f"{column} >= {cutoff}"
+    if field_type in ("DATETIME", "TIMESTAMP"):
+        return f"{column} >= {field_type}({cutoff})"
+    return None
+
+
+def add_partition_filters(
+    sql: str, tables: Iterable[TableMetadata], lookback_days: int
+) -> str:
+    """Restrict time-partitioned tables to their most recent partitions.
+
+    Each reference to a partitioned table is replaced by a subquery that
+    filters on the partitioning column, which BigQuery uses to prune the
+    partitions that are scanned. References keep their alias, or are aliased
+    with the table name so that qualified column names still resolve. Table
+    names in string literals and comments are left alone.
+    """
+    for table in tables:
+        partition_filter = _partition_filter(table, lookback_days)
+        if partition_filter is None:
+            continue
+        project, dataset_id, table_id = table.table_id.split(".")
+        reference = re.compile(
+            rf"(?:`{re.escape(table.table_id)}`"
+            rf"|`{re.escape(project)}`\.`{re.escape(dataset_id)}`\.`{re.escape(table_id)}`"
+            rf"|\b{re.escape(table.table_id)}\b)"
+            # Alias, if any, following the table reference
+            r"(?P<alias>\s+(?:AS\s+)?`?(?P<name>\w+)`?)?",
+            re.IGNORECASE,
+        )
+
+        subquery = f"(SELECT * FROM `{table.table_id}` WHERE {partition_filter})"
+        rewritten = []
+        end = 0
+        for match in reference.finditer(_mask_literals_and_comments(sql)):
+            rewritten.append(sql[end : match.start()])
+            # From the SQL rather than the match, which has comments blanked
+            alias = sql[match.start("alias") : match.end("alias")]
+            if alias and match.group("name").upper() not in _CLAUSE_KEYWORDS:
+                rewritten.append(subquery + alias)
+            else:
+                rewritten.append(f"{subquery} AS `{table_id}`{alias}")
+            end = match.end()
+        rewritten.append(sql[end:])
+        sql = "".join(rewritten)
+    return sql
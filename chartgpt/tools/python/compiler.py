@@ -0,0 +1,82 @@
+"""Compilation and execution of Python REPL queries."""
+
+import ast
+import logging
+import os
+import time
+from contextlib import redirect_stdout
+from functools import lru_cache
+from io import StringIO
+from types import CodeType
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+from chartgpt.tools.python.secure_ast import analyze_ast
+
+logger = logging.getLogger(__name__)
+
+# Number of compiled queries kept, shared by all sessions
+REPL_CODE_CACHE_SIZE = int(os.environ.get("REPL_CODE_CACHE_SIZE", 256))
+
+
+class CompiledQuery(NamedTuple):
+    """Code objects for a REPL query, split so the last line can be displayed."""
+
+    body: CodeType
+    last: Optional[CodeType]
+    # Whether `last` was compiled in "eval" mode and returns the line's value
+    last_is_expression: bool
+
+
+@lru_cache(maxsize=REPL_CODE_CACHE_SIZE)
+def compile_query(query: str, secure: bool) -> CompiledQuery:
+    """Parse, validate and compile a query once.
+
+    Compiled queries are memoized, so that retries of identical code skip
+    all three phases. Validation errors aren't cached and are raised again.
+    """
+    start = time.perf_counter()
+    tree = ast.parse(query, filename="<ast>", mode="exec")
+    parsed_at = time.perf_counter()
+    if secure:
+        analyze_ast(tree)
+    validated_at = time.perf_counter()
+
+    body = compile(
+        ast.Module(tree.body[:-1], type_ignores=[]), filename="<ast>", mode="exec"
+    )
+    last = None
+    last_is_expression = False
+    if tree.body and isinstance(tree.body[-1], ast.Expr):
+        last = compile(
+            ast.Expression(tree.body[-1].value), filename="<ast>", mode="eval"
+        )
+        last_is_expression = True
+    elif tree.body:
+        last = compile(
+            ast.Module(tree.body[-1:], type_ignores=[]), filename="<ast>", mode="exec"
+        )
+    logger.info(
+        "Compiled %d line query: parse %.2f ms, validate %.2f ms, compile %.2f ms",
+        query.count("\n") + 1,
+        (parsed_at - start) * 1000,
+        (validated_at - parsed_at) * 1000,
+        (time.perf_counter() - validated_at) * 1000,
+    )
+    return CompiledQuery(body, last, last_is_expression)
+
+
+def run_compiled(
+    compiled: CompiledQuery, namespace: Dict[str, Any]
+) -> Tuple[Optional[Any], str]:
+    """Run a compiled query, returning the value of its last line and stdout."""
+    exec(compiled.body, namespace, namespace)
+    io_buffer = StringIO()
+    with redirect_stdout(io_buffer):
+        if compiled.last is None:
+            ret = None
+        elif compiled.last_is_expression:
+            ret = eval(compiled.last, namespace, namespace)
+        else:
+            exec(compiled.last, namespace, namespace)
+            ret = None
+    return ret, io_buffer.getvalue()
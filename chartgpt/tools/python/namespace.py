@@ -0,0 +1,35 @@
+"""Namespace that agent code runs in, seeded once per session."""
+
+from typing import Any, Dict
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+import streamlit as st
+
+# Pandas options are global, so they only need setting once per process
+pd.set_option("display.max_columns", None)
+pd.set_option("display.max_rows", 5)
+
+
+def display(*args):
+    st.write(*args)
+    return args
+
+
+def create_namespace(**variables: Any) -> Dict[str, Any]:
+    """Create REPL locals with the modules and helpers agent code expects.
+
+    Seeding these once per session means agent code doesn't need to import
+    them, so they aren't run and validated again on every agent step.
+    """
+    return {
+        "st": st,
+        "px": px,
+        "go": go,
+        "pd": pd,
+        "np": np,
+        "display": display,
+        **variables,
+    }
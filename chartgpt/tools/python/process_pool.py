@@ -0,0 +1,417 @@
+"""Execution backend that runs agent code in a pool of worker processes.
+
+Enabled with `REPL_EXECUTION_BACKEND=process`. Heavy computations then run
+in parallel across cores instead of competing for the GIL of the Streamlit
+server, and are bounded by per-call CPU time and memory limits and a
+wall-clock timeout, after which the worker is restarted.
+"""
+
+import asyncio
+import atexit
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+import weakref
+from dataclasses import asdict
+from typing import Any, Dict, List, Sequence, Tuple
+
+import plotly.io as pio
+import pyarrow as pa
+import streamlit as st
+
+logger = logging.getLogger(__name__)
+
+REPL_EXECUTION_BACKEND = os.environ.get("REPL_EXECUTION_BACKEND", "thread")
+REPL_WORKERS = int(os.environ.get("REPL_WORKERS", os.cpu_count() or 1))
+REPL_CPU_TIME_LIMIT = float(os.environ.get("REPL_CPU_TIME_LIMIT", 60))  # seconds
+REPL_MEMORY_LIMIT = int(os.environ.get("REPL_MEMORY_LIMIT", 2 * 1024**3))  # bytes
+REPL_TIMEOUT = float(os.environ.get("REPL_TIMEOUT", 120))  # seconds
+
+# Seconds between attempts of an async call to take a busy worker
+WORKER_LOCK_POLL_INTERVAL = 0.05
+
+# Streamlit functions that agent code may call, replayed in the session
+REPLAYED_STREAMLIT_FUNCTIONS = frozenset(
+    {
+        "area_chart",
+        "bar_chart",
+        "caption",
+        "code",
+        "dataframe",
+        "error",
+        "header",
+        "info",
+        "json",
+        "line_chart",
+        "markdown",
+        "metric",
+        "plotly_chart",
+        "subheader",
+        "success",
+        "table",
+        "text",
+        "title",
+        "warning",
+        "write",
+    }
+)
+
+
+RESET_NOTICE = (
+    "Note: the Python session was restarted, "
+    "variables from previous steps were lost."
+)
+
+
+class WorkerError(Exception):
+    """Raised when a worker exits or times out while running code."""
+
+
+def _worker_main(conn) -> None:
+    # Imported in the worker only, as it patches plotly to record figures
+    from chartgpt.tools.python import worker
+
+    worker.main(conn)
+
+
+def _start_worker(context) -> Tuple[multiprocessing.Process, Any]:
+    parent_conn, child_conn = context.Pipe()
+    process = context.Process(target=_worker_main, args=(child_conn,), daemon=True)
+    process.start()
+    child_conn.close()
+    return process, parent_conn
+
+
+async def _wait_readable(conn) -> None:
+    """Wait until a connection has data to receive, using the event loop."""
+    if conn.poll():
+        return
+    loop = asyncio.get_running_loop()
+    readable = loop.create_future()
+
+    def on_readable():
+        if not readable.done():
+            readable.set_result(None)
+
+    loop.add_reader(conn.fileno(), on_readable)
+    try:
+        await readable
+    finally:
+        loop.remove_reader(conn.fileno())
+
+
+class ProcessPool:
+    """Fixed pool of worker processes, each serving one call at a time.
+
+    Workers are forked from a server that has already imported the worker
+    module, and with it pandas, plotly and the BigQuery client, so starting
+    or restarting a worker doesn't pay for those imports. Sessions stick to
+    the worker holding their namespace.
+    """
+
+    def __init__(
+        self,
+        size: int,
+        cpu_time_limit: float,
+        memory_limit: int,
+        timeout: float,
+    ):
+        self.size = size
+        self.cpu_time_limit = cpu_time_limit
+        self.memory_limit = memory_limit
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._context = None
+        self._workers: List[Tuple[multiprocessing.Process, Any]] = []
+        # Held while a worker runs a call, including while it is restarted
+        self._worker_locks = [threading.Lock() for _ in range(size)]
+        self._sessions = [0] * size
+        self._dropped: List[List[str]] = [[] for _ in range(size)]
+
+    def start(self) -> None:
+        with self._lock:
+            if self._workers:
+                return
+            start = time.perf_counter()
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                self._context = multiprocessing.get_context("forkserver")
+                self._context.set_forkserver_preload(["chartgpt.tools.python.worker"])
+            else:
+                self._context = multiprocessing.get_context("spawn")
+            self._workers = [_start_worker(self._context) for _ in range(self.size)]
+            atexit.register(self.shutdown)
+            logger.info(
+                "Started %d REPL workers in %.2f s",
+                self.size,
+                time.perf_counter() - start,
+            )
+
+    def shutdown(self) -> None:
+        with self._lock:
+            for process, conn in self._workers:
+                conn.close()
+                process.kill()
+            self._workers = []
+
+    def session(
+        self,
+        tables_summary: Dict,
+        bigquery_client: Any,
+        schema_columns: Sequence[Tuple] = (),
+    ) -> "ProcessSession":
+        """Create a session for an agent, assigned to the least used worker."""
+        self.start()
+        with self._lock:
+            index = min(range(self.size), key=self._sessions.__getitem__)
+            self._sessions[index] += 1
+        return ProcessSession(
+            self, index, tables_summary, bigquery_client, schema_columns
+        )
+
+    def run(self, index: int, message: Dict) -> Tuple[Dict, List[bytes]]:
+        """Send a message to a worker and wait for its response and blobs."""
+        with self._worker_locks[index]:
+            try:
+                conn = self._send(index, message)
+                if not conn.poll(self.timeout):
+                    raise self._timeout_error()
+                return self._receive(conn)
+            except (EOFError, OSError) as e:
+                self._restart(index)
+                raise WorkerError("The Python process exited unexpectedly") from e
+            except WorkerError:
+                self._restart(index)
+                raise
+
+    async def arun(self, index: int, message: Dict) -> Tuple[Dict, List[bytes]]:
+        """Like `run()`, but waits for the worker without blocking the loop."""
+        lock = self._worker_locks[index]
+        # Polled rather than acquired in a thread, which can't be cancelled
+        while not lock.acquire(blocking=False):
+            await asyncio.sleep(WORKER_LOCK_POLL_INTERVAL)
+        restart = False
+        try:
+            conn = self._send(index, message)
+            await asyncio.wait_for(_wait_readable(conn), self.timeout)
+            return self._receive(conn)
+        except asyncio.TimeoutError:
+            restart = True
+            raise self._timeout_error() from None
+        except (EOFError, OSError) as e:
+            restart = True
+            raise WorkerError("The Python process exited unexpectedly") from e
+        except asyncio.CancelledError:
+            # The worker's response would be read as the next call's
+            restart = True
+            raise
+        finally:
+            if restart:
+                # Killing, joining and forking a process blocks, so it's done
+                # in a thread, which releases the worker once it's restarted
+                asyncio.get_running_loop().run_in_executor(
+                    None, self._restart_and_release, index
+                )
+            else:
+                lock.release()
+
+    def release(self, index: int, session_id: str) -> None:
+        """Forget a session, dropping its namespace with the next message."""
+        with self._lock:
+            self._sessions[index] -= 1
+            self._dropped[index].append(session_id)
+
+    def _send(self, index: int, message: Dict):
+        with self._lock:
+            message["drop"], self._dropped[index] = self._dropped[index], []
+        process, conn = self._workers[index]
+        conn.send_bytes(json.dumps(message).encode())
+        return conn
+
+    def _receive(self, conn) -> Tuple[Dict, List[bytes]]:
+        # Blobs are sent right after the response, so they don't need waiting for
+        response = json.loads(conn.recv_bytes())
+        blobs = [conn.recv_bytes() for _ in range(response["blobs"])]
+        return response, blobs
+
+    def _timeout_error(self) -> WorkerError:
+        return WorkerError(
+            f"Code execution exceeded {self.timeout:.0f} seconds and was stopped"
+        )
+
+    def _restart_and_release(self, index: int) -> None:
+        try:
+            self._restart(index)
+        except Exception:
+            logger.exception("Failed to restart REPL worker %d", index)
+        finally:
+            self._worker_locks[index].release()
+
+    def _restart(self, index: int) -> None:
+        process, conn = self._workers[index]
+        logger.warning("Restarting REPL worker %d (pid %s)", index, process.pid)
+        conn.close()
+        process.kill()
+        process.join()
+        self._workers[index] = _start_worker(self._context)
+        with self._lock:
+            # Namespaces of the previous worker are already gone
+            self._dropped[index] = []
+
+
+class ProcessSession:
+    """Runs the code of one agent session in its worker of a `ProcessPool`.
+
+    Used as the `backend` of a `PythonAstREPLTool`. Results, Streamlit calls
+    and BigQuery statistics are decoded in the server, so that DataFrames and
+    figures are displayed and saved in the session as they are in-process.
+    """
+
+    def __init__(
+        self,
+        pool: ProcessPool,
+        index: int,
+        tables_summary: Dict,
+        bigquery_client: Any,
+        schema_columns: Sequence[Tuple] = (),
+    ):
+        self.id = uuid.uuid4().hex
+        self._pool = pool
+        self._index = index
+        self._bigquery_client = bigquery_client
+        self._seed = {
+            "tables_summary": dict(tables_summary),
+            "datasets": [
+                asdict(dataset) for dataset in getattr(bigquery_client, "datasets", [])
+            ],
+            "schema_columns": [list(column) for column in schema_columns],
+        }
+        self._seeded = False
+        self._notices: List[str] = []
+        weakref.finalize(self, pool.release, index, self.id)
+
+    def run(self, query: str, secure: bool) -> Any:
+        start = time.perf_counter()
+        try:
+            response, blobs = self._pool.run(self._index, self._message(query, secure))
+            if response.get("type") == "unknown_session":
+                self._on_unknown_session()
+                response, blobs = self._pool.run(
+                    self._index, self._message(query, secure)
+                )
+        except WorkerError as e:
+            return self._on_worker_error(e)
+        return self._handle(response, blobs, start)
+
+    async def arun(self, query: str, secure: bool) -> Any:
+        start = time.perf_counter()
+        try:
+            response, blobs = await self._pool.arun(
+                self._index, self._message(query, secure)
+            )
+            if response.get("type") == "unknown_session":
+                self._on_unknown_session()
+                response, blobs = await self._pool.arun(
+                    self._index, self._message(query, secure)
+                )
+        except WorkerError as e:
+            return self._on_worker_error(e)
+        # Replays Streamlit calls, so in a thread attached to the session
+        return await asyncio.to_thread(self._handle, response, blobs, start)
+
+    def _message(self, query: str, secure: bool) -> Dict:
+        message = {
+            "type": "run",
+            "session_id": self.id,
+            "query": query,
+            "secure": secure,
+            "cpu_time_limit": self._pool.cpu_time_limit,
+            "memory_limit": self._pool.memory_limit,
+        }
+        # The schema is large, so it's only sent until the worker has it
+        if not self._seeded:
+            message["seed"] = self._seed
+        return message
+
+    def _on_unknown_session(self) -> None:
+        # The worker lost the namespace, e.g. evicted or restarted by another call
+        if self._seeded:
+            self._notices.append(RESET_NOTICE)
+        self._seeded = False
+
+    def _on_worker_error(self, error: WorkerError) -> str:
+        self._notices.append(RESET_NOTICE)
+        # Already reported, the new worker mustn't report the reset again
+        self._seeded = False
+        return "{}: {}".format(type(error).__name__, str(error))
+
+    def _handle(self, response: Dict, blobs: List[bytes], start: float) -> Any:
+        self._seeded = True
+        logger.info(
+            "Ran query in worker %d in %.2f ms (%.2f ms in worker, %.2f s CPU, "
+            "%d bytes of DataFrames)",
+            response["pid"],
+            (time.perf_counter() - start) * 1000,
+            response["seconds"] * 1000,
+            response["cpu_seconds"],
+            sum(len(blob) for blob in blobs),
+        )
+        if hasattr(self._bigquery_client, "record"):
+            self._bigquery_client.record(response["queries"], response["notices"])
+
+        for render in response["renders"]:
+            args = [decode(arg, blobs) for arg in render["args"]]
+            kwargs = {
+                key: decode(value, blobs) for key, value in render["kwargs"].items()
+            }
+            if render["name"] == "show":
+                # Displayed and saved by the patched `Figure.show()`
+                args[0].show()
+            elif render["name"] in REPLAYED_STREAMLIT_FUNCTIONS:
+                getattr(st, render["name"])(*args, **kwargs)
+            else:
+                logger.warning("Ignored call to st.%s from worker", render["name"])
+
+        if response["error"]:
+            return response["error"]
+        if response["result"] is None:
+            return response["stdout"]
+        return decode(response["result"], blobs)
+
+    def pop_notices(self) -> List[str]:
+        notices, self._notices = self._notices, []
+        return notices
+
+
+def decode(value: Dict, blobs: List[bytes]) -> Any:
+    """Decode a value encoded by `chartgpt.tools.python.worker.Encoder`."""
+    value_type = value["type"]
+    if value_type in ("dataframe", "series"):
+        df = pa.ipc.open_stream(pa.py_buffer(blobs[value["blob"]])).read_all()
+        df = df.to_pandas()
+        for position in value.get("categorized", []):
+            df.isetitem(position, df.iloc[:, position].astype(object))
+        if value_type == "series":
+            series = df.iloc[:, 0]
+            series.name = value["name"]
+            return series
+        return df
+    if value_type == "figure":
+        return pio.from_json(value["json"])
+    if value_type in ("list", "tuple"):
+        items = [decode(item, blobs) for item in value["items"]]
+        return tuple(items) if value_type == "tuple" else items
+    if value_type == "dict":
+        return {key: decode(item, blobs) for key, item in value["items"].items()}
+    return value["value"]
+
+
+process_pool = ProcessPool(
+    size=REPL_WORKERS,
+    cpu_time_limit=REPL_CPU_TIME_LIMIT,
+    memory_limit=REPL_MEMORY_LIMIT,
+    timeout=REPL_TIMEOUT,
+)
@@ -3,208 +3,281 @@ import builtins
 
 from sentry_sdk import capture_exception
 
-allowed_builtins = {
-    "abs",
-    "bool",
-    "callable",
-    "chr",
-    "complex",
-    "divmod",
-    "float",
-    "hex",
-    "int",
-    "isinstance",
-    "len",
-    "max",
-    "min",
-    "oct",
-    "ord",
-    "pow",
-    "range",
-    "repr",
-    "round",
-    "sorted",
-    "str",
-    "sum",
-    "tuple",
-    "type",
-    "zip",
-    "__import__",
-    "print",
-    "list",
-    "dict",
-    "set",
-}
-
-insecure_functions = {
-    "open",
-    "exec",
-    "eval",
-    "compile",
-    "globals",
-    "locals",
-    "vars",
-    "dir",
-    "importlib",
-}
-
-disallowed_attributes = {
-    # Builtins
-    "os",
-    "sys",
-    "__import__",
-    # Streamlit
-    "session_state",
-    "secrets",
-}
-
-allowed_imports = {
-    "dataclass",
-    "pandas",
-    "random",
-    "streamlit",
-    "bigquery",
-    "plotly",
-    "plotly.express",
-    "plotly.graph_objs",
-    "plotly.graph_objects",
-    "plotly.io",
-    "numpy",
-    "math",
-    "Figure",
-    "make_subplots",
-    "datetime",
-    "timedelta",
-    # GPT suggested:
-    "google.cloud.bigquery",
-    "numpy",
-    "math",
-    "plotly.subplots",
-    # "matplotlib",
-    # "matplotlib.pyplot",
-    # "seaborn",
-    "scipy",
-    "scipy.stats",
-    "scipy.optimize",
-    "scikit-learn",
-    "sklearn",
-    "sklearn.preprocessing",
-    "sklearn.metrics",
-    "sklearn.model_selection",
-    "sklearn.linear_model",
-    "sklearn.tree",
-    "sklearn.ensemble",
-    "sklearn.cluster",
-    "sklearn.decomposition",
-    "statsmodels",
-    "statsmodels.api",
-    "statsmodels.formula.api",
-    "statsmodels.tsa.api",
-    "statsmodels.stats.api",
-    # "tensorflow",
-    # "tensorflow.keras",
-    # "keras",
-    # "keras.models",
-    # "keras.layers",
-    # "keras.optimizers",
-    # "keras.preprocessing",
-    # "keras.callbacks",
-    # "keras.utils",
-    # "keras.datasets",
-    # "pytorch",
-    # "torch",
-    # "torch.nn",
-    # "torch.optim",
-    # "torch.utils.data",
-    # "torchvision",
-    # "torchvision.transforms",
-    # "torchvision.datasets",
-    # "torchtext",
-    # "nltk",
-    "spacy",
-    "gensim",
-    "psycopg2",
-    "dash",
-    "dash_core_components",
-    "dash_html_components",
-    "dash.dependencies",
-    "dash_table",
-    "lxml",
-    "geopandas",
-    "shapely",
-    "networkx",
-    "bokeh",
-    "holoviews",
-    "altair",
-    "time",
-    "pyarrow",
-    "dask",
-    "dask.dataframe",
-    "h5py",
-    "json",
-    "pickle",
-    "csv",
-    "re",
-    # Types
-    "typing",
-    "Optional",
-    "List",
-    "Any",
-    "Union",
-}
-
-
-def allowed_node(node):
-    if isinstance(node, (ast.Import, ast.ImportFrom)):
+allowed_builtins = frozenset(
+    {
+        "abs",
+        "bool",
+        "callable",
+        "chr",
+        "complex",
+        "divmod",
+        "float",
+        "hex",
+        "int",
+        "isinstance",
+        "len",
+        "max",
+        "min",
+        "oct",
+        "ord",
+        "pow",
+        "range",
+        "repr",
+        "round",
+        "sorted",
+        "str",
+        "sum",
+        "tuple",
+        "type",
+        "zip",
+        "__import__",
+        "print",
+        "list",
+        "dict",
+        "set",
+    }
+)
+
+SAFE_BUILTINS = {name: getattr(builtins, name) for name in allowed_builtins}
+
+insecure_functions = frozenset(
+    {
+        "open",
+        "exec",
+        "eval",
+        "compile",
+        "globals",
+        "locals",
+        "vars",
+        "dir",
+        "importlib",
+    }
+)
+
+disallowed_attributes = frozenset(
+    {
+        # Builtins
+        "os",
+        "sys",
+        "__import__",
+        # Streamlit
+        "session_state",
+        "secrets",
+    }
+)
+
+allowed_imports = frozenset(
+    {
+        "dataclass",
+        "pandas",
+        "random",
+        "streamlit",
+        "bigquery",
+        "plotly",
+        "plotly.express",
+        "plotly.graph_objs",
+        "plotly.graph_objects",
+        "plotly.io",
+        "numpy",
+        "math",
+        "Figure",
+        "make_subplots",
+        "datetime",
+        "timedelta",
+        # GPT suggested:
+        "google.cloud.bigquery",
+        "numpy",
+        "math",
+        "plotly.subplots",
+        # "matplotlib",
+        # "matplotlib.pyplot",
+        # "seaborn",
+        "scipy",
+        "scipy.stats",
+        "scipy.optimize",
+        "scikit-learn",
+        "sklearn",
+        "sklearn.preprocessing",
+        "sklearn.metrics",
+        "sklearn.model_selection",
+        "sklearn.linear_model",
+        "sklearn.tree",
+        "sklearn.ensemble",
+        "sklearn.cluster",
+        "sklearn.decomposition",
+        "statsmodels",
+        "statsmodels.api",
+        "statsmodels.formula.api",
+        "statsmodels.tsa.api",
+        "statsmodels.stats.api",
+        # "tensorflow",
+        # "tensorflow.keras",
+        # "keras",
+        # "keras.models",
+        # "keras.layers",
+        # "keras.optimizers",
+        # "keras.preprocessing",
+        # "keras.callbacks",
+        # "keras.utils",
+        # "keras.datasets",
+        # "pytorch",
+        # "torch",
+        # "torch.nn",
+        # "torch.optim",
+        # "torch.utils.data",
+        # "torchvision",
+        # "torchvision.transforms",
+        # "torchvision.datasets",
+        # "torchtext",
+        # "nltk",
+        "spacy",
+        "gensim",
+        "psycopg2",
+        "dash",
+        "dash_core_components",
+        "dash_html_components",
+        "dash.dependencies",
+        "dash_table",
+        "lxml",
+        "geopandas",
+        "shapely",
+        "networkx",
+        "bokeh",
+        "holoviews",
+        "altair",
+        "time",
+        "pyarrow",
+        "dask",
+        "dask.dataframe",
+        "h5py",
+        "json",
+        "pickle",
+        "csv",
+        "re",
+        # Types
+        "typing",
+        "Optional",
+        "List",
+        "Any",
+        "Union",
+    }
+)
+
+
+class InsecureCodeError(ValueError):
+    """Raised with every violation found when validating code."""
+
+    def __init__(self, violations):
+        super().__init__("; ".join(violations))
+        self.violations = violations
+
+
+def _child_fields(node_type):
+    # Expression contexts (Load, Store, Del) and constants never need checking
+    if node_type is ast.Constant:
+        return ()
+    return tuple(name for name in node_type._fields if name != "ctx")
+
+
+class _Validator:
+    """Single pass over an AST that collects security violations.
+
+    Nodes are visited iteratively with an explicit stack, so that large
+    generated scripts can't exceed the recursion limit, and only node types
+    with a `visit_<type>` method are checked. The child fields and visitor of
+    each node type are looked up once per type.
+    """
+
+    _node_types = {}
+
+    def __init__(self):
+        self.violations = []
+        # Attributes already checked as part of an enclosing chain
+        self._resolved = set()
+
+    def validate(self, tree, max_depth=float("inf")):
+        node_types = self._node_types
+        stack = [(tree, 0)]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            node, depth = pop()
+            if not isinstance(node, ast.AST) or depth >= max_depth:
+                # E.g. None for missing dictionary keys, or names in `global`
+                continue
+            node_type = type(node)
+            if node_type not in node_types:
+                node_types[node_type] = (
+                    _child_fields(node_type),
+                    getattr(_Validator, "visit_" + node_type.__name__, None),
+                )
+            fields, visitor = node_types[node_type]
+            if visitor is not None:
+                visitor(self, node)
+            depth += 1
+            for name in fields:
+                value = getattr(node, name, None)
+                if type(value) is list:
+                    for child in value:
+                        push((child, depth))
+                elif value is not None:
+                    push((value, depth))
+        # The same violation is only reported once
+        return list(dict.fromkeys(self.violations))
+
+    def visit_Import(self, node):
         for alias in node.names:
             if alias.name not in allowed_imports:
-                raise ValueError(f"Importing '{alias.name}' is not allowed")
+                self.violations.append(f"Importing '{alias.name}' is not allowed")
+
+    visit_ImportFrom = visit_Import
 
-    if isinstance(node, ast.Call):
+    def visit_Call(self, node):
+        if not isinstance(node.func, ast.Name):
+            return
         # Check for the '__import__' function
-        if isinstance(node.func, ast.Name) and node.func.id == "__import__":
-            if isinstance(node.args[0], ast.Str):
-                if node.args[0].s not in allowed_imports:
-                    raise ValueError(
-                        f"Dynamic importing '{node.args[0].s}' is not allowed"
-                    )
+        if node.func.id == "__import__":
+            if (
+                node.args
+                and isinstance(node.args[0], ast.Constant)
+                and isinstance(node.args[0].value, str)
+                and node.args[0].value not in allowed_imports
+            ):
+                self.violations.append(
+                    f"Dynamic importing '{node.args[0].value}' is not allowed"
+                )
         # Check for other insecure functions
-        elif isinstance(node.func, ast.Name) and node.func.id in insecure_functions:
-            raise ValueError(f"Function '{node.func.id}' is not allowed")
-
-    if isinstance(node, ast.Attribute):
-        full_name = []
-        n = node
-        while isinstance(n, ast.Attribute):
-            full_name.insert(0, n.attr)
-            n = n.value
-        if isinstance(n, ast.Name):
-            full_name.insert(0, n.id)
-        full_attr_name = ".".join(full_name)
-        if full_attr_name in disallowed_attributes:
-            raise ValueError(f"Accessing '{full_attr_name}' is not allowed")
-
-    if isinstance(node, (ast.Attribute, ast.Name)):
-        if (
-            (node.attr.startswith("._") or node.attr.startswith(".__"))
-            if hasattr(node, "attr")
-            else (node.id.startswith("._") or node.id.startswith(".__"))
-        ):
-            raise ValueError(f"Accessing private members is not allowed")
-
-
-def analyze_ast(node, max_depth=float("inf"), current_depth=0):
-    if current_depth >= max_depth:
-        return
-
-    try:
-        if isinstance(node, ast.AST):
-            allowed_node(node)
-            for child in ast.iter_child_nodes(node):
-                analyze_ast(child, max_depth, current_depth + 1)
-    except Exception as e:
-        capture_exception(e)
-        raise e
+        elif node.func.id in insecure_functions:
+            self.violations.append(f"Function '{node.func.id}' is not allowed")
+
+    def visit_Attribute(self, node):
+        if node.attr.startswith("_"):
+            self.violations.append("Accessing private members is not allowed")
+        if id(node) in self._resolved:
+            return
+        # Resolve the dotted name of the whole chain, e.g. `a.b.c`, once from
+        # its outermost attribute, and check it and each of its prefixes
+        chain = []
+        value = node
+        while isinstance(value, ast.Attribute):
+            self._resolved.add(id(value))
+            chain.append(value.attr)
+            value = value.value
+        full_name = [value.id] if isinstance(value, ast.Name) else []
+        for attr in reversed(chain):
+            full_name.append(attr)
+            full_attr_name = ".".join(full_name)
+            if full_attr_name in disallowed_attributes:
+                self.violations.append(f"Accessing '{full_attr_name}' is not allowed")
+
+
+def analyze_ast(node, max_depth=float("inf")):
+    """Raise `InsecureCodeError` listing every violation in the tree."""
+    violations = _Validator().validate(node, max_depth)
+    if violations:
+        error = InsecureCodeError(violations)
+        capture_exception(error)
+        raise error
 
 
 def assert_secure_code(code, mode="exec", max_depth=float("inf")):
@@ -213,9 +286,14 @@ def assert_secure_code(code, mode="exec", max_depth=float("inf")):
     analyze_ast(tree, max_depth)
 
 
+def restrict_builtins(custom_globals):
+    """Limit the builtins available to code run with `custom_globals`."""
+    # Copied so that executed code can't modify the builtins of other sessions
+    custom_globals["__builtins__"] = dict(SAFE_BUILTINS)
+
+
 def secure_exec(code, custom_globals={}, custom_locals={}, max_depth=float("inf")):
-    safe_builtins = {name: getattr(builtins, name) for name in allowed_builtins}
-    custom_globals["__builtins__"] = safe_builtins
+    restrict_builtins(custom_globals)
 
     tree = ast.parse(code, mode="exec")
     analyze_ast(tree, max_depth)
@@ -224,8 +302,7 @@ def secure_exec(code, custom_globals={}, custom_locals={}, max_depth=float("inf"
 
 
 def secure_eval(expr, custom_globals={}, custom_locals={}, max_depth=float("inf")):
-    safe_builtins = {name: getattr(builtins, name) for name in allowed_builtins}
-    custom_globals["__builtins__"] = safe_builtins
+    restrict_builtins(custom_globals)
 
     tree = ast.parse(expr, mode="eval")
     analyze_ast(tree, max_depth)
@@ -1,21 +1,27 @@
 """A tool for running python code in a REPL."""
 
-import ast
+import asyncio
+import logging
 import re
 import sys
-import traceback
+import time
 from collections.abc import Callable
-from contextlib import redirect_stdout
-from io import StringIO
-from typing import Dict, Optional
+from typing import Any, Dict, List, Optional
 
 import streamlit as st
-from langchain.callbacks.manager import CallbackManagerForToolRun
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForToolRun,
+    CallbackManagerForToolRun,
+)
 from langchain.tools.base import BaseTool
 from pydantic import Field, root_validator
 
-import app
-from chartgpt.tools.python.secure_ast import secure_eval, secure_exec
+from chartgpt import tracing
+from chartgpt.data.preview import to_text
+from chartgpt.tools.python.compiler import compile_query, run_compiled
+from chartgpt.tools.python.secure_ast import restrict_builtins
+
+logger = logging.getLogger(__name__)
 
 
 def sanitize_input(query: str) -> str:
@@ -50,7 +56,11 @@ class PythonAstREPLTool(BaseTool):
     globals: Optional[Dict] = Field(default_factory=dict)
     sanitize_input: bool = True
     query_post_processing: Optional[Callable[[str], str]] = None
+    # Returns notices to append to the observation, e.g. about rewritten queries
+    observation_notices: Optional[Callable[[], List[str]]] = None
     secure_execution: bool = True
+    # Runs queries elsewhere, e.g. a `ProcessSession`, instead of in `locals`
+    backend: Optional[Any] = None
 
     @root_validator(pre=True, allow_reuse=True)
     def validate_python_version(cls, values: Dict) -> Dict:
@@ -70,72 +80,84 @@ class PythonAstREPLTool(BaseTool):
     ) -> str:
         """Use the tool."""
         try:
-            if self.sanitize_input:
-                query = sanitize_input(query)
-            if self.query_post_processing:
-                query = self.query_post_processing(query)
+            # Spans of BigQuery jobs run by the code are children of this call
+            with tracing.activate(run_manager.run_id if run_manager else None):
+                observation = self._execute(self._prepare(query))
+        finally:
+            self._reset_container()
+        return self._add_notices(observation)
+
+    async def _arun(
+        self,
+        query: str,
+        run_manager: Optional[AsyncCallbackManagerForToolRun] = None,
+    ) -> str:
+        """Use the tool asynchronously.
+
+        Code runs in a thread, or in the backend's worker process if it can be
+        awaited, so the event loop is free for other sessions meanwhile.
+        """
+        query = self._prepare(query)
+        try:
+            with tracing.activate(run_manager.run_id if run_manager else None):
+                if hasattr(self.backend, "arun"):
+                    observation = await self._aexecute(query)
+                else:
+                    observation = await asyncio.to_thread(self._execute, query)
+        finally:
+            await asyncio.to_thread(self._reset_container)
+        return self._add_notices(observation)
+
+    def _prepare(self, query: str) -> str:
+        if self.sanitize_input:
+            query = sanitize_input(query)
+        if self.query_post_processing:
+            query = self.query_post_processing(query)
+        logger.debug("Raw query:\n\n%s", query)
+        return query
+
+    def _execute(self, query: str):
+        try:
+            if self.backend is not None:
+                return self.backend.run(query, self.secure_execution)
+
+            start = time.perf_counter()
+            compiled = compile_query(query, self.secure_execution)
+            compiled_at = time.perf_counter()
             self.globals = self.locals
-            app.logger.info(
-                "Executing `exec(ast.unparse(module), self.globals, self.locals)`"
-            )
-            app.logger.info("Raw query:\n\n%s", query)
-            tree = ast.parse(query)
-            module = ast.Module(tree.body[:-1], type_ignores=[])
-            app.logger.info(ast.unparse(module))
             if self.secure_execution:
-                secure_exec(
-                    ast.unparse(module),
-                    custom_globals=self.globals,
-                    custom_locals=self.locals,
-                )
-            else:
-                exec(ast.unparse(module), self.globals, self.locals)  # type: ignore
-            module_end = ast.Module(tree.body[-1:], type_ignores=[])
-            module_end_str = ast.unparse(module_end)  # type: ignore
-            io_buffer = StringIO()
-            try:
-                with redirect_stdout(io_buffer):
-                    app.logger.info(
-                        "Executing `eval(module_end_str, self.globals, self.locals)`"
-                    )
-                    app.logger.info(module_end_str)
-                    if self.secure_execution:
-                        ret = secure_eval(
-                            module_end_str,
-                            custom_globals=self.globals,
-                            custom_locals=self.locals,
-                        )
-                    else:
-                        ret = eval(module_end_str, self.globals, self.locals)
-                    if ret is None:
-                        return io_buffer.getvalue()
-                    else:
-                        return ret
-            except Exception as e:
-                app.logger.info(e)
-                with redirect_stdout(io_buffer):
-                    app.logger.info(
-                        "Executing `eval(module_end_str, self.globals, self.locals)`"
-                    )
-                    app.logger.info(module_end_str)
-                    if self.secure_execution:
-                        secure_exec(
-                            module_end_str,
-                            custom_globals=self.globals,
-                            custom_locals=self.locals,
-                        )
-                    else:
-                        exec(module_end_str, self.globals, self.locals)
-                return io_buffer.getvalue()
+                restrict_builtins(self.globals)
+            ret, stdout = run_compiled(compiled, self.locals)
+            # Compile time is close to zero when the query was memoized
+            logger.info(
+                "Ran query in %.2f ms (compile %.2f ms)",
+                (time.perf_counter() - start) * 1000,
+                (compiled_at - start) * 1000,
+            )
+            if ret is None:
+                return stdout
+            return ret
         except Exception as e:
-            app.logger.info(e)
+            logger.info(e)
             return "{}: {}".format(type(e).__name__, str(e))
-        finally:
-            # Clear Streamlit output and start on new line
-            st.session_state["container"].text("")
-            st.session_state["text"] = "\n\n"
-            st.session_state["empty_container"] = st.session_state["container"].empty()
-
-    async def _arun(self, query: str) -> str:
-        """Use the tool asynchronously."""
-        raise NotImplementedError("PythonAstReplTool does not support async")
+
+    async def _aexecute(self, query: str):
+        try:
+            return await self.backend.arun(query, self.secure_execution)
+        except Exception as e:
+            logger.info(e)
+            return "{}: {}".format(type(e).__name__, str(e))
+
+    def _reset_container(self) -> None:
+        # Clear Streamlit output and start on new line
+        st.session_state["container"].text("")
+        st.session_state["text"] = "\n\n"
+        st.session_state["empty_container"] = st.session_state["container"].empty()
+
+    def _add_notices(self, observation: Any) -> Any:
+        notices = self.observation_notices() if self.observation_notices else []
+        if self.backend is not None:
+            notices += self.backend.pop_notices()
+        if notices:
+            return "\n".join([to_text(observation), *notices])
+        return observation
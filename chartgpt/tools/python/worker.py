@@ -0,0 +1,283 @@
+"""Worker process that runs agent code for the process execution backend.
+
+Workers keep a namespace per agent session, so variables persist between
+agent steps as they do in-process. Messages are JSON, followed by any binary
+blobs such as DataFrames as Arrow IPC streams, so that nothing sent by the
+worker is unpickled by the Streamlit server. Calls to Streamlit and to
+`Figure.show()` are recorded and replayed in the session by the server.
+"""
+
+import json
+import logging
+import math
+import os
+import resource
+import signal
+import time
+from collections import OrderedDict
+from multiprocessing.connection import Connection
+from typing import Any, Dict, List, Optional, Tuple
+
+import pandas as pd
+import plotly.io as pio
+import pyarrow as pa
+from plotly.basedatatypes import BaseFigure
+from plotly.graph_objs import Figure
+
+from api.connectors.bigquery import bigquery_client
+from config.datasets import Dataset
+from chartgpt.agents.agent_toolkits.bigquery.schema_retriever import SchemaRetriever
+from chartgpt.tools.bigquery.client import ReplBigQueryClient
+from chartgpt.tools.bigquery.dataframe import compact_dtypes
+from chartgpt.tools.python.compiler import compile_query, run_compiled
+from chartgpt.tools.python.namespace import create_namespace
+from chartgpt.tools.python.secure_ast import restrict_builtins
+
+logger = logging.getLogger(__name__)
+
+# Namespaces kept per worker, in case sessions aren't dropped by the server
+MAX_NAMESPACES = 32
+
+
+class CPUTimeLimitError(Exception):
+    """Raised when agent code uses more CPU time than allowed for a call."""
+
+
+class Encoder:
+    """Encodes values as JSON, with DataFrames as separate Arrow blobs."""
+
+    def __init__(self):
+        self.blobs: List[pa.Buffer] = []
+
+    def encode(self, value: Any) -> Dict:
+        if isinstance(value, pd.Series):
+            blob, categorized = self._add_dataframe(value.to_frame())
+            return {
+                "type": "series",
+                "blob": blob,
+                "categorized": categorized,
+                "name": None if value.name is None else str(value.name),
+            }
+        if isinstance(value, pd.DataFrame):
+            blob, categorized = self._add_dataframe(value)
+            return {"type": "dataframe", "blob": blob, "categorized": categorized}
+        if isinstance(value, BaseFigure):
+            return {"type": "figure", "json": value.to_json()}
+        if value is None or isinstance(value, (str, bool, int, float)):
+            return {"type": "value", "value": value}
+        if isinstance(value, (list, tuple)):
+            return {
+                "type": type(value).__name__,
+                "items": [self.encode(item) for item in value],
+            }
+        if isinstance(value, dict) and all(isinstance(key, str) for key in value):
+            return {
+                "type": "dict",
+                "items": {key: self.encode(item) for key, item in value.items()},
+            }
+        return {"type": "text", "value": repr(value)}
+
+    def _add_dataframe(self, df: pd.DataFrame) -> Tuple[int, List[int]]:
+        # Low-cardinality strings are sent dictionary encoded, and the
+        # positions of those columns are returned so they can be restored
+        compact = compact_dtypes(df)
+        categorized = [
+            position
+            for position, (before, after) in enumerate(zip(df.dtypes, compact.dtypes))
+            if isinstance(after, pd.CategoricalDtype)
+            and not isinstance(before, pd.CategoricalDtype)
+        ]
+        try:
+            table = pa.Table.from_pandas(compact)
+        except (pa.ArrowException, TypeError, ValueError):
+            # E.g. object columns holding mixed types
+            table = pa.Table.from_pandas(df.astype(str))
+            categorized = []
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        self.blobs.append(sink.getvalue())
+        return len(self.blobs) - 1, categorized
+
+
+class StreamlitRecorder:
+    """Stand-in for the `streamlit` module that records calls to replay."""
+
+    def __init__(self):
+        self.renders: List[Dict] = []
+        self.encoder = Encoder()
+
+    def reset(self) -> None:
+        self.renders = []
+        self.encoder = Encoder()
+
+    def record(self, name: str, *args, **kwargs) -> None:
+        # Encoded immediately, as agent code may modify the arguments later
+        self.renders.append(
+            {
+                "name": name,
+                "args": [self.encoder.encode(arg) for arg in args],
+                "kwargs": {
+                    key: self.encoder.encode(value) for key, value in kwargs.items()
+                },
+            }
+        )
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.record(name, *args, **kwargs)
+
+
+# Recorder of the session whose code is running, for `Figure.show()`
+_active_recorder: Optional[StreamlitRecorder] = None
+
+
+def _show(figure, *args, **kwargs) -> None:
+    if _active_recorder is not None:
+        _active_recorder.record("show", figure)
+
+
+class SessionNamespace:
+    """Namespace and BigQuery client of one agent session."""
+
+    def __init__(self, seed: Dict):
+        self.recorder = StreamlitRecorder()
+        self.bigquery_client = ReplBigQueryClient(
+            bigquery_client,
+            datasets=[Dataset(**dataset) for dataset in seed["datasets"]],
+        )
+
+        def display(*args):
+            self.recorder.record("write", *args)
+            return args
+
+        # JSON turns the (name, description) tuples of the summary into lists
+        tables_summary = {
+            dataset_id: {
+                table_id: [tuple(column) for column in columns]
+                for table_id, columns in tables.items()
+            }
+            for dataset_id, tables in seed["tables_summary"].items()
+        }
+        self.locals = create_namespace(
+            tables_summary=tables_summary,
+            bigquery_client=self.bigquery_client,
+            describe_columns=SchemaRetriever(seed["schema_columns"]).describe_columns,
+        )
+        self.locals["st"] = self.recorder
+        self.locals["display"] = display
+
+
+def _address_space() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[0]) * resource.getpagesize()
+    except OSError:
+        return None
+
+
+def _set_limits(cpu_time_limit: float, memory_limit: int) -> None:
+    if cpu_time_limit:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        used = usage.ru_utime + usage.ru_stime
+        resource.setrlimit(
+            resource.RLIMIT_CPU,
+            (math.ceil(used + cpu_time_limit), resource.RLIM_INFINITY),
+        )
+    address_space = _address_space()
+    if memory_limit and address_space is not None:
+        # Allocations beyond the limit raise MemoryError in agent code
+        resource.setrlimit(
+            resource.RLIMIT_AS,
+            (address_space + memory_limit, resource.RLIM_INFINITY),
+        )
+
+
+def _clear_limits() -> None:
+    for limit in (resource.RLIMIT_CPU, resource.RLIMIT_AS):
+        resource.setrlimit(limit, (resource.RLIM_INFINITY, resource.RLIM_INFINITY))
+
+
+def _on_cpu_time_limit(signum, frame):
+    raise CPUTimeLimitError("Code execution exceeded its CPU time limit")
+
+
+def run(namespace: SessionNamespace, message: Dict) -> Dict:
+    """Run a query in a session's namespace and encode its results."""
+    global _active_recorder
+
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    recorder = namespace.recorder
+    recorder.reset()
+    _active_recorder = recorder
+    result = None
+    stdout = ""
+    error = None
+    try:
+        compiled = compile_query(message["query"], message["secure"])
+        if message["secure"]:
+            restrict_builtins(namespace.locals)
+        _set_limits(message["cpu_time_limit"], message["memory_limit"])
+        try:
+            ret, stdout = run_compiled(compiled, namespace.locals)
+        finally:
+            _clear_limits()
+        if ret is not None:
+            result = recorder.encoder.encode(ret)
+    except Exception as e:
+        error = "{}: {}".format(type(e).__name__, str(e))
+    finally:
+        _active_recorder = None
+    return {
+        "result": result,
+        "stdout": stdout,
+        "error": error,
+        "renders": recorder.renders,
+        "queries": namespace.bigquery_client.pop_stats()["queries"],
+        "notices": namespace.bigquery_client.pop_notices(),
+        "seconds": time.perf_counter() - start,
+        "cpu_seconds": time.process_time() - cpu_start,
+    }
+
+
+def main(conn: Connection) -> None:
+    """Serve requests from the server until the connection is closed."""
+    Figure.show = _show
+    pio.show = _show
+    signal.signal(signal.SIGXCPU, _on_cpu_time_limit)
+    # Interrupts are handled by the server, which stops its workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    namespaces: "OrderedDict[str, SessionNamespace]" = OrderedDict()
+    while True:
+        try:
+            message = json.loads(conn.recv_bytes())
+        except EOFError:
+            break
+        for session_id in message.get("drop", []):
+            namespaces.pop(session_id, None)
+        if message["type"] != "run":
+            continue
+
+        session_id = message["session_id"]
+        if session_id not in namespaces:
+            if "seed" not in message:
+                # E.g. evicted or restarted, the server resends the message with the seed
+                conn.send_bytes(
+                    json.dumps({"type": "unknown_session", "blobs": 0}).encode()
+                )
+                continue
+            namespaces[session_id] = SessionNamespace(message["seed"])
+            while len(namespaces) > MAX_NAMESPACES:
+                namespaces.popitem(last=False)
+        namespaces.move_to_end(session_id)
+        response = run(namespaces[session_id], message)
+        response["pid"] = os.getpid()
+
+        blobs = namespaces[session_id].recorder.encoder.blobs
+        response["blobs"] = len(blobs)
+        conn.send_bytes(json.dumps(response).encode())
+        for blob in blobs:
+            conn.send_bytes(blob)
+        namespaces[session_id].recorder.reset()
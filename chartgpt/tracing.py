@@ -0,0 +1,282 @@
+"""Sampled, structured traces of agent runs.
+
+A trace is a tree of spans: the agent's chains, LLM calls, tool calls and
+the BigQuery jobs run by agent code, with durations, token counts and byte
+counts as attributes. Whether a trace is kept is decided once, when its root
+span starts, so that unsampled traces cost little more than a dict lookup
+per callback. Finished spans are written as JSON lines by a background
+thread, so exporting never blocks an agent.
+
+LangChain runs are traced by `chartgpt.callback_handler.TracingCallbackHandler`,
+keyed by their `run_id`. Code that runs within a span, such as agent code
+within a tool call, finds its parent with `current_span()`.
+"""
+
+import atexit
+import contextlib
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0.1))
+# Include prompts, completions, code and observations in spans
+TRACE_VERBOSE = os.environ.get("TRACE_VERBOSE", "false").lower() == "true"
+TRACE_PATH = os.environ.get("TRACE_PATH", "logs/traces.jsonl")
+# Finished spans buffered for the exporter, beyond which spans are dropped
+TRACE_QUEUE_SIZE = 10000
+# Open spans kept, and seconds they are kept for, in case a run never ends,
+# e.g. when a Streamlit script is stopped
+TRACE_MAX_OPEN_SPANS = 10000
+TRACE_SPAN_MAX_AGE = float(os.environ.get("TRACE_SPAN_MAX_AGE", 3600))
+
+
+@dataclass
+class Span:
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    name: str
+    kind: str
+    sampled: bool
+    start: float = field(default_factory=time.time)
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    _perf_start: float = field(default_factory=time.perf_counter, repr=False)
+
+    def to_dict(self, duration_ms: float, error: Optional[str]) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "start": self.start,
+            "duration_ms": round(duration_ms, 3),
+            "status": "error" if error else "ok",
+            "error": error,
+            "attributes": self.attributes,
+        }
+
+
+class JsonlExporter:
+    """Appends spans to a JSON lines file from a background thread."""
+
+    def __init__(self, path: str, max_queue_size: int = TRACE_QUEUE_SIZE):
+        self.path = path
+        self.dropped = 0
+        self._queue: "queue.Queue[Optional[Dict]]" = queue.Queue(max_queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def export(self, span: Dict[str, Any]) -> None:
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def shutdown(self) -> None:
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="trace-exporter", daemon=True
+            )
+            self._thread.start()
+            atexit.register(self.shutdown)
+
+    def _run(self) -> None:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        while True:
+            spans = [self._queue.get()]
+            # Write everything already queued in one go
+            while len(spans) < 1000:
+                try:
+                    spans.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in spans
+            lines = [json.dumps(span, default=str) for span in spans if span]
+            try:
+                with open(self.path, "a") as f:
+                    f.write("".join(line + "\n" for line in lines))
+            except OSError:
+                logger.exception("Failed to export %d spans", len(lines))
+            if stop:
+                return
+
+
+class Tracer:
+    """Tracks open spans, sampling traces when their root span starts.
+
+    Only spans of sampled traces are kept open, at most `max_open_spans` of
+    them and for at most `max_age` seconds, after which they are exported
+    as abandoned.
+    """
+
+    def __init__(
+        self,
+        exporter: JsonlExporter,
+        sample_rate: float = TRACE_SAMPLE_RATE,
+        verbose: bool = TRACE_VERBOSE,
+        max_open_spans: int = TRACE_MAX_OPEN_SPANS,
+        max_age: float = TRACE_SPAN_MAX_AGE,
+    ):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.verbose = verbose
+        self.max_open_spans = max_open_spans
+        self.max_age = max_age
+        # Ordered by start time
+        self._spans: "OrderedDict[Any, Span]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start_span(
+        self,
+        key: Any,
+        name: str,
+        kind: str,
+        parent_key: Any = None,
+        **attributes: Any,
+    ) -> Span:
+        """Start a span, identified by `key` until it ends.
+
+        A span whose parent isn't open belongs to an unsampled trace, and
+        isn't kept either.
+        """
+        if parent_key is None:
+            span = self._new_span(name, kind, None)
+        else:
+            parent = self.get_span(parent_key)
+            span = self._new_span(name, kind, parent or UNSAMPLED_SPAN)
+        if not span.sampled:
+            return span
+        span.attributes.update(attributes)
+        with self._lock:
+            self._spans[key] = span
+            abandoned = self._evict()
+        for abandoned_span in abandoned:
+            self._export(
+                abandoned_span,
+                (time.perf_counter() - abandoned_span._perf_start) * 1000,
+                "Abandoned: the span was never ended",
+            )
+        return span
+
+    def end_span(self, key: Any, error: Optional[BaseException] = None) -> None:
+        with self._lock:
+            span = self._spans.pop(key, None)
+        if span is not None:
+            self._export(
+                span,
+                (time.perf_counter() - span._perf_start) * 1000,
+                _format_error(error),
+            )
+
+    def get_span(self, key: Any) -> Optional[Span]:
+        with self._lock:
+            return self._spans.get(key)
+
+    def record_span(
+        self,
+        name: str,
+        kind: str,
+        duration_ms: float,
+        parent: Optional[Span] = None,
+        error: Optional[BaseException] = None,
+        **attributes: Any,
+    ) -> None:
+        """Record a finished span, e.g. for a BigQuery job, under `parent`.
+
+        Nothing is recorded without a parent, so work outside of a sampled
+        trace isn't traced.
+        """
+        if parent is None or not parent.sampled:
+            return
+        span = self._new_span(name, kind, parent)
+        span.start -= duration_ms / 1000
+        span.attributes.update(attributes)
+        self._export(span, duration_ms, _format_error(error))
+
+    def _new_span(self, name: str, kind: str, parent: Optional[Span]) -> Span:
+        if parent is None:
+            sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+            trace_id = uuid.uuid4().hex if sampled else ""
+        else:
+            sampled = parent.sampled
+            trace_id = parent.trace_id
+        return Span(
+            trace_id=trace_id,
+            span_id=uuid.uuid4().hex[:16] if sampled else "",
+            parent_id=parent.span_id if parent else None,
+            name=name,
+            kind=kind,
+            sampled=sampled,
+        )
+
+    def _evict(self) -> List[Span]:
+        # Oldest spans first, called with the lock held
+        evicted = []
+        oldest_start = time.perf_counter() - self.max_age
+        while self._spans and (
+            len(self._spans) > self.max_open_spans
+            or next(iter(self._spans.values()))._perf_start < oldest_start
+        ):
+            evicted.append(self._spans.popitem(last=False)[1])
+        return evicted
+
+    def _export(self, span: Span, duration_ms: float, error: Optional[str]) -> None:
+        self.exporter.export(span.to_dict(duration_ms, error))
+
+
+def _format_error(error: Optional[BaseException]) -> Optional[str]:
+    return f"{type(error).__name__}: {error}" if error else None
+
+
+# Parent of the spans of unsampled traces, which aren't kept
+UNSAMPLED_SPAN = Span(
+    trace_id="", span_id="", parent_id=None, name="", kind="", sampled=False
+)
+
+
+tracer = Tracer(JsonlExporter(TRACE_PATH))
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+def current_span() -> Optional[Span]:
+    """The span that work in this context belongs to, if any."""
+    return _current_span.get()
+
+
+@contextlib.contextmanager
+def activate(key: Any) -> Iterator[Optional[Span]]:
+    """Make an open span of `tracer` the current span within the block.
+
+    The current span is a context variable, so it is also current in
+    threads started with `asyncio.to_thread()` within the block.
+    """
+    span = tracer.get_span(key) if key is not None else None
+    token = _current_span.set(span)
+    try:
+        yield span
+    finally:
+        _current_span.reset(token)
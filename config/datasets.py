@@ -1,8 +1,13 @@
+import os
 from dataclasses import dataclass, field
 from typing import List, Optional
 
 from api.connectors.bigquery import bigquery_client
 
+DEFAULT_MAX_BYTES_PROCESSED = int(
+    os.environ.get("DEFAULT_MAX_BYTES_PROCESSED", 10 * 1024**3)
+)
+
 
 @dataclass
 class Dataset:
@@ -25,6 +30,8 @@ class Dataset:
     Do not limit the number of rows in the SQL query.
     Provide a unique description for each column based on what you can see."
     """
+    # Maximum bytes a single agent query over this dataset may process
+    max_bytes_processed: int = DEFAULT_MAX_BYTES_PROCESSED
 
     def __repr__(self):
         return self.name
@@ -0,0 +1,130 @@
+"""
+Benchmark the data cleaning helpers against the previous per-element versions
+on a synthetic NFTfi loan table
+
+Usage: python scripts/benchmark_data_utils.py [--rows 1000000]
+"""
+
+import argparse
+import locale
+import time
+
+import numpy as np
+import pandas as pd
+
+from chartgpt.data.utils import clean_nftfi_loan_dataframe, locale_to_float_series
+
+DIVISION_ERROR = "#DIV/0! (Function DIVIDE parameter 2 cannot be zero.)"
+
+
+def synthetic_loan_table(rows, seed=0):
+    """A table shaped like the NFTfi loan data export, with its error values."""
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp("2021-01-01") + pd.to_timedelta(
+        rng.integers(0, 3 * 365 * 86400, rows), unit="s"
+    )
+    due = start + pd.to_timedelta(rng.integers(7, 90, rows), unit="D")
+    apr = rng.uniform(0, 300, rows).round(2).astype(object)
+    apr[rng.random(rows) < 0.01] = DIVISION_ERROR
+    protocol = rng.choice(["NFTfi", "Arcade", "BendDAO", "#N/A"], rows)
+    principal = rng.uniform(100, 1_000_000, rows)
+    return pd.DataFrame(
+        {
+            "date": (start - pd.Timestamp("1899-12-30")).days.astype(float),
+            "loan_start_time": start.astype(str),
+            "loan_due_time": due.astype(str),
+            "apr": apr,
+            "protocol": protocol,
+            # Integers too large for int64, as text
+            "nft_collateral_id": rng.integers(0, 10**6, rows).astype(str),
+            "platform_fee": rng.uniform(0, 5, rows).round(4).astype(str),
+            # Written with a comma as the decimal separator, as in French
+            "loan_principal": [f"{value:.2f}".replace(".", ",") for value in principal],
+            "repaid_date": "",
+            "liquidation_date": "",
+            "": "",
+        }
+    )
+
+
+def legacy_clean_nftfi_loan_dataframe(df):
+    """The version of `clean_nftfi_loan_dataframe()` using regex replace."""
+    df["date"] = pd.to_datetime(df["date"], unit="D", origin="1899-12-30")
+    df["loan_start_time"] = df["loan_start_time"].astype("datetime64[s]")
+    df["loan_due_time"] = df["loan_due_time"].astype("datetime64[s]")
+    df.replace(r"#DIV/0!", np.nan, regex=True, inplace=True)
+    df.replace(r"#N/A", "", regex=True, inplace=True)
+    df["nft_collateral_id"] = df["nft_collateral_id"].astype(float).astype(np.int64)
+    df["platform_fee"] = df["platform_fee"].astype(float)
+    df.drop(["repaid_date", "liquidation_date"], axis=1, inplace=True)
+    df = df.drop("", axis=1, errors="ignore")
+    return df
+
+
+def legacy_is_locale_string(s):
+    return (
+        isinstance(s, str)
+        and ("," in s or "." in s)
+        and s.replace(",", "").replace(".", "").isnumeric()
+    )
+
+
+def legacy_locale_to_float_series(series):
+    """The version of `locale_to_float_series()` using `locale.atof()`."""
+    if any(series.apply(legacy_is_locale_string)):
+        first_non_null = series.dropna().iloc[0]
+        if "," in first_non_null:
+            locale.setlocale(locale.LC_ALL, "fr_FR.UTF-8")
+        else:
+            locale.setlocale(locale.LC_ALL, "en_US.UTF-8")
+        series = series.apply(
+            lambda x: locale.atof(x) if legacy_is_locale_string(x) else x
+        )
+        series = pd.to_numeric(series)
+    return series
+
+
+def benchmark(name, function, df):
+    start = time.perf_counter()
+    result = function(df.copy())
+    seconds = time.perf_counter() - start
+    print(f"{name:<32} {seconds:8.3f} s")
+    return result, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    df = synthetic_loan_table(args.rows)
+    print(f"Synthetic loan table: {len(df)} rows x {len(df.columns)} columns")
+
+    legacy, legacy_seconds = benchmark(
+        "legacy clean_nftfi_loan_dataframe", legacy_clean_nftfi_loan_dataframe, df
+    )
+    current, current_seconds = benchmark(
+        "clean_nftfi_loan_dataframe", clean_nftfi_loan_dataframe, df
+    )
+    pd.testing.assert_frame_equal(current, legacy)
+    print(f"Speedup: {legacy_seconds / current_seconds:.2f}x, same result")
+
+    principal = df["loan_principal"]
+    current, current_seconds = benchmark(
+        "locale_to_float_series", locale_to_float_series, principal
+    )
+    try:
+        legacy, legacy_seconds = benchmark(
+            "legacy locale_to_float_series", legacy_locale_to_float_series, principal
+        )
+    except locale.Error as e:
+        print(f"legacy locale_to_float_series    skipped, {e}")
+        return
+    finally:
+        locale.setlocale(locale.LC_ALL, "")
+    pd.testing.assert_series_equal(current, legacy)
+    print(f"Speedup: {legacy_seconds / current_seconds:.2f}x, same result")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Benchmark the AST security validator against the previous recursive version
+
+Usage: python scripts/benchmark_secure_ast.py [--repeat 200]
+"""
+
+import argparse
+import ast
+import timeit
+
+from chartgpt.tools.python.secure_ast import (
+    allowed_imports,
+    analyze_ast,
+    disallowed_attributes,
+    insecure_functions,
+)
+
+# Code in the style the agent writes, after `query_post_processing()`
+SNIPPETS = [
+    """
+query = '''
+SELECT DATE(block_timestamp) AS date, COUNT(*) AS transactions
+FROM `bigquery-public-data.crypto_ethereum.transactions`
+WHERE block_timestamp >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 365 DAY)
+GROUP BY date
+ORDER BY date
+'''
+df = bigquery_client.query(query).to_dataframe()
+fig = px.line(df, x="date", y="transactions", title="Transactions per day")
+st.plotly_chart(fig)
+""",
+    """
+display(tables_summary["metaquants_nft_finance_aggregator"]["p2p_and_p2pool_loan_data_borrow"])
+""",
+    """
+query = '''
+SELECT protocol, AVG(apr) AS avg_apr
+FROM `chartgpt-staging.metaquants_nft_finance_aggregator.p2p_and_p2pool_loan_data_borrow`
+WHERE loan_start_time >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 30 DAY)
+GROUP BY protocol
+ORDER BY avg_apr
+'''
+df = bigquery_client.query(query).to_dataframe()
+df["avg_apr"] = df["avg_apr"].round(2)
+display(df.sort_values("avg_apr").head(1))
+""",
+    """
+df = bigquery_client.query(query).to_dataframe()
+df["month"] = pd.to_datetime(df["loan_start_time"]).dt.to_period("M").astype(str)
+volume = df.groupby(["month", "protocol"], as_index=False)["loan_principal_usd"].sum()
+fig = go.Figure()
+for protocol, group in volume.groupby("protocol"):
+    fig.add_trace(
+        go.Scatter(
+            x=group["month"],
+            y=group["loan_principal_usd"],
+            name=protocol,
+            stackgroup="one",
+        )
+    )
+fig.update_layout(title="USD lending volume", xaxis_title="Month", yaxis_title="USD")
+st.plotly_chart(fig)
+""",
+    """
+import numpy as np
+import scipy.stats
+
+numeric = df.select_dtypes(include=[np.number])
+display(numeric.describe())
+corr = numeric.corr()
+fig = px.imshow(corr, text_auto=True, title="Correlation matrix")
+st.plotly_chart(fig)
+outliers = {
+    column: int((np.abs(scipy.stats.zscore(numeric[column].dropna())) > 3).sum())
+    for column in numeric.columns
+}
+display(outliers)
+""",
+]
+
+
+def legacy_allowed_node(node):
+    if isinstance(node, (ast.Import, ast.ImportFrom)):
+        for alias in node.names:
+            if alias.name not in allowed_imports:
+                raise ValueError(f"Importing '{alias.name}' is not allowed")
+
+    if isinstance(node, ast.Call):
+        if isinstance(node.func, ast.Name) and node.func.id == "__import__":
+            if isinstance(node.args[0], ast.Constant):
+                if node.args[0].value not in allowed_imports:
+                    raise ValueError(
+                        f"Dynamic importing '{node.args[0].value}' is not allowed"
+                    )
+        elif isinstance(node.func, ast.Name) and node.func.id in insecure_functions:
+            raise ValueError(f"Function '{node.func.id}' is not allowed")
+
+    if isinstance(node, ast.Attribute):
+        full_name = []
+        n = node
+        while isinstance(n, ast.Attribute):
+            full_name.insert(0, n.attr)
+            n = n.value
+        if isinstance(n, ast.Name):
+            full_name.insert(0, n.id)
+        full_attr_name = ".".join(full_name)
+        if full_attr_name in disallowed_attributes:
+            raise ValueError(f"Accessing '{full_attr_name}' is not allowed")
+
+    if isinstance(node, (ast.Attribute, ast.Name)):
+        if (
+            (node.attr.startswith("._") or node.attr.startswith(".__"))
+            if hasattr(node, "attr")
+            else (node.id.startswith("._") or node.id.startswith(".__"))
+        ):
+            raise ValueError("Accessing private members is not allowed")
+
+
+def legacy_analyze_ast(node, max_depth=float("inf"), current_depth=0):
+    """The recursive validator replaced by `analyze_ast()`."""
+    if current_depth >= max_depth:
+        return
+    if isinstance(node, ast.AST):
+        legacy_allowed_node(node)
+        for child in ast.iter_child_nodes(node):
+            legacy_analyze_ast(child, max_depth, current_depth + 1)
+
+
+def benchmark(name, validate, trees, repeat):
+    seconds = min(
+        timeit.repeat(
+            lambda: [validate(tree) for tree in trees], number=repeat, repeat=5
+        )
+    )
+    per_call_us = seconds / (repeat * len(trees)) * 1e6
+    print(f"{name:<10} {per_call_us:8.1f} us per snippet")
+    return per_call_us
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    trees = [ast.parse(snippet) for snippet in SNIPPETS]
+    # A long generated script, as produced when the agent unrolls a loop
+    trees.append(ast.parse("\n".join(SNIPPETS * 50)))
+
+    legacy = benchmark("legacy", legacy_analyze_ast, trees, args.repeat)
+    current = benchmark("current", analyze_ast, trees, args.repeat)
+    print(f"Speedup: {legacy / current:.2f}x")
+
+    # Long expressions, e.g. sums of many columns, are deeply nested trees,
+    # validated from deep within the Streamlit and LangChain call stacks
+    deep = ast.parse("x = " + " + ".join(["df['a']"] * 800))
+    for name, validate in [("legacy", legacy_analyze_ast), ("current", analyze_ast)]:
+        try:
+            call_with_stack_depth(200, validate, deep)
+            print(f"{name:<10} validated deeply nested code")
+        except RecursionError:
+            print(f"{name:<10} RecursionError on deeply nested code")
+
+
+def call_with_stack_depth(depth, function, *args):
+    if depth == 0:
+        return function(*args)
+    return call_with_stack_depth(depth - 1, function, *args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+"""
+Rename documents in `closed_beta_email_addresses` collection to their lower-cased
+email address, as closed beta membership is looked up by lower-cased email address
+"""
+
+from app import db
+
+closed_beta_email_addresses = db.collection("closed_beta_email_addresses")
+
+for doc in closed_beta_email_addresses.stream():
+    email_address = doc.id.lower()
+    if doc.id == email_address:
+        continue
+    print(f"Renaming email address {doc.id} to {email_address}")
+    closed_beta_email_addresses.document(email_address).set(doc.to_dict(), merge=True)
+    closed_beta_email_addresses.document(doc.id).delete()
@@ -16,15 +16,20 @@ closed_beta_email_addresses_waitlist = [
 closed_beta_email_addresses_stream = db.collection(
     "closed_beta_email_addresses"
 ).stream()
-closed_beta_email_addresses = [doc.id for doc in closed_beta_email_addresses_stream]
+# Stored in lower case, as membership is checked by lower-cased email address
+closed_beta_email_addresses = [
+    doc.id.lower() for doc in closed_beta_email_addresses_stream
+]
 
 # Transfer email addresses from waitlist
 for email_address in closed_beta_email_addresses_waitlist:
-    if email_address not in closed_beta_email_addresses:
+    if email_address.lower() not in closed_beta_email_addresses:
         print(
             f"Adding email address {email_address} to closed_beta_email_addresses collection"
         )
-        db.collection("closed_beta_email_addresses").document(email_address).set({})
+        db.collection("closed_beta_email_addresses").document(
+            email_address.lower()
+        ).set({})
     else:
         print(
             f"Email address {email_address} already exists in closed_beta_email_addresses collection"
@@ -32,7 +37,7 @@ for email_address in closed_beta_email_addresses_waitlist:
 
 # If email was successfully transferred, delete it from the waitlist
 for email_address in closed_beta_email_addresses_waitlist:
-    if email_address in closed_beta_email_addresses:
+    if email_address.lower() in closed_beta_email_addresses:
         print(
             f"Deleting email address {email_address} from closed_beta_email_addresses_waitlist collection"
         )